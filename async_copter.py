@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+
+"""
+    Asyncio version of the Copter class from main.py.
+
+    The link is driven by an asyncio datagram (UDP) or serial transport, every received
+    packet is parsed in the event loop and dispatched on a MessageBus, and the waits are
+    futures resolved from that bus. One event loop can then stream setpoints, watch
+    telemetry and run the planner at the same time without threads.
+
+    Serial links need pyserial-asyncio (pip install pyserial-asyncio).
+"""
+
+import asyncio
+import os
+import threading
+
+from pymavlink import mavutil
+
+from main import (Copter, ErrorException, HeartbeatScheduler, MessageBus, MessageCache, TimeoutException,
+                  WaitAltitudeTimout, WaitModeTimeout)
+
+
+class DatagramLink(asyncio.DatagramProtocol):
+    """UDP transport feeding an AsyncCopter."""
+
+    def __init__(self, copter, remote=None):
+        self.copter = copter
+        self.remote = remote
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.remote is None or self.copter.reply_to_sender:
+            # udpin: answer whoever talks to us, like mavutil does
+            self.remote = addr
+        self.copter.data_received(data)
+
+    def write(self, buf):
+        if self.remote is not None:
+            self.transport.sendto(buf, self.remote)
+
+
+class StreamLink(asyncio.Protocol):
+    """Serial (or any stream) transport feeding an AsyncCopter."""
+
+    def __init__(self, copter):
+        self.copter = copter
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.copter.data_received(data)
+
+    def write(self, buf):
+        self.transport.write(buf)
+
+
+class AsyncCopter:
+    """ArduPilot Copter class for asyncio.
+
+    Same commands as Copter, but every command and wait is a coroutine."""
+
+    def __init__(self, sysid=1, source_system=250, source_component=250):
+        self.target_system = sysid
+        self.target_component = 1
+        self.source_system = source_system
+        self.source_component = source_component
+        self.heartbeat_interval_ms = 1000
+        self.reply_to_sender = False
+        self.link = None
+        self.mav = None
+        self.bus = MessageBus()
+        self.cache = MessageCache()
+        self.heartbeat = None
+        self.heartbeat_task = None
+        self.flightmode = "UNKNOWN"
+        self.motors_armed = False
+        self.mode_map = None
+
+    progress = staticmethod(Copter.progress)
+    mav_result_name = staticmethod(Copter.mav_result_name)
+
+    async def connect(self, connection_string='udpin:0.0.0.0:14550', baud=115200):
+        """Open the link and start the heartbeats.
+        connection_string is udpin:host:port, udpout:host:port or a serial device."""
+        os.environ['MAVLINK20'] = '1'
+        mavutil.set_dialect("ardupilotmega")
+        self.mav = mavutil.mavlink.MAVLink(self, srcSystem=self.source_system, srcComponent=self.source_component)
+        self.mav.robust_parsing = True
+        loop = asyncio.get_running_loop()
+        if connection_string.startswith(('udpin:', 'udp:')):
+            host, port = connection_string.split(':')[1:]
+            self.reply_to_sender = True
+            (_, self.link) = await loop.create_datagram_endpoint(lambda: DatagramLink(self),
+                                                                 local_addr=(host, int(port)))
+        elif connection_string.startswith('udpout:'):
+            host, port = connection_string.split(':')[1:]
+            (_, self.link) = await loop.create_datagram_endpoint(lambda: DatagramLink(self, (host, int(port))),
+                                                                 remote_addr=(host, int(port)))
+        else:
+            try:
+                import serial_asyncio
+            except ImportError:
+                raise ErrorException("Serial links need pyserial-asyncio")
+            (_, self.link) = await serial_asyncio.create_serial_connection(loop, lambda: StreamLink(self),
+                                                                           connection_string, baudrate=baud)
+        self.bus.subscribe('HEARTBEAT', self.heartbeat_hook, sysid=self.target_system)
+        self.bus.subscribe('STATUSTEXT', self.message_hook, sysid=self.target_system)
+        if self.heartbeat_interval_ms is not None:
+            self.heartbeat = HeartbeatScheduler(self, threading.Lock(), self.heartbeat_interval_ms * 0.001)
+            self.heartbeat_task = asyncio.ensure_future(self.heartbeat_loop())
+
+    def close(self):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+        if self.link is not None:
+            self.link.transport.close()
+            self.link = None
+
+    def write(self, buf):
+        """File interface used by the MAVLink encoder."""
+        self.link.write(buf)
+
+    def data_received(self, data):
+        """Parse what the transport got and dispatch every message."""
+        msgs = self.mav.parse_buffer(data)
+        if msgs is None:
+            return
+        for m in msgs:
+            if m.get_type() == 'BAD_DATA':
+                continue
+            if m.get_srcSystem() == self.target_system:
+                self.cache.update(m)
+            self.bus.publish(m)
+
+    async def heartbeat_loop(self):
+        loop = asyncio.get_running_loop()
+        next_beat = loop.time()
+        while True:
+            self.heartbeat.beat()
+            next_beat += self.heartbeat.interval
+            await asyncio.sleep(max(0.0, next_beat - loop.time()))
+
+    def heartbeat_hook(self, msg):
+        if msg.get_srcComponent() != self.target_component:
+            return
+        self.flightmode = mavutil.mode_string_v10(msg)
+        self.motors_armed = bool(msg.base_mode & mavutil.mavlink.MAV_MODE_FLAG_SAFETY_ARMED)
+        if self.mode_map is None:
+            self.mode_map = mavutil.mode_mapping_byname(msg.type)
+
+    def message_hook(self, msg):
+        """Display STATUSTEXT messages."""
+        self.progress("AP: %s" % msg.text)
+
+    def expect(self, type, condition=None):
+        """Return a future resolved by the next message of type (a string or a list of strings)
+        from our target system that satisfies condition.
+        Register it before sending the request so the answer can't be missed."""
+        if not isinstance(type, (list, set)):
+            type = [type]
+        future = asyncio.get_running_loop().create_future()
+
+        def resolve(msg):
+            if future.done():
+                return
+            if condition is not None and not condition(msg):
+                return
+            future.set_result(msg)
+
+        tokens = [self.bus.subscribe(t, resolve, sysid=self.target_system) for t in type]
+
+        def cleanup(_):
+            for token in tokens:
+                self.bus.unsubscribe(token)
+
+        future.add_done_callback(cleanup)
+        return future
+
+    async def recv_match(self, type, timeout=None, condition=None):
+        """Wait for the next message of type; return None on timeout."""
+        future = self.expect(type, condition)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def wait_heartbeat(self, timeout=10):
+        m = await self.recv_match('HEARTBEAT', timeout=timeout,
+                                  condition=lambda m: m.get_srcComponent() == self.target_component)
+        if m is None:
+            raise TimeoutException("Did not receive heartbeat")
+        return m
+
+    def send_cmd(self, command, p1, p2, p3, p4, p5, p6, p7, target_sysid=None, target_compid=None):
+        """Send a MAVLink command long."""
+        if target_sysid is None:
+            target_sysid = self.target_system
+        if target_compid is None:
+            target_compid = 1
+        self.mav.command_long_send(target_sysid,
+                                   target_compid,
+                                   command,
+                                   1,  # confirmation
+                                   p1,
+                                   p2,
+                                   p3,
+                                   p4,
+                                   p5,
+                                   p6,
+                                   p7)
+
+    async def run_cmd(self,
+                      command,
+                      p1,
+                      p2,
+                      p3,
+                      p4,
+                      p5,
+                      p6,
+                      p7,
+                      want_result=mavutil.mavlink.MAV_RESULT_ACCEPTED,
+                      target_sysid=None,
+                      target_compid=None,
+                      timeout=10,
+                      quiet=False):
+        ack = self.expect('COMMAND_ACK', condition=lambda m: m.command == command)
+        self.send_cmd(command, p1, p2, p3, p4, p5, p6, p7,
+                      target_sysid=target_sysid, target_compid=target_compid)
+        try:
+            m = await asyncio.wait_for(ack, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutException("Did not get good COMMAND_ACK within %fs" % timeout)
+        if not quiet:
+            self.progress("ACK received: %s" % str(m))
+        if m.result != want_result:
+            raise ValueError("Expected %s got %s" % (self.mav_result_name(want_result),
+                                                     self.mav_result_name(m.result)))
+
+    def get_mode_from_mode_mapping(self, mode):
+        """Validate and return the mode number from a string or int."""
+        if self.mode_map is None:
+            raise ErrorException("No mode map yet, wait for a heartbeat first")
+        if isinstance(mode, str):
+            if mode in self.mode_map:
+                return self.mode_map.get(mode)
+        if mode in self.mode_map.values():
+            return mode
+        self.progress("Available modes '%s'" % self.mode_map)
+        raise ErrorException("Unknown mode '%s'" % mode)
+
+    async def change_mode(self, mode, timeout=60):
+        """change vehicle flightmode"""
+        if self.mode_map is None:
+            await self.wait_heartbeat()
+        want_custom_mode = self.get_mode_from_mode_mapping(mode)
+        self.progress("Changing mode to %s" % mode)
+        loop = asyncio.get_running_loop()
+        tstart = loop.time()
+        while loop.time() - tstart < timeout:
+            heartbeat = self.expect('HEARTBEAT', condition=lambda m: m.custom_mode == want_custom_mode)
+            await self.run_cmd(mavutil.mavlink.MAV_CMD_DO_SET_MODE,
+                               mavutil.mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED,
+                               want_custom_mode,
+                               0,
+                               0,
+                               0,
+                               0,
+                               0,
+                               timeout=10)
+            try:
+                await asyncio.wait_for(heartbeat, 5)
+                return
+            except asyncio.TimeoutError:
+                continue
+        raise WaitModeTimeout("Failed to change mode")
+
+    async def arm_vehicle(self, timeout=20):
+        """Arm vehicle with mavlink arm message."""
+        self.progress("Arm motors with MAVLink cmd")
+        armed = self.expect('HEARTBEAT',
+                            condition=lambda m: m.base_mode & mavutil.mavlink.MAV_MODE_FLAG_SAFETY_ARMED)
+        await self.run_cmd(mavutil.mavlink.MAV_CMD_COMPONENT_ARM_DISARM,
+                           1,  # ARM
+                           0,
+                           0,
+                           0,
+                           0,
+                           0,
+                           0,
+                           timeout=timeout)
+        try:
+            await asyncio.wait_for(armed, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutException("Failed to ARM with mavlink")
+        self.progress("Motors ARMED")
+        return True
+
+    async def user_takeoff(self, alt_min=30):
+        """takeoff using mavlink takeoff command"""
+        await self.run_cmd(mavutil.mavlink.MAV_CMD_NAV_TAKEOFF,
+                           0,  # param1
+                           0,  # param2
+                           0,  # param3
+                           0,  # param4
+                           0,  # param5
+                           0,  # param6
+                           alt_min  # param7
+                           )
+        await self.wait_altitude(alt_min - 1, alt_min + 5, relative=True)
+
+    async def wait_altitude(self, altitude_min, altitude_max, relative=False, timeout=30, minimum_duration=0):
+        """Wait for a given altitude range, held for minimum_duration seconds."""
+        assert altitude_min <= altitude_max, "Minimum altitude should be less than maximum altitude."
+        self.progress("Waiting for Altitude between %.02f and %.02f" % (altitude_min, altitude_max))
+        loop = asyncio.get_running_loop()
+        tstart = loop.time()
+        achieving_duration_start = None
+        # one subscription for the whole wait, every sample is queued
+        samples = asyncio.Queue()
+        token = self.bus.subscribe('GLOBAL_POSITION_INT', samples.put_nowait, sysid=self.target_system)
+        try:
+            while True:
+                remaining = tstart + timeout - loop.time()
+                if remaining <= 0:
+                    raise WaitAltitudeTimout("Failed to attain altitude between %.02f and %.02f" %
+                                             (altitude_min, altitude_max))
+                try:
+                    m = await asyncio.wait_for(samples.get(), remaining)
+                except asyncio.TimeoutError:
+                    continue
+                if relative:
+                    alt = m.relative_alt / 1000.0  # mm -> m
+                else:
+                    alt = m.alt / 1000.0  # mm -> m
+                if not altitude_min <= alt <= altitude_max:
+                    achieving_duration_start = None
+                    continue
+                if achieving_duration_start is None:
+                    achieving_duration_start = loop.time()
+                if loop.time() - achieving_duration_start >= minimum_duration:
+                    self.progress("Attained Altitude=%f" % alt)
+                    return alt
+        finally:
+            self.bus.unsubscribe(token)
+
+    async def move_ned(self, north, east, down):
+        """Send a position target in the local NED frame."""
+        self.mav.send(
+            mavutil.mavlink.MAVLink_set_position_target_local_ned_message(10, self.target_system,
+                                                                          self.target_component,
+                                                                          mavutil.mavlink.MAV_FRAME_LOCAL_NED,
+                                                                          int(0b010111111000),
+                                                                          north,
+                                                                          east,
+                                                                          down,
+                                                                          0, 0, 0, 0, 0, 0, 0, 0))
+        # give the loop a chance to run the receive and heartbeat tasks between setpoints
+        await asyncio.sleep(0)
+
+
+async def main():
+    copter = AsyncCopter()
+    await copter.connect("udpin:0.0.0.0:14550")
+    await copter.wait_heartbeat()
+    await copter.change_mode("GUIDED")
+    if not copter.motors_armed:
+        await copter.arm_vehicle()
+        await copter.user_takeoff(1)
+
+    async def stream_setpoints():
+        for coord in [[0.0, 0.0, -1.0], [1.0, 0.0, -1.0], [1.0, 1.0, -1.0], [0.0, 0.0, -1.0]]:
+            await copter.move_ned(coord[0], coord[1], coord[2])
+            await asyncio.sleep(2)
+
+    async def watch_altitude():
+        for i in range(8):
+            m = await copter.recv_match('GLOBAL_POSITION_INT', timeout=2)
+            if m is not None:
+                copter.progress("Alt: %.02f" % (m.relative_alt / 1000.0))
+            await asyncio.sleep(1)
+
+    await asyncio.gather(stream_setpoints(), watch_altitude())
+    copter.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""
+    MAVLink FTP client for Copter.
+
+    Usage :
+    ftp = MAVFTPClient(copter.mav, copter.bus, copter.target_system)
+    (count, params) = decode_param_pck(ftp.read_file("@PARAM/param.pck"))
+"""
+
+import queue
+import struct
+import time
+
+
+class FTPError(Exception):
+    """Thrown when a MAVLink FTP operation is refused or times out"""
+    pass
+
+
+class FTPReply:
+    """Decoded FILE_TRANSFER_PROTOCOL payload."""
+
+    HEADER = struct.Struct('<HBBBBBBI')
+
+    def __init__(self, payload):
+        (self.seq, self.session, self.opcode, self.size, self.req_opcode, self.burst_complete, _,
+         self.offset) = self.HEADER.unpack_from(payload, 0)
+        self.data = bytes(payload[self.HEADER.size:self.HEADER.size + self.size])
+
+
+class MAVFTPClient:
+    """MAVLink FTP client on top of the Copter message bus.
+
+    Reads use burst reads: the vehicle streams the file without waiting for one request per chunk.
+    The chunks lost on the way are asked again with plain reads, window at a time. A session is
+    always terminated, whatever happens during the transfer."""
+
+    OP_TERMINATE_SESSION = 1
+    OP_RESET_SESSIONS = 2
+    OP_OPEN_FILE_RO = 4
+    OP_READ_FILE = 5
+    OP_BURST_READ_FILE = 15
+    OP_ACK = 128
+    OP_NAK = 129
+    ERR_EOF = 6
+    MAX_DATA = 239
+
+    def __init__(self, mav, bus, target_system, target_component=1):
+        self.mav = mav
+        self.bus = bus
+        self.target_system = target_system
+        self.target_component = target_component
+        self.seq = 0
+        self.replies = queue.SimpleQueue()
+
+    def send(self, opcode, session=0, offset=0, size=0, data=b''):
+        self.seq = (self.seq + 1) % 0x10000
+        payload = FTPReply.HEADER.pack(self.seq, session, opcode, size, 0, 0, 0, offset) + data
+        payload += bytes(251 - len(payload))
+        self.mav.mav.file_transfer_protocol_send(0, self.target_system, self.target_component, payload)
+
+    def reply(self, timeout):
+        """Next FTP reply, None after timeout seconds."""
+        try:
+            m = self.replies.get(timeout=max(0.0, timeout))
+        except queue.Empty:
+            return None
+        return FTPReply(bytes(m.payload))
+
+    def request(self, opcode, session=0, offset=0, size=0, data=b'', timeout=1.0, retries=3):
+        """Send a request and return its ACK; raise FTPError on NAK or when no answer comes."""
+        for attempt in range(retries + 1):
+            self.send(opcode, session, offset, size, data)
+            deadline = time.monotonic() + timeout
+            while True:
+                r = self.reply(deadline - time.monotonic())
+                if r is None:
+                    break
+                if r.req_opcode != opcode:
+                    continue
+                if r.opcode == self.OP_NAK:
+                    raise FTPError("FTP request %u refused, error %u" % (opcode, r.data[0] if r.data else 0))
+                return r
+        raise FTPError("No answer to FTP request %u" % opcode)
+
+    def start(self):
+        self.token = self.bus.subscribe('FILE_TRANSFER_PROTOCOL', self.replies.put, sysid=self.target_system)
+
+    def stop(self):
+        self.bus.unsubscribe(self.token)
+
+    def read_file(self, path, timeout=60, window=8, idle_timeout=0.3):
+        """Return the content of path on the vehicle."""
+        self.start()
+        session = None
+        try:
+            r = self.request(self.OP_OPEN_FILE_RO, data=path.encode('ascii'), size=len(path))
+            session = r.session
+            file_size = None
+            if r.size >= 4:
+                (file_size,) = struct.unpack('<I', r.data[:4])
+                # virtual files like param.pck may not know their size before they are read
+                file_size = file_size or None
+            return self.read_session(session, file_size, time.monotonic() + timeout, window, idle_timeout)
+        finally:
+            if session is not None:
+                try:
+                    self.request(self.OP_TERMINATE_SESSION, session=session, retries=1)
+                except FTPError:
+                    pass
+            self.stop()
+
+    def read_session(self, session, file_size, deadline, window, idle_timeout):
+        chunks = {}
+        requested = {}
+        self.send(self.OP_BURST_READ_FILE, session, 0, self.MAX_DATA)
+        bursting = True
+        while True:
+            if time.monotonic() > deadline:
+                raise FTPError("FTP read timed out, got %u bytes" % sum(len(c) for c in chunks.values()))
+            r = self.reply(idle_timeout)
+            if r is not None:
+                if r.session != session:
+                    continue
+                if r.opcode == self.OP_ACK and r.req_opcode in (self.OP_READ_FILE, self.OP_BURST_READ_FILE):
+                    chunks[r.offset] = r.data
+                    requested.pop(r.offset, None)
+                    if r.req_opcode == self.OP_BURST_READ_FILE and r.burst_complete:
+                        bursting = False
+                elif r.opcode == self.OP_NAK and r.data and r.data[0] == self.ERR_EOF:
+                    if r.req_opcode == self.OP_BURST_READ_FILE:
+                        bursting = False
+                    requested.pop(r.offset, None)
+                    if file_size is None or r.offset < file_size:
+                        file_size = r.offset
+                elif r.opcode == self.OP_NAK:
+                    raise FTPError("FTP read refused, error %u" % (r.data[0] if r.data else 0))
+                if bursting:
+                    continue
+            elif bursting:
+                # the burst went quiet, its last packets were lost
+                bursting = False
+            (gaps, end) = self.gaps(chunks, file_size)
+            if len(gaps) == 0:
+                if file_size is not None:
+                    return b''.join(chunks[offset] for offset in sorted(chunks))[:file_size]
+                # the burst stopped before the end of the file
+                self.send(self.OP_BURST_READ_FILE, session, end, self.MAX_DATA)
+                bursting = True
+                continue
+            now = time.monotonic()
+            in_flight = len([t for t in requested.values() if now - t < idle_timeout])
+            for (offset, size) in gaps:
+                if in_flight >= window:
+                    break
+                if now - requested.get(offset, 0) < idle_timeout:
+                    continue
+                self.send(self.OP_READ_FILE, session, offset, size)
+                requested[offset] = now
+                in_flight += 1
+
+    def gaps(self, chunks, file_size):
+        """Return the (offset, size) reads needed to fill the holes of chunks, and where they end."""
+        gaps = []
+        end = 0
+        for offset in sorted(chunks):
+            if offset > end:
+                gaps.extend(self.split(end, offset))
+            end = max(end, offset + len(chunks[offset]))
+        if file_size is not None and end < file_size:
+            gaps.extend(self.split(end, file_size))
+        return gaps, end
+
+    def split(self, start, stop):
+        return [(offset, min(self.MAX_DATA, stop - offset)) for offset in range(start, stop, self.MAX_DATA)]
+
+
+def decode_param_pck(data):
+    """Decode ArduPilot's @PARAM/param.pck into (total parameter count, [(name, value)] in index order)."""
+    (magic, count, total) = struct.unpack_from('<HHH', data, 0)
+    if magic not in (0x671b, 0x671c):
+        raise FTPError("param.pck has a bad magic 0x%x" % magic)
+    with_defaults = magic == 0x671c
+    formats = {1: 'b', 2: 'h', 3: 'i', 4: 'f'}
+    params = []
+    last_name = b''
+    pos = 6
+    while pos < len(data):
+        if data[pos] == 0:
+            # padding so that no record crosses a FTP chunk boundary
+            pos += 1
+            continue
+        (ptype, plen) = struct.unpack_from('<BB', data, pos)
+        fmt = formats.get(ptype & 0x0F)
+        if fmt is None:
+            raise FTPError("param.pck has a bad type 0x%x" % ptype)
+        name_len = (plen >> 4) + 1
+        common_len = plen & 0x0F
+        name = last_name[:common_len] + data[pos + 2:pos + 2 + name_len]
+        pos += 2 + name_len
+        (value,) = struct.unpack_from('<' + fmt, data, pos)
+        pos += struct.calcsize(fmt)
+        if with_defaults and (ptype >> 4) & 1:
+            pos += struct.calcsize(fmt)
+        params.append((name.decode('ascii'), float(value)))
+        last_name = name
+    if len(params) != count:
+        raise FTPError("param.pck holds %u parameters, expected %u" % (len(params), count))
+    return total, params
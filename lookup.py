@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+    Name <-> id tables of the ardupilotmega dialect, built once at import.
+
+    The per-message and per-command paths look names up in these dictionaries instead of
+    scanning the pymavlink enums or building attribute names at runtime. COMMAND_LONG progress
+    lines are formatted from a CommandTemplate holding the command name, so only the
+    parameters are formatted per call.
+
+    Usage :
+    lookup.message_id('GLOBAL_POSITION_INT')
+    lookup.enum_value('EKF_STATUS_FLAGS', 'EKF_PRED_POS_HORIZ_REL')
+    lookup.command_template(mavutil.mavlink.MAV_CMD_NAV_TAKEOFF).describe(1, 1, params)
+"""
+
+from pymavlink.dialects.v20 import ardupilotmega as dialect
+
+# message name -> id, id -> name and id -> full payload length
+MESSAGE_IDS = {}
+MESSAGE_NAMES = {}
+MESSAGE_LENGTHS = {}
+for (msgid, message_class) in dialect.mavlink_map.items():
+    MESSAGE_IDS[message_class.msgname] = msgid
+    MESSAGE_NAMES[msgid] = message_class.msgname
+    MESSAGE_LENGTHS[msgid] = message_class.unpacker.size
+
+# enum -> {entry name -> value} and enum -> {value -> entry name}
+ENUM_VALUES = {}
+ENUM_NAMES = {}
+for (enum, entries) in dialect.enums.items():
+    ENUM_VALUES[enum] = {entry.name: value for (value, entry) in entries.items()}
+    ENUM_NAMES[enum] = {value: entry.name for (value, entry) in entries.items()}
+
+
+def message_id(msg_type):
+    """Return the id of a message name; an id or None is returned as is."""
+    if msg_type is None or isinstance(msg_type, int):
+        return msg_type
+    try:
+        return MESSAGE_IDS[msg_type]
+    except KeyError:
+        raise ValueError("Unknown message %s" % msg_type)
+
+
+def message_name(msgid, default=None):
+    return MESSAGE_NAMES.get(msgid, default)
+
+
+def frame_length(msgid, signed=False):
+    """Longest MAVLink2 frame of msgid on the wire: header, untruncated payload, CRC and the optional signature."""
+    length = dialect.HEADER_LEN_V2 + MESSAGE_LENGTHS[msgid] + 2
+    if signed:
+        length += dialect.MAVLINK_SIGNATURE_BLOCK_LEN
+    return length
+
+
+def enum_value(enum, name):
+    """Return the value of the entry name of enum; raise ValueError if there is none."""
+    try:
+        return ENUM_VALUES[enum][name]
+    except KeyError:
+        raise ValueError("No enum entry with name: " + name)
+
+
+def enum_name(enum, value, default=None):
+    return ENUM_NAMES.get(enum, {}).get(value, default)
+
+
+class CommandTemplate:
+    """What we know about a MAV_CMD before sending it: its id, its name and its progress line."""
+
+    def __init__(self, command, name):
+        self.command = command
+        self.name = name
+        self.progress_format = ("Sending COMMAND_LONG to (%%u,%%u) (%s) "
+                                "(p1=%%f p2=%%f p3=%%f p4=%%f p5=%%f p6=%%f  p7=%%f)" % name)
+
+    def describe(self, target_sysid, target_compid, params):
+        """Progress line of this command sent to (target_sysid, target_compid) with the 7 params."""
+        return self.progress_format % ((target_sysid, target_compid) + tuple(params))
+
+
+COMMAND_TEMPLATES = {command: CommandTemplate(command, name) for (command, name) in ENUM_NAMES["MAV_CMD"].items()}
+
+
+def command_template(command):
+    """Return the CommandTemplate of command; ids missing from the dialect get one named UNKNOWN=<id>."""
+    template = COMMAND_TEMPLATES.get(command)
+    if template is None:
+        template = CommandTemplate(command, "UNKNOWN=%u" % command)
+        COMMAND_TEMPLATES[command] = template
+    return template
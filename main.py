@@ -40,24 +40,39 @@
     Those are heavily based on the work done on ArduPilot Autotest framework : https://ardupilot.org/dev/docs/the-ardupilot-autotest-framework.html
 """
 
+import collections
+import concurrent.futures
 import copy
+import itertools
+import json
 import math
 import os
+import queue
+import random
+import struct
 import sys
+import threading
 import time
+import traceback
 
 from pymavlink.dialects.v20 import ardupilotmega
 from MAVProxy.modules.lib import mp_util
 from pymavlink import mavutil
 from pymavlink import mavextra
 from pymavlink import mavparm
-from pymavlink.rotmat import Vector3
 from pymavlink import mavwp
 from pymavlink.mavutil import location
 import datetime
 
+import lookup
+from ftp import FTPError, MAVFTPClient, decode_param_pck
+from recorder import TelemetryRecorder
+from replay import ReplayLink
+
 __license__ = "GPLv3}"
 
+PARAMETER_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "copter-parameters")
+
 
 class ErrorException(Exception):
     """Base class for other exceptions"""
@@ -143,11 +158,1144 @@ class PreconditionFailedException(ErrorException):
     pass
 
 
+class WaitGuardException(NotAchievedException):
+    """Thrown when a guard of a composite wait is attained"""
+    pass
+
+
+class LinkBudgetException(ErrorException):
+    """Thrown when a message rate plan needs more bandwidth than the link has"""
+    pass
+
+
 class ArmedAtEndOfTestException(ErrorException):
     """Created when test left vehicle armed"""
     pass
 
 
+class MessageCache:
+    """Latest message of each type received from the vehicle.
+
+    Filled by the Copter receive thread. Every type keeps a sequence number that is bumped on each
+    new message, so a reader can tell whether the cached message is newer than the one it last saw,
+    and wait_newer() blocks on the condition until it is."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.messages = {}
+        self.sequence = {}
+
+    def update(self, msg):
+        """Store a freshly parsed message."""
+        mtype = msg.get_type()
+        with self.condition:
+            self.messages[mtype] = msg
+            self.sequence[mtype] = self.sequence.get(mtype, 0) + 1
+            self.condition.notify_all()
+
+    def get(self, mtype, default=None):
+        """Return the latest message of the given type without blocking."""
+        return self.messages.get(mtype, default)
+
+    def wait_newer(self, mtype, sequence, timeout=None):
+        """Return (message, its sequence number) once the mtype sequence number is above sequence;
+        (None, sequence) on timeout."""
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.sequence.get(mtype, 0) <= sequence:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None, sequence
+                self.condition.wait(remaining)
+            return self.messages[mtype], self.sequence[mtype]
+
+
+class ReceiveBuffer:
+    """Ring buffer of the last received messages, stamped with their monotonic arrival time.
+
+    Every message gets an ever increasing index and a cursor is just such an index: "only consider
+    messages newer than T" is a bisect on the arrival times instead of a drain of the link, and
+    nothing is thrown away for the other readers."""
+
+    def __init__(self, size=4096, condition=None):
+        if condition is None:
+            condition = threading.Condition()
+        self.condition = condition
+        self.size = size
+        self.messages = [None] * size
+        self.times = [0.0] * size
+        self.next_index = 0
+
+    def append(self, msg, arrival=None):
+        if arrival is None:
+            arrival = time.monotonic()
+        with self.condition:
+            slot = self.next_index % self.size
+            self.messages[slot] = msg
+            self.times[slot] = arrival
+            self.next_index += 1
+            self.condition.notify_all()
+
+    def cursor(self):
+        """Cursor past the newest message."""
+        return self.next_index
+
+    def oldest(self):
+        """Cursor of the oldest message still in the buffer."""
+        return max(0, self.next_index - self.size)
+
+    def cursor_at(self, arrival):
+        """Cursor of the first message that arrived at or after the monotonic time arrival."""
+        with self.condition:
+            lo = self.oldest()
+            hi = self.next_index
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.times[mid % self.size] < arrival:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+
+    def arrival_time(self, cursor):
+        """Monotonic arrival time of the message at cursor, None if it was overwritten or not received yet."""
+        with self.condition:
+            if cursor < self.oldest() or cursor >= self.next_index:
+                return None
+            return self.times[cursor % self.size]
+
+    def wait(self, cursor, types=None, timeout=None, condition=None):
+        """Return (msg, cursor past msg) for the first message from cursor whose type is in types
+        and that satisfies condition. Return (None, cursor past everything scanned) on timeout."""
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                if cursor < self.oldest():
+                    # the reader fell more than a whole buffer behind
+                    cursor = self.oldest()
+                while cursor < self.next_index:
+                    msg = self.messages[cursor % self.size]
+                    cursor += 1
+                    if types is not None and msg.get_type() not in types:
+                        continue
+                    if condition is not None and not condition(msg):
+                        continue
+                    return msg, cursor
+                if deadline is None:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None, cursor
+                self.condition.wait(remaining)
+
+
+class MessageBus:
+    """Publish/subscribe dispatch of received messages keyed by message id.
+
+    Callbacks only run for the message ids they subscribed to (None subscribes to everything),
+    after the optional source sysid/compid filter. A callback raising is reported on stderr and
+    counted in errors; the others still get the message. Subscribe and unsubscribe are O(1); the
+    tuple of callbacks used for dispatch is rebuilt lazily the first time an id is published after a change."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.dispatch_table = {}
+        self.tokens = itertools.count()
+        self.errors = 0
+
+    @staticmethod
+    def message_id(msg_type):
+        """Return the message id for a message name or id; None stays None (every message)."""
+        return lookup.message_id(msg_type)
+
+    def subscribe(self, msg_type, callback, sysid=None, compid=None):
+        """Call callback(msg) for each message of msg_type, optionally only from sysid/compid.
+        Return a token for unsubscribe."""
+        msgid = self.message_id(msg_type)
+        token = (msgid, next(self.tokens))
+        with self.lock:
+            self.subscribers.setdefault(msgid, {})[token[1]] = (callback, sysid, compid)
+            self.dispatch_table.pop(msgid, None)
+        return token
+
+    def unsubscribe(self, token):
+        """Remove a subscription; return False if it was not there."""
+        msgid, key = token
+        with self.lock:
+            subscribers = self.subscribers.get(msgid)
+            if subscribers is None or subscribers.pop(key, None) is None:
+                return False
+            self.dispatch_table.pop(msgid, None)
+        return True
+
+    def callbacks(self, msgid):
+        entries = self.dispatch_table.get(msgid)
+        if entries is None:
+            with self.lock:
+                entries = tuple(self.subscribers.get(msgid, {}).values())
+                self.dispatch_table[msgid] = entries
+        return entries
+
+    def publish(self, msg):
+        """Dispatch msg to the subscribers of its id and to the catch-all subscribers."""
+        for entries in (self.callbacks(msg.get_msgId()), self.callbacks(None)):
+            for (callback, sysid, compid) in entries:
+                if sysid is not None and msg.get_srcSystem() != sysid:
+                    continue
+                if compid is not None and msg.get_srcComponent() != compid:
+                    continue
+                try:
+                    callback(msg)
+                except Exception:
+                    # one broken subscriber must not stop the receive thread for everybody else
+                    self.errors += 1
+                    print("MessageBus: %s callback %r failed:" % (msg.get_type(), callback), file=sys.stderr)
+                    traceback.print_exc()
+
+
+def install_send_lock(link, lock):
+    """Make link.send hold lock, so several threads can share one MAVLink sequence number."""
+    send = link.send
+
+    def locked_send(mavmsg, force_mavlink1=False):
+        with lock:
+            send(mavmsg, force_mavlink1=force_mavlink1)
+
+    link.send = locked_send
+
+
+class HeartbeatScheduler:
+    """Send the GCS HEARTBEAT from its own thread on a monotonic timer.
+
+    The packet is encoded once for each of the 256 sequence numbers, so a beat is a table lookup
+    and a single write, whatever the telemetry load on the receive path. The link send_callback
+    still sees every heartbeat, as with MAVLink.send."""
+
+    def __init__(self, mav, lock, interval=1.0):
+        self.mav = mav
+        self.lock = lock
+        self.interval = interval
+        self.packets = None
+        self.encoded_for = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def encode(self, link):
+        """Pre-encode the HEARTBEAT for every sequence number of link, as (message, packet) pairs."""
+        seq = link.seq
+        packets = []
+        for i in range(256):
+            msg = link.heartbeat_encode(mavutil.mavlink.MAV_TYPE_GCS,
+                                        mavutil.mavlink.MAV_AUTOPILOT_INVALID,
+                                        0,
+                                        0,
+                                        0)
+            link.seq = i
+            packets.append((msg, msg.pack(link)))
+        link.seq = seq
+        self.packets = packets
+        self.encoded_for = link
+
+    def beat(self):
+        """Send one heartbeat now."""
+        with self.lock:
+            link = self.mav.mav
+            if link.signing.sign_outgoing:
+                # signed packets carry a timestamp, they can't be pre-encoded
+                link.heartbeat_send(mavutil.mavlink.MAV_TYPE_GCS,
+                                    mavutil.mavlink.MAV_AUTOPILOT_INVALID,
+                                    0,
+                                    0,
+                                    0)
+                return
+            if self.encoded_for is not link:
+                self.encode(link)
+            (msg, buf) = self.packets[link.seq]
+            link.file.write(buf)
+            link.seq = (link.seq + 1) % 256
+            link.total_packets_sent += 1
+            link.total_bytes_sent += len(buf)
+            if link.send_callback is not None:
+                link.send_callback(msg, *link.send_callback_args, **link.send_callback_kwargs)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="copter-heartbeat", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=2):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join(timeout)
+        self.thread = None
+
+    def run(self):
+        next_beat = time.monotonic()
+        while not self.stop_event.wait(max(0.0, next_beat - time.monotonic())):
+            self.beat()
+            next_beat += self.interval
+            now = time.monotonic()
+            if next_beat < now:
+                # we overslept (suspended process?); don't burst to catch up
+                next_beat = now + self.interval
+
+
+# COMMAND_CANCEL and MAV_RESULT_CANCELLED are only in the development dialect
+MAVLINK_MSG_ID_COMMAND_CANCEL = 80
+MAV_RESULT_CANCELLED = 6
+
+
+class MAVLink_command_cancel_message(mavutil.mavlink.MAVLink_message):
+    """Cancel a long running command (COMMAND_CANCEL from the MAVLink development dialect)."""
+
+    id = MAVLINK_MSG_ID_COMMAND_CANCEL
+    msgname = "COMMAND_CANCEL"
+    fieldnames = ["target_system", "target_component", "command"]
+    ordered_fieldnames = ["command", "target_system", "target_component"]
+    fieldtypes = ["uint8_t", "uint8_t", "uint16_t"]
+    fielddisplays_by_name = {}
+    fieldenums_by_name = {"command": "MAV_CMD"}
+    fieldunits_by_name = {}
+    native_format = bytearray(b"<HBB")
+    orders = [1, 2, 0]
+    lengths = [1, 1, 1]
+    array_lengths = [0, 0, 0]
+    crc_extra = 14
+    unpacker = struct.Struct("<HBB")
+    instance_field = None
+    instance_offset = -1
+
+    def __init__(self, target_system, target_component, command):
+        mavutil.mavlink.MAVLink_message.__init__(self, self.id, self.msgname)
+        self._fieldnames = self.fieldnames
+        self._instance_field = self.instance_field
+        self._instance_offset = self.instance_offset
+        self.target_system = target_system
+        self.target_component = target_component
+        self.command = command
+
+    def pack(self, mav, force_mavlink1=False):
+        return self._pack(mav, self.crc_extra, self.unpacker.pack(self.command, self.target_system,
+                                                                  self.target_component),
+                          force_mavlink1=force_mavlink1)
+
+
+class CommandHandle:
+    """One COMMAND_LONG in flight, resolved by the COMMAND_ACK for its (target, command).
+
+    Long running commands first answer MAV_RESULT_IN_PROGRESS ACKs: they update progress, are
+    queued for next_update() and push the timeout back, until the final ACK."""
+
+    def __init__(self, engine, command, params, target_system, target_component, timeout, retries):
+        self.engine = engine
+        self.command = command
+        self.params = params
+        self.target_system = target_system
+        self.target_component = target_component
+        self.timeout = timeout
+        self.retries = retries
+        self.confirmation = 0
+        self.started = time.monotonic()
+        self.deadline = self.started + timeout
+        self.sent_at = None
+        self.ack = None
+        self.error = None
+        self.in_progress = False
+        self.progress = None
+        self.updates = queue.SimpleQueue()
+        self.finished = threading.Event()
+
+    def update(self, ack):
+        """A MAV_RESULT_IN_PROGRESS ACK; progress is 0-100, 255 if the vehicle doesn't know."""
+        self.in_progress = True
+        self.progress = ack.progress
+        self.deadline = time.monotonic() + self.timeout
+        self.updates.put(ack)
+
+    def finish(self, ack=None, error=None):
+        self.ack = ack
+        self.error = error
+        self.finished.set()
+        self.updates.put(ack)
+
+    def next_update(self, timeout=None):
+        """Return the next ACK of this command, progress or final; None on timeout or failure."""
+        try:
+            return self.updates.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def cancel(self):
+        """Ask the vehicle to cancel the command; the final ACK (MAV_RESULT_CANCELLED) still finishes it."""
+        self.engine.cancel(self)
+
+    def done(self):
+        return self.finished.is_set()
+
+    @property
+    def result(self):
+        """MAV_RESULT of the final ACK, None until then."""
+        if self.ack is None:
+            return None
+        return self.ack.result
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def wait(self, timeout=None):
+        """Return the final COMMAND_ACK; raise the engine error (TimeoutException...) if there is none.
+        Without timeout, wait as long as the command timeout, which MAV_RESULT_IN_PROGRESS ACKs push back."""
+        tstart = time.monotonic()
+        while not self.finished.is_set():
+            now = time.monotonic()
+            if timeout is None:
+                # the engine fails the handle at its deadline; the second is a safety margin
+                remaining = self.deadline + 1.0 - now
+            else:
+                remaining = tstart + timeout - now
+            if remaining <= 0:
+                raise TimeoutException("Did not get COMMAND_ACK within %fs" % (now - tstart))
+            self.finished.wait(min(remaining, 0.1))
+        if self.error is not None:
+            raise self.error
+        return self.ack
+
+
+class CommandEngine:
+    """Table of the outstanding commands keyed by (target system, command id).
+
+    ACKs are matched from a COMMAND_ACK bus subscription, so commands to different ids overlap and
+    unrelated ACKs are never lost. A thread retransmits the commands still unanswered every
+    retransmit_interval, bumping the confirmation counter, and fails them at their timeout."""
+
+    def __init__(self, retransmit_interval=1.0):
+        self.retransmit_interval = retransmit_interval
+        self.condition = threading.Condition()
+        self.outstanding = {}
+        self.stale_acks = {}
+        self.mav = None
+        self.token = None
+        self.thread = None
+        self.running = False
+
+    def start(self, mav, bus, sysid):
+        self.mav = mav
+        self.token = bus.subscribe('COMMAND_ACK', self.on_ack, sysid=sysid)
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self.run, name="copter-commands", daemon=True)
+            self.thread.start()
+
+    def stop(self, bus, timeout=2):
+        if self.token is not None:
+            bus.unsubscribe(self.token)
+            self.token = None
+        if self.thread is not None:
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+            self.thread.join(timeout)
+            self.thread = None
+
+    def send(self, command, params, target_system, target_component=1, timeout=10, retries=3):
+        """Send a COMMAND_LONG and return its CommandHandle.
+        A command already in flight for the same (target, command) is superseded: the ACK can't tell them apart.
+        The final ACKs still owed to it (one per transmission) are dropped, so they don't resolve the new one."""
+        handle = CommandHandle(self, command, params, target_system, target_component, timeout, retries)
+        key = (target_system, command)
+        with self.condition:
+            old = self.outstanding.get(key)
+            if old is not None:
+                old.finish(error=ErrorException("Superseded by a new command %u" % command))
+                (owed, expiry) = self.stale_acks.get(key, (0, 0))
+                self.stale_acks[key] = (owed + old.confirmation, max(expiry, old.deadline))
+            self.outstanding[key] = handle
+            self.transmit(handle)
+            self.condition.notify_all()
+        return handle
+
+    def in_flight(self, command, target_system):
+        """True while a command is outstanding for (target_system, command)."""
+        with self.condition:
+            return (target_system, command) in self.outstanding
+
+    def transmit(self, handle):
+        self.mav.mav.command_long_send(handle.target_system,
+                                       handle.target_component,
+                                       handle.command,
+                                       handle.confirmation,
+                                       *handle.params)
+        handle.sent_at = time.monotonic()
+        handle.confirmation += 1
+
+    def on_ack(self, msg):
+        if getattr(msg, 'target_system', 0) not in (0, self.mav.mav.srcSystem):
+            # an ACK for another GCS
+            return
+        key = (msg.get_srcSystem(), msg.command)
+        with self.condition:
+            if key in self.stale_acks:
+                (owed, expiry) = self.stale_acks[key]
+                if time.monotonic() < expiry:
+                    # an answer to a superseded command, not to the one in flight
+                    if msg.result != mavutil.mavlink.MAV_RESULT_IN_PROGRESS:
+                        if owed > 1:
+                            self.stale_acks[key] = (owed - 1, expiry)
+                        else:
+                            del self.stale_acks[key]
+                    return
+                del self.stale_acks[key]
+            handle = self.outstanding.get(key)
+            if handle is None:
+                return
+            if msg.result == mavutil.mavlink.MAV_RESULT_IN_PROGRESS:
+                handle.update(msg)
+                return
+            del self.outstanding[key]
+        handle.finish(ack=msg)
+
+    def cancel(self, handle):
+        self.mav.mav.send(MAVLink_command_cancel_message(handle.target_system, handle.target_component,
+                                                         handle.command))
+
+    def run(self):
+        with self.condition:
+            while self.running:
+                now = time.monotonic()
+                for (key, handle) in list(self.outstanding.items()):
+                    if now >= handle.deadline:
+                        del self.outstanding[key]
+                        handle.finish(error=TimeoutException("Did not get good COMMAND_ACK within %fs" %
+                                                             handle.timeout))
+                    elif (not handle.in_progress and now - handle.sent_at >= self.retransmit_interval and
+                          handle.confirmation <= handle.retries):
+                        self.transmit(handle)
+                self.condition.wait(0.05)
+
+
+MODE_MAPPINGS = {}
+
+
+def mode_mapping(mav_type):
+    """Return the name to number mode map of mav_type, built once per vehicle type; None if unknown."""
+    if mav_type not in MODE_MAPPINGS:
+        MODE_MAPPINGS[mav_type] = mavutil.mode_mapping_byname(mav_type)
+    return MODE_MAPPINGS[mav_type]
+
+
+class ModeTracker:
+    """Flight mode and armed state of the vehicle, kept from every HEARTBEAT of its autopilot.
+
+    The receive thread keeps it current, so checking the mode is a lookup and waiting for a mode
+    wakes up on the heartbeat that reports it. count numbers the heartbeats, to wait for one
+    received after a given point."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heartbeat = None
+        self.custom_mode = None
+        self.base_mode = 0
+        self.mav_type = None
+        self.count = 0
+        self.last_change = None
+        self.token = None
+
+    def start(self, bus, sysid):
+        """Follow the HEARTBEAT messages of sysid published on bus."""
+        self.token = bus.subscribe('HEARTBEAT', self.update, sysid=sysid)
+
+    def stop(self, bus):
+        if self.token is not None:
+            bus.unsubscribe(self.token)
+            self.token = None
+
+    def update(self, msg):
+        if msg.autopilot == mavutil.mavlink.MAV_AUTOPILOT_INVALID:
+            # gimbals, cameras and the other components of the vehicle
+            return
+        with self.condition:
+            if msg.custom_mode != self.custom_mode:
+                self.last_change = time.monotonic()
+            self.heartbeat = msg
+            self.custom_mode = msg.custom_mode
+            self.base_mode = msg.base_mode
+            self.mav_type = msg.type
+            self.count += 1
+            self.condition.notify_all()
+
+    def mapping(self):
+        """Mode map of the vehicle type, None before the first heartbeat."""
+        if self.mav_type is None:
+            return None
+        return mode_mapping(self.mav_type)
+
+    def flightmode(self):
+        """Name of the current mode, None before the first heartbeat."""
+        mapping = self.mapping()
+        if mapping is None:
+            return None
+        for (name, number) in mapping.items():
+            if number == self.custom_mode:
+                return name
+        return "Mode(%u)" % self.custom_mode
+
+    def armed(self):
+        return self.base_mode & mavutil.mavlink.MAV_MODE_FLAG_SAFETY_ARMED != 0
+
+    def wait(self, predicate=None, timeout=None, after=0):
+        """Wait for a heartbeat numbered above after for which predicate() is true.
+        Return False on timeout."""
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.count <= after or (predicate is not None and not predicate()):
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                self.condition.wait(remaining)
+            return True
+
+
+class MissionTracker:
+    """Progress of the vehicle mission, kept from MISSION_CURRENT, MISSION_ITEM_REACHED and NAV_CONTROLLER_OUTPUT.
+
+    arrivals lists every (seq, timestamp) reached, in order, so the laps of a looping mission can be
+    timed; timestamps are the message receive times (the log times when replaying). An item that stops
+    being current without any MISSION_ITEM_REACHED received for it (lost on the link) counts as
+    reached when the next one becomes current. reported_seq is the item last counted, so a repeated
+    or late MISSION_ITEM_REACHED for it is not counted twice. count numbers the updates, to wait for
+    one after a given point."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.current = None
+        self.current_since = None
+        self.reported_seq = None
+        self.wp_dist = None
+        self.arrivals = []
+        self.waiters = {}
+        self.count = 0
+        self.tokens = []
+
+    def start(self, bus, sysid):
+        """Follow the mission messages of sysid published on bus."""
+        for msg_type in ('MISSION_CURRENT', 'MISSION_ITEM_REACHED', 'NAV_CONTROLLER_OUTPUT'):
+            self.tokens.append(bus.subscribe(msg_type, self.update, sysid=sysid))
+
+    def stop(self, bus):
+        for token in self.tokens:
+            bus.unsubscribe(token)
+        self.tokens = []
+
+    def update(self, msg):
+        mtype = msg.get_type()
+        timestamp = getattr(msg, '_timestamp', None)
+        if timestamp is None:
+            timestamp = time.time()
+        with self.condition:
+            if mtype == 'NAV_CONTROLLER_OUTPUT':
+                self.wp_dist = msg.wp_dist
+            elif mtype == 'MISSION_ITEM_REACHED':
+                if msg.seq != self.reported_seq:
+                    self.arrive(msg.seq, timestamp)
+            elif msg.seq != self.current:
+                # item 0 is home, the current item before the mission starts
+                if self.current not in (None, 0) and self.reported_seq != self.current:
+                    self.arrive(self.current, timestamp)
+                if msg.seq == self.reported_seq:
+                    # back to the item last reached (a loop): its next arrival is a new one
+                    self.reported_seq = None
+                self.current = msg.seq
+                self.current_since = timestamp
+                # until the next NAV_CONTROLLER_OUTPUT it is the distance to the previous item
+                self.wp_dist = None
+            self.count += 1
+            self.condition.notify_all()
+
+    def arrive(self, seq, timestamp):
+        self.arrivals.append((seq, timestamp))
+        self.reported_seq = seq
+        for future in self.waiters.pop(seq, []):
+            if not future.cancelled():
+                future.set_result(timestamp)
+
+    def reached(self, seq):
+        """Return a future resolved with the timestamp of the next arrival at item seq.
+        A future cancelled before that is forgotten at once."""
+        future = concurrent.futures.Future()
+        with self.condition:
+            self.waiters.setdefault(seq, []).append(future)
+        future.add_done_callback(lambda done: self.forget(seq, done))
+        return future
+
+    def forget(self, seq, future):
+        with self.condition:
+            waiters = self.waiters.get(seq)
+            if waiters is None or future not in waiters:
+                return
+            waiters.remove(future)
+            if not waiters:
+                del self.waiters[seq]
+
+    def arrivals_since(self, index):
+        """Items reached after the first index arrivals."""
+        with self.condition:
+            return [seq for (seq, timestamp) in self.arrivals[index:]]
+
+    def lap_times(self, seq):
+        """Durations between the successive arrivals at item seq."""
+        with self.condition:
+            times = [timestamp for (reached, timestamp) in self.arrivals if reached == seq]
+        return [t2 - t1 for (t1, t2) in zip(times, times[1:])]
+
+    def wait_update(self, after, timeout):
+        """Wait for an update numbered above after; return False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.count <= after:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+
+class SensorHealth:
+    """SYS_STATUS sensor bitmasks of the vehicle: the latest present/enabled/health snapshot, the bit
+    changes as events, and their timeline.
+
+    Each SYS_STATUS is XORed with the previous one, so only the bits that changed produce a
+    (timestamp, field, bit, value) event: it goes to history, to the subscribers and wakes up the
+    waiters. A query over any set of sensor bits is a mask test on the snapshot."""
+
+    FIELDS = ('present', 'enabled', 'health')
+
+    def __init__(self, history_len=10000):
+        self.condition = threading.Condition()
+        self.present = None
+        self.enabled = None
+        self.health = None
+        self.last_update = None
+        self.history = collections.deque(maxlen=history_len)
+        self.subscribers = {}
+        self.tokens = itertools.count()
+        self.token = None
+
+    def start(self, bus, sysid):
+        """Follow the SYS_STATUS messages of sysid published on bus."""
+        self.token = bus.subscribe('SYS_STATUS', self.update, sysid=sysid)
+
+    def stop(self, bus):
+        if self.token is not None:
+            bus.unsubscribe(self.token)
+            self.token = None
+
+    def update(self, msg):
+        timestamp = getattr(msg, '_timestamp', None)
+        if timestamp is None:
+            timestamp = time.time()
+        new = (msg.onboard_control_sensors_present,
+               msg.onboard_control_sensors_enabled,
+               msg.onboard_control_sensors_health)
+        changes = []
+        with self.condition:
+            first = self.present is None
+            for (field, before, after) in zip(self.FIELDS, (self.present, self.enabled, self.health), new):
+                changed = after if before is None else before ^ after
+                while changed:
+                    bit = changed & -changed
+                    changed ^= bit
+                    changes.append((timestamp, field, bit, after & bit != 0))
+            (self.present, self.enabled, self.health) = new
+            self.last_update = time.monotonic()
+            self.history.extend(changes)
+            if changes or first:
+                self.condition.notify_all()
+            subscribers = list(self.subscribers.values())
+        for (callback, sensors) in subscribers:
+            for change in changes:
+                if change[2] & sensors:
+                    callback(*change)
+
+    def subscribe(self, callback, sensors=0xFFFFFFFF):
+        """Call callback(timestamp, field, bit, value) for each change of the sensors bits; return a token."""
+        key = next(self.tokens)
+        with self.condition:
+            self.subscribers[key] = (callback, sensors)
+        return key
+
+    def unsubscribe(self, token):
+        with self.condition:
+            return self.subscribers.pop(token, None) is not None
+
+    def state_error(self, sensors, present=True, enabled=True, healthy=True):
+        """What keeps all of the sensors bits from the wanted state, None if they are in it
+        (or if no SYS_STATUS was received yet, see has_snapshot)."""
+        if self.present is None:
+            return None
+        for (reported, want, name) in ((self.present, present, "present"),
+                                       (self.enabled, enabled, "enabled"),
+                                       (self.health, healthy, "healthy")):
+            if want and reported & sensors != sensors:
+                return "not %s" % name
+            if not want and reported & sensors:
+                return "%s when it shouldn't be" % name
+        return None
+
+    def has_snapshot(self):
+        return self.present is not None
+
+    def has_state(self, sensors, present=True, enabled=True, healthy=True):
+        return self.present is not None and self.state_error(sensors, present, enabled, healthy) is None
+
+    def wait(self, predicate, timeout):
+        """Wait until predicate() is true, checking it on each change; return False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while not predicate():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def timeline(self, sensors=0xFFFFFFFF):
+        """The recorded changes of the sensors bits as (timestamp, field, sensor name, value)."""
+        with self.condition:
+            return [(timestamp, field, lookup.enum_name("MAV_SYS_STATUS_SENSOR", bit, "0x%x" % bit), value)
+                    for (timestamp, field, bit, value) in self.history if bit & sensors]
+
+
+class Predicate:
+    """A condition over the vehicle state, evaluated on each message of msg_types as it arrives.
+
+    value(msg) returns the watched value (None to skip the message) and valid(value, msg) tells if
+    the condition holds. Once it has held for minimum_duration the future resolves with the mean of
+    the values seen while holding; after timeout it fails with exception. Evaluating a message is a
+    couple of calls and float updates, nothing is allocated per sample. called_function(value, target)
+    is called for each sample, on the receive thread: it must not block (Copter.recv_match refuses to
+    run there), and what it raises fails the wait with that exception."""
+
+    def __init__(self, name, want, msg_types, value, valid, minimum_duration=0, timeout=30,
+                 exception=TimeoutException, target=None, called_function=None):
+        if not isinstance(msg_types, (list, set, tuple)):
+            msg_types = [msg_types]
+        self.name = name
+        self.want = want
+        self.msg_types = msg_types
+        self.value = value
+        self.valid = valid
+        self.minimum_duration = minimum_duration
+        self.timeout = timeout
+        self.exception = exception
+        self.target = target
+        self.called_function = called_function
+        self.future = concurrent.futures.Future()
+        self.lock = threading.Lock()
+        self.timer = None
+        self.last_value = None
+        self.held_since = None
+        self.held_sum = 0.0
+        self.held_count = 0
+
+    def feed(self, msg):
+        """Bus callback, on the receive thread."""
+        value = self.value(msg)
+        if value is None:
+            return
+        self.last_value = value
+        if self.called_function is not None:
+            try:
+                self.called_function(value, self.target)
+            except Exception as e:
+                self.finish(error=e)
+                return
+        if not self.valid(value, msg):
+            self.held_since = None
+            self.held_sum = 0.0
+            self.held_count = 0
+            return
+        now = time.monotonic()
+        if self.held_since is None:
+            self.held_since = now
+        self.held_sum += value
+        self.held_count += 1
+        if now - self.held_since >= self.minimum_duration:
+            self.finish(result=self.held_sum / self.held_count)
+
+    def expire(self):
+        self.finish(error=self.exception("Failed to attain %s %s, reached %s" % (self.name, self.want, self.last_value)))
+
+    def attained(self):
+        """True once the future resolved with a value."""
+        return self.future.done() and not self.future.cancelled() and self.future.exception() is None
+
+    def error(self):
+        """Why the wait failed, None while it runs or once attained."""
+        if not self.future.done():
+            return None
+        if self.future.cancelled():
+            return ErrorException("Wait for %s %s cancelled" % (self.name, self.want))
+        return self.future.exception()
+
+    def finish(self, result=None, error=None):
+        with self.lock:
+            if self.future.done():
+                return
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result(result)
+
+
+class PredicateEngine:
+    """Registry of the Predicates waiting on the vehicle messages.
+
+    Each predicate is subscribed on the bus for its message types, so it only runs for the messages
+    it watches, and is unsubscribed as soon as its future is done: attained, timed out or cancelled."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bus = None
+        self.sysid = None
+        self.active = {}
+
+    def start(self, bus, sysid):
+        self.bus = bus
+        self.sysid = sysid
+
+    def add(self, predicate, timeout=None, expires=True):
+        """Start evaluating predicate; return its future.
+        timeout replaces predicate.timeout for this wait; with expires False it never times out."""
+        if timeout is None:
+            timeout = predicate.timeout
+        if not expires:
+            timeout = None
+        tokens = [self.bus.subscribe(msg_type, predicate.feed, sysid=self.sysid) for msg_type in predicate.msg_types]
+        with self.lock:
+            self.active[predicate] = tokens
+        if timeout is not None:
+            predicate.timer = threading.Timer(timeout, predicate.expire)
+            predicate.timer.daemon = True
+            predicate.timer.start()
+        predicate.future.add_done_callback(lambda future: self.remove(predicate))
+        return predicate.future
+
+    def remove(self, predicate):
+        with self.lock:
+            tokens = self.active.pop(predicate, [])
+        for token in tokens:
+            self.bus.unsubscribe(token)
+        if predicate.timer is not None:
+            predicate.timer.cancel()
+
+    def cancel_all(self):
+        with self.lock:
+            predicates = list(self.active)
+        for predicate in predicates:
+            predicate.future.cancel()
+
+
+class MessageRatePlan:
+    """Telemetry we want from the vehicle: message name (or id) -> rate in Hz, 0 to disable it.
+
+    Applying a plan stops every other stream. bytes_per_second() estimates the downlink the plan
+    needs from the longest frame of each message plus the 1Hz vehicle heartbeat, so a plan can be
+    checked against a serial link before it is sent."""
+
+    def __init__(self, rates, signed=False):
+        self.rates = {lookup.message_id(msg_type): float(rate) for (msg_type, rate) in rates.items()}
+        self.signed = signed
+
+    def interval_us(self, msgid):
+        """SET_MESSAGE_INTERVAL value of msgid; -1 disables it."""
+        rate = self.rates[msgid]
+        if rate <= 0:
+            return -1
+        return int(round(1.0e6 / rate))
+
+    def matches(self, msgid, interval_us):
+        """True if the interval reported in MESSAGE_INTERVAL is the one we asked for.
+        ArduPilot keeps intervals in milliseconds, so 1ms of rounding is accepted."""
+        want = self.interval_us(msgid)
+        if want == -1:
+            # -1 is disabled, 0 not available
+            return interval_us <= 0
+        return abs(interval_us - want) <= 1000
+
+    def bytes_per_second(self):
+        total = lookup.frame_length(mavutil.mavlink.MAVLINK_MSG_ID_HEARTBEAT, self.signed)
+        for (msgid, rate) in self.rates.items():
+            if rate > 0:
+                total += rate * lookup.frame_length(msgid, self.signed)
+        return total
+
+    def check_budget(self, baudrate, max_usage=0.8):
+        """Raise LinkBudgetException if the plan needs more than max_usage of a serial link at baudrate
+        (8N1, so 10 bits per byte). Return the bytes per second needed."""
+        needed = self.bytes_per_second()
+        budget = baudrate / 10.0 * max_usage
+        if needed > budget:
+            heaviest = sorted(self.rates, key=lambda msgid: -self.rates[msgid] * lookup.frame_length(msgid, self.signed))
+            raise LinkBudgetException("Rate plan needs %.0f bytes/s, %u baud allows %.0f at %.0f%% usage (heaviest: %s)" % (
+                needed, baudrate, budget, max_usage * 100,
+                ", ".join(lookup.message_name(msgid) for msgid in heaviest[:3])))
+        return needed
+
+
+class ParameterStore:
+    """In-memory copy of the vehicle parameter table.
+
+    Filled in bulk with PARAM_REQUEST_LIST; the indices lost on the way are re-requested one by one
+    with PARAM_REQUEST_READ. Every PARAM_VALUE the vehicle sends afterwards (answers to anybody's
+    set or read, or unsolicited changes) keeps the table current, so reads are dictionary lookups."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.values = {}
+        self.names = {}
+        self.count = None
+        self.last_update = 0
+        self.token = None
+
+    def start(self, bus, sysid):
+        """Follow the PARAM_VALUE messages of sysid published on bus."""
+        self.token = bus.subscribe('PARAM_VALUE', self.update, sysid=sysid)
+
+    def stop(self, bus):
+        if self.token is not None:
+            bus.unsubscribe(self.token)
+            self.token = None
+
+    def update(self, msg):
+        with self.condition:
+            self.values[msg.param_id] = msg.param_value
+            if msg.param_count != 0xFFFF:
+                self.count = msg.param_count
+            if self.count is not None and msg.param_index < self.count:
+                if msg.param_index not in self.names:
+                    self.last_update = time.monotonic()
+                self.names[msg.param_index] = msg.param_id
+            self.condition.notify_all()
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def __contains__(self, name):
+        return name in self.values
+
+    def missing(self):
+        """Indices of the table we have not received yet."""
+        with self.condition:
+            if self.count is None:
+                return []
+            return [i for i in range(self.count) if i not in self.names]
+
+    def complete(self):
+        return self.count is not None and len(self.names) >= self.count
+
+    def snapshot(self):
+        """The table as a JSON-able dict."""
+        with self.condition:
+            return {
+                "count": self.count,
+                "names": [self.names.get(i) for i in range(self.count or 0)],
+                "values": dict(self.values),
+            }
+
+    def restore(self, snapshot, overwrite=False):
+        """Fill the table from a snapshot(); values received since are kept unless overwrite."""
+        with self.condition:
+            self.count = snapshot["count"]
+            for (index, name) in enumerate(snapshot["names"]):
+                if name is not None:
+                    self.names[index] = name
+            for (name, value) in snapshot["values"].items():
+                if overwrite:
+                    self.values[name] = value
+                else:
+                    self.values.setdefault(name, value)
+            self.condition.notify_all()
+
+    def wait_quiet(self, quiet_time, deadline, indices=None):
+        """Wait until we have the indices (the whole table if None), no new index arrived for
+        quiet_time seconds, or deadline (monotonic). Only new indices count as progress, so the
+        PARAM_VALUEs of the parameters we already have don't hold back the gap requests."""
+        with self.condition:
+            while True:
+                if indices is None:
+                    if self.complete():
+                        return
+                elif all(i in self.names for i in indices):
+                    return
+                now = time.monotonic()
+                quiet_until = self.last_update + quiet_time
+                if now >= quiet_until or now >= deadline:
+                    return
+                self.condition.wait(min(quiet_until, deadline) - now)
+
+    def fetch_all(self, mav, target_system, target_component=1, timeout=60, quiet_time=0.5, batch=10):
+        """Download the whole table: one PARAM_REQUEST_LIST, then PARAM_REQUEST_READ by index for the gaps,
+        batch at a time so ArduPilot's short parameter queue doesn't overflow.
+        Return True once every index was received."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.last_update = time.monotonic()
+        mav.mav.param_request_list_send(target_system, target_component)
+        self.wait_quiet(quiet_time, deadline)
+        while not self.complete():
+            if time.monotonic() >= deadline:
+                return False
+            if self.count is None:
+                # not even one answer, ask again
+                mav.mav.param_request_list_send(target_system, target_component)
+                requested = None
+            else:
+                requested = self.missing()[:batch]
+                for index in requested:
+                    mav.mav.param_request_read_send(target_system, target_component, b'', index)
+            with self.condition:
+                self.last_update = time.monotonic()
+            self.wait_quiet(quiet_time, deadline, requested)
+        return True
+
+
+class ParameterApplyReport:
+    """What Copter.apply_parameter_file found and did.
+
+    changed maps each name that was sent to its (old, new) values; unchanged lists the names already
+    at the file value and unknown the names the vehicle doesn't have."""
+
+    def __init__(self, path):
+        self.path = path
+        self.changed = {}
+        self.unchanged = []
+        self.unknown = []
+
+    def __str__(self):
+        lines = ["%s: %u changed, %u unchanged, %u unknown" %
+                 (self.path, len(self.changed), len(self.unchanged), len(self.unknown))]
+        for (name, (old, new)) in sorted(self.changed.items()):
+            lines.append("  %s %f -> %f" % (name, old, new))
+        for name in self.unknown:
+            lines.append("  %s unknown" % name)
+        return "\n".join(lines)
+
+
 class Copter:
     """ArduPilot Copter class.
 
@@ -161,14 +1309,34 @@ class Copter:
         self.target_system = sysid
         self.target_component = 1
         self.heartbeat_interval_ms = 1000
-        self.last_heartbeat_time_ms = None
-        self.last_heartbeat_time_wc_s = 0
+        self.heartbeat = None
+        self.link_lock = threading.RLock()
         self.in_drain_mav = False
         self.total_waiting_to_arm_time = 0
         self.waiting_to_arm_count = 0
         self.wploader = mavwp.MAVWPLoader()
         self.wp_requested = {}
         self.wp_expected_count = 0
+        self.cache = MessageCache()
+        self.rx_buffer = ReceiveBuffer(condition=self.cache.condition)
+        self.rx_readers = threading.local()
+        self.rx_consumed = 0
+        self.rx_read_time = 0.0
+        self.rx_waiting = 0
+        self.rx_thread = None
+        self.rx_running = False
+        self.bus = MessageBus()
+        self.hook_tokens = {}
+        self.recorder = None
+        self.parameters = ParameterStore()
+        self.modes = ModeTracker()
+        self.predicates = PredicateEngine()
+        self.mission = MissionTracker()
+        self.sensors = SensorHealth()
+        self.commands = CommandEngine()
+        self.parameter_snapshot_file = None
+        self.rate_plan = None
+        self.link_baudrate = None
 
     @staticmethod
     def progress(text):
@@ -242,14 +1410,18 @@ class Copter:
             mavutil.location(loc1_lat * 1e-7, loc1_lon * 1e-7),
             mavutil.location(loc2_lat * 1e-7, loc2_lon * 1e-7))
 
-    def connect(self, connection_string='udpin:0.0.0.0:14550'):
+    def connect(self, connection_string='udpin:0.0.0.0:14550', rate_plan=None, baud=None):
         """Set the connection with the drone.
          Use ArduPilot dialect and enforce MAVLink2 usage.
-         Set some default streamrate.
+         Set some default streamrate, or only the messages of rate_plan (see apply_rate_plan).
+         baud is the serial link speed (115200 if not given), also used as the rate plan budget.
          Add some default utility default hook that serve when receiving messages."""
         os.environ['MAVLINK20'] = '1'
+        if rate_plan is not None:
+            self.rate_plan = rate_plan
         self.mav = mavutil.mavlink_connection(
             connection_string,
+            baud=baud or 115200,
             retries=1000,
             robust_parsing=True,
             source_system=250,
@@ -257,10 +1429,166 @@ class Copter:
             autoreconnect=True,
             dialect="ardupilotmega",
         )
-        self.set_streamrate(self.streamrate)
-
-        self.mav.message_hooks.append(self.message_hook)
+        self.link_baudrate = baud
+        if baud is None and isinstance(self.mav, mavutil.mavserial):
+            self.link_baudrate = self.mav.baud
+        self.install_send_lock()
+        self.start_heartbeats()
+        self.setup_link()
+
+    def connect_via_router(self, router):
+        """Use our sysid share of a LinkRouter endpoint instead of opening our own connection.
+        The router sends the GCS heartbeats for every vehicle."""
+        self.mav = router.vehicle_link(self.target_system)
+        self.link_lock = router.link_lock
+        self.setup_link()
+
+    def connect_replay(self, path, speed=1.0):
+        """Feed the recorded tlog path to this Copter as if it were the live link.
+        speed multiplies the recorded rate; None replays as fast as the waits read the messages.
+        Everything we send is discarded."""
+        self.mav = ReplayLink(path, speed=speed, sysid=self.target_system, reader=self)
+        self.install_send_lock()
+        self.setup_link(set_streamrate=False)
+
+    def setup_link(self, set_streamrate=True):
+        """Install the default hooks, start the receive thread and set the default streamrate or rate plan."""
         self.mav.idle_hooks.append(self.idle_hook)
+        self.bus.subscribe('STATUSTEXT', self.message_hook, sysid=self.target_system)
+        self.parameters.start(self.bus, self.target_system)
+        self.modes.start(self.bus, self.target_system)
+        self.predicates.start(self.bus, self.target_system)
+        self.mission.start(self.bus, self.target_system)
+        self.sensors.start(self.bus, self.target_system)
+        self.commands.start(self.mav, self.bus, self.target_system)
+        self.start_receive_thread()
+        if not set_streamrate:
+            return
+        if self.rate_plan is not None:
+            self.apply_rate_plan(self.rate_plan)
+        else:
+            self.set_streamrate(self.streamrate)
+
+    def install_send_lock(self):
+        """Serialise outgoing packets between our threads; they share the link sequence number."""
+        install_send_lock(self.mav.mav, self.link_lock)
+
+    def start_heartbeats(self):
+        """Start sending GCS heartbeats every heartbeat_interval_ms; None disables them."""
+        if self.heartbeat_interval_ms is None:
+            return
+        if self.heartbeat is None:
+            self.heartbeat = HeartbeatScheduler(self.mav, self.link_lock, self.heartbeat_interval_ms * 0.001)
+        self.heartbeat.start()
+
+    def stop_heartbeats(self):
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+
+    def close(self):
+        """Save the parameter snapshot, stop our threads and close the link."""
+        self.save_parameter_snapshot()
+        self.stop_recording()
+        self.commands.stop(self.bus)
+        self.stop_receive_thread()
+        self.stop_heartbeats()
+        self.mav.close()
+
+    def start_receive_thread(self):
+        """Start the thread that parses the link and fills the message cache.
+        Once running, every wait is served from the cache instead of reading the link."""
+        if self.rx_thread is not None:
+            return
+        self.rx_running = True
+        self.rx_thread = threading.Thread(target=self.receive_loop, name="copter-rx", daemon=True)
+        self.rx_thread.start()
+
+    def stop_receive_thread(self, timeout=2):
+        if self.rx_thread is None:
+            return
+        self.rx_running = False
+        self.rx_thread.join(timeout)
+        self.rx_thread = None
+
+    def receive_loop(self):
+        """Parse the link once for everybody, cache our target system messages and dispatch them on the bus."""
+        while self.rx_running:
+            m = self.mav.recv_match(blocking=True, timeout=0.1)
+            if m is None or m.get_type() == 'BAD_DATA':
+                continue
+            if m.get_srcSystem() == self.target_system:
+                self.cache.update(m)
+            # the trackers see the message before any buffer reader is woken up by it
+            self.bus.publish(m)
+            if m.get_srcSystem() == self.target_system:
+                self.rx_buffer.append(m)
+
+    def start_recording(self, path, flush_interval=0.5):
+        """Record every received message to the tlog path, with a .idx sidecar for fast lookups."""
+        self.stop_recording()
+        self.recorder = TelemetryRecorder(path, flush_interval=flush_interval)
+        self.recorder.start(self.bus)
+
+    def stop_recording(self):
+        if self.recorder is None:
+            return
+        self.recorder.stop(self.bus)
+        self.recorder = None
+
+    def recv_match(self, type=None, blocking=False, timeout=None, condition=None, since=None, since_time=None):
+        """Return the next message of type (a string or a list of strings) not seen yet.
+        Served from the receive buffer when the receive thread runs, from the link otherwise.
+        condition is an optional callable filtering the candidate messages.
+        since (a receive buffer cursor) or since_time (a time.monotonic() value) restart the
+        search from that point instead of after the last message of the same type(s) this thread
+        was returned. A type the thread asks for the first time (or since drain_mav) only matches
+        messages received from now on. For the current value of a message, pass
+        since=self.rx_buffer.cursor() or read self.cache."""
+        if self.rx_thread is None:
+            tstart = time.time()
+            while True:
+                remaining = None
+                if timeout is not None:
+                    remaining = timeout - (time.time() - tstart)
+                    if remaining <= 0:
+                        return None
+                m = self.mav.recv_match(type=type, blocking=blocking, timeout=remaining)
+                if m is None or condition is None or condition(m):
+                    return m
+        if threading.current_thread() is self.rx_thread:
+            # a bus callback (hook, predicate called_function) waiting for the thread that runs it
+            raise ErrorException("recv_match called from the receive thread")
+        if type is not None and not isinstance(type, (list, set)):
+            type = [type]
+        if not blocking:
+            timeout = 0
+        if since_time is not None:
+            since = self.rx_buffer.cursor_at(since_time)
+        reader = self.rx_reader()
+        key = None if type is None else frozenset(type)
+        if since is None:
+            since = reader.cursors.get(key)
+        if since is None:
+            since = self.rx_buffer.cursor()
+        with self.rx_buffer.condition:
+            self.rx_waiting += 1
+        try:
+            m, cursor = self.rx_buffer.wait(since, type, timeout=timeout, condition=condition)
+        finally:
+            with self.rx_buffer.condition:
+                self.rx_waiting -= 1
+                self.rx_consumed = max(self.rx_consumed, cursor)
+                self.rx_read_time = time.monotonic()
+        reader.cursors[key] = cursor
+        return m
+
+    def rx_reader(self):
+        """Receive buffer cursors of the calling thread, one per type list asked for, so readers in
+        other threads or after other types don't skip messages."""
+        reader = self.rx_readers
+        if not hasattr(reader, 'cursors'):
+            reader.cursors = {}
+        return reader
 
     def set_streamrate(self, streamrate, timeout=20):
         """set MAV_DATA_STREAM_ALL; timeout is wallclock time"""
@@ -268,15 +1596,17 @@ class Copter:
         while True:
             if time.time() - tstart > timeout:
                 raise TimeoutException("Failed to set streamrate")
+            since = self.rx_buffer.cursor()
             self.mav.mav.request_data_stream_send(
                 self.target_system,
                 self.target_component,
                 mavutil.mavlink.MAV_DATA_STREAM_ALL,
                 streamrate,
                 1)
-            m = self.mav.recv_match(type='SYSTEM_TIME',
-                                    blocking=True,
-                                    timeout=1)
+            m = self.recv_match(type='SYSTEM_TIME',
+                                blocking=True,
+                                timeout=1,
+                                since=since)
             if m is not None:
                 break
 
@@ -286,7 +1616,7 @@ class Copter:
     def set_message_rate_hz(self, id, rate_hz):
         """set a message rate in Hz; 0 for original, -1 to disable"""
         if type(id) == str:
-            id = eval("mavutil.mavlink.MAVLINK_MSG_ID_%s" % id)
+            id = lookup.message_id(id)
         if rate_hz == 0 or rate_hz == -1:
             set_interval = rate_hz
         else:
@@ -300,7 +1630,75 @@ class Copter:
                      0,
                      0)
 
+    def apply_rate_plan(self, plan, baudrate=None, max_usage=0.8, timeout=5, round_timeout=0.5):
+        """Stream only the messages of plan (a MessageRatePlan or a dict message name -> Hz).
+
+        With a baudrate (by default the serial link one, or the one given to connect) the plan is first
+        checked against that link budget. Every stream is stopped, then each message gets a
+        SET_MESSAGE_INTERVAL and a GET_MESSAGE_INTERVAL through the command engine; the messages whose
+        MESSAGE_INTERVAL reply doesn't confirm the rate are sent again the next round, and the streams
+        are stopped again until the first confirmation. Return the confirmed {msgid: interval_us}."""
+        if not isinstance(plan, MessageRatePlan):
+            plan = MessageRatePlan(plan)
+        if baudrate is None:
+            baudrate = self.link_baudrate
+        if baudrate is not None:
+            needed = plan.check_budget(baudrate, max_usage)
+            self.progress("Rate plan needs %.0f bytes/s of %.0f" % (needed, baudrate / 10.0))
+        replies = queue.SimpleQueue()
+        token = self.bus.subscribe('MESSAGE_INTERVAL', replies.put, sysid=self.target_system)
+        pending = set(plan.rates)
+        confirmed = {}
+        reported = {}
+        tstart = time.time()
+        try:
+            while pending:
+                if time.time() - tstart > timeout:
+                    raise NotAchievedException("Rate plan not confirmed for %s" % ", ".join(
+                        "%s (want %dus got %s)" % (lookup.message_name(msgid, msgid), plan.interval_us(msgid),
+                                                   "%dus" % reported[msgid] if msgid in reported else "nothing")
+                        for msgid in sorted(pending)))
+                if not confirmed:
+                    # stopping the streams again would undo the rates already confirmed
+                    self.mav.mav.request_data_stream_send(self.target_system,
+                                                          self.target_component,
+                                                          mavutil.mavlink.MAV_DATA_STREAM_ALL,
+                                                          0,
+                                                          0)
+                # one message at a time: the ACKs of a same command can't be told apart
+                for msgid in sorted(pending):
+                    handles = [self.start_cmd(mavutil.mavlink.MAV_CMD_SET_MESSAGE_INTERVAL,
+                                              msgid, plan.interval_us(msgid), 0, 0, 0, 0, 0,
+                                              timeout=round_timeout, retries=0, quiet=True),
+                               self.start_cmd(mavutil.mavlink.MAV_CMD_GET_MESSAGE_INTERVAL,
+                                              msgid, 0, 0, 0, 0, 0, 0,
+                                              timeout=round_timeout, retries=0, quiet=True)]
+                    for handle in handles:
+                        try:
+                            handle.wait()
+                        except TimeoutException:
+                            # lost on the way, the next round asks again
+                            pass
+                round_end = time.time() + round_timeout
+                while pending:
+                    remaining = round_end - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        m = replies.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    reported[m.message_id] = m.interval_us
+                    if m.message_id in pending and plan.matches(m.message_id, m.interval_us):
+                        pending.discard(m.message_id)
+                        confirmed[m.message_id] = m.interval_us
+        finally:
+            self.bus.unsubscribe(token)
+        self.progress("Rate plan of %u messages applied in %.3fs" % (len(confirmed), time.time() - tstart))
+        return confirmed
+
     def send_get_message_interval(self, victim_message_id):
+        since = self.rx_buffer.cursor()
         self.mav.mav.command_long_send(
             1,
             1,
@@ -313,7 +1711,7 @@ class Copter:
             0,
             0,
             0)
-        m = self.mav.recv_match(type='MESSAGE_INTERVAL', blocking=True)
+        m = self.recv_match(type='MESSAGE_INTERVAL', blocking=True, since=since)
         return self.rate_to_interval_us(m.interval_us)
 
     def send_set_parameter_direct(self, name, value):
@@ -336,88 +1734,102 @@ class Copter:
     def set_parameter(self, name, value, **kwargs):
         self.set_parameters({name: value}, **kwargs)
 
-    def set_parameters(self, parameters, add_to_context=True, epsilon_pct=0.00001, retries=None, verbose=True):
-        """Set parameters from vehicle."""
+    @staticmethod
+    def parameter_matches(value, autopilot_value, epsilon_pct=0.00001):
+        """True if the autopilot value is value, within epsilon_pct percent."""
+        return abs(autopilot_value - value) <= epsilon_pct * 0.01 * abs(value)
+
+    def set_parameters(self, parameters, add_to_context=True, epsilon_pct=0.00001, retries=None, verbose=True,
+                       window=10, param_timeout=1.0):
+        """Set parameters on the vehicle.
+
+        Up to window PARAM_SETs are in flight at once; each is confirmed by the PARAM_VALUE echo of its
+        name and only the ones not confirmed within param_timeout are sent again, at most retries times.
+        ArduPilot's param queue is short and drops what doesn't fit, so every timeout halves the
+        window and it grows back by one each time a whole window is confirmed."""
         want = copy.copy(parameters)
         self.progress("set_parameters: (%s)" % str(want))
-        self.drain_mav()
         if len(want) == 0:
             return
-
         if retries is None:
-            # we can easily fill ArduPilot's param-set/param-get queue
-            # which is quite short.  So we retry *a lot*.
-            retries = (len(want) + 1) * 5
-
-        param_value_messages = []
+            retries = 5
 
-        def add_param_value(mav, m):
-            t = m.get_type()
-            if t != "PARAM_VALUE":
-                return
-            param_value_messages.append(m)
-
-        self.install_message_hook(add_param_value)
+        echoes = queue.SimpleQueue()
+        token = self.bus.subscribe('PARAM_VALUE', echoes.put, sysid=self.target_system)
 
-        original_values = {}
-        autopilot_values = {}
+        pending = collections.deque(want.keys())
+        in_flight = {}
+        attempts = collections.Counter()
+        current_window = window
+        confirmed_in_window = 0
         tstart = time.time()
-        for i in range(retries):
-            self.drain_mav(quiet=True)
-            received = set()
-            for (name, value) in want.items():
-                self.progress("%s want=%f autopilot=%s" % (name, value, autopilot_values.get(name, 'None')))
-                if name not in autopilot_values:
-                    self.send_get_parameter_direct(name)
-                    self.progress("Requesting (%s) (retry=%u)" % (name, i))
-                    continue
-                delta = abs(autopilot_values[name] - value)
-                if delta <= epsilon_pct * 0.01 * abs(value):
-                    # correct value
-                    self.progress("%s is now %f" % (name, autopilot_values[name]))
-                    # if add_to_context:
-                    #     context_param_name_list = [p[0] for p in self.context_get().parameters]
-                    #     if name.upper() not in context_param_name_list:
-                    #         self.context_get().parameters.append((name, original_values[name]))
-                    received.add(name)
-                    continue
-                self.progress("Sending set (%s) to (%f) (old=%f)" % (name, value, original_values[name]))
-                self.send_set_parameter_direct(name, value)
-            for name in received:
-                del want[name]
-            if len(want):
-                self.wait_heartbeat()
-            #     # problem here is that a reboot can happen after we
-            #     # send the request but before we receive the reply:
-            #     try:
-            #         self.do_timesync_roundtrip(quiet=True)
-            #     except AutoTestTimeoutException:
-            #         pass
-            #         # now = self.get_sim_time_cached()
-            #         # if tstart > now:
-            #         #     self.progress("Time wrap detected")
-            #         # else:
-            #         #     raise
-            do_fetch_all = False
-            for m in param_value_messages:
-                if m.param_id in want:
-                    self.progress("Received wanted PARAM_VALUE %s=%f" %
-                                  (str(m.param_id), m.param_value))
-                    autopilot_values[m.param_id] = m.param_value
-                    if m.param_id not in original_values:
-                        original_values[m.param_id] = m.param_value;
-                        if (self.should_fetch_all_for_parameter_change(m.param_id.upper()) and
-                                m.param_value != 0):
-                            do_fetch_all = True
-            param_value_messages = []
-        #            if do_fetch_all:
-        #                self.do_fetch_all()
-
-        self.remove_message_hook(add_param_value)
-
-        if len(want) == 0:
-            return
-        raise ValueError("Failed to set parameters (%s)" % want)
+        try:
+            while pending or in_flight:
+                now = time.monotonic()
+                while pending and len(in_flight) < current_window:
+                    name = pending.popleft()
+                    if attempts[name] > retries:
+                        raise ValueError("Failed to set parameters (%s)" % want)
+                    attempts[name] += 1
+                    if verbose:
+                        self.progress("Sending set (%s) to (%f) (try=%u)" % (name, want[name], attempts[name]))
+                    self.send_set_parameter_direct(name, want[name])
+                    in_flight[name] = now + param_timeout
+                try:
+                    m = echoes.get(timeout=max(0.0, min(in_flight.values()) - time.monotonic()))
+                except queue.Empty:
+                    m = None
+                if m is not None:
+                    if m.param_id in want and self.parameter_matches(want[m.param_id], m.param_value, epsilon_pct):
+                        # may be the late echo of a set we already queued again
+                        if verbose:
+                            self.progress("%s is now %f" % (m.param_id, m.param_value))
+                        if in_flight.pop(m.param_id, None) is None and m.param_id in pending:
+                            pending.remove(m.param_id)
+                        del want[m.param_id]
+                        confirmed_in_window += 1
+                        if confirmed_in_window >= current_window:
+                            confirmed_in_window = 0
+                            current_window = min(window, current_window + 1)
+                # on every pass: a steady flow of other PARAM_VALUEs must not delay the retransmits
+                now = time.monotonic()
+                expired = [name for (name, deadline) in in_flight.items() if deadline <= now]
+                for name in expired:
+                    del in_flight[name]
+                    pending.appendleft(name)
+                if expired:
+                    current_window = max(1, current_window // 2)
+                    confirmed_in_window = 0
+                    self.progress("%u PARAM_SET unanswered, window now %u" % (len(expired), current_window))
+        finally:
+            self.bus.unsubscribe(token)
+        # self.parameters follows the echoes; the snapshot file is written on close()
+        self.progress("Set %u parameters in %fs" % (len(parameters), time.time() - tstart))
+
+    def apply_parameter_file(self, path, epsilon_pct=0.00001, dry_run=False, **kwargs):
+        """Apply a .parm file, only sending the values that differ from the cached parameter table.
+        Extra arguments go to set_parameters. Return a ParameterApplyReport."""
+        parm = mavparm.MAVParmDict()
+        if not parm.load(path):
+            raise ErrorException("Failed to load parameter file %s" % path)
+        if not self.parameters.complete():
+            self.fetch_parameters()
+        report = ParameterApplyReport(path)
+        want = {}
+        for name in sorted(parm.keys()):
+            value = parm[name]
+            current = self.parameters.get(name)
+            if current is None:
+                report.unknown.append(name)
+            elif self.parameter_matches(value, current, epsilon_pct):
+                report.unchanged.append(name)
+            else:
+                report.changed[name] = (current, value)
+                want[name] = value
+        if len(want) and not dry_run:
+            self.set_parameters(want, epsilon_pct=epsilon_pct, **kwargs)
+        self.progress(str(report))
+        return report
 
     @staticmethod
     def should_fetch_all_for_parameter_change(param_name):
@@ -435,8 +1847,183 @@ class Copter:
             return True
         return False
 
-    def get_parameter(self, *args, **kwargs):
-        return self.get_parameter_direct(*args, **kwargs)
+    def fetch_parameters(self, timeout=60, cache_dir=PARAMETER_CACHE_DIR):
+        """Fill self.parameters with the whole parameter table.
+        With a cache_dir, a snapshot saved for this vehicle identity (sysid, firmware, board UID) is used
+        instead of a download when a sample of it still matches the vehicle; a download refreshes it."""
+        tstart = time.time()
+        if cache_dir is not None:
+            path = self.parameter_snapshot_path(cache_dir)
+            if path is not None and self.load_parameter_snapshot(path):
+                self.progress("Got %u parameters from %s in %fs" % (self.parameters.count, path, time.time() - tstart))
+                return
+        if self.vehicle_supports(mavutil.mavlink.MAV_PROTOCOL_CAPABILITY_FTP) and self.fetch_parameters_ftp(timeout):
+            self.progress("Got %u parameters over FTP in %fs" % (self.parameters.count, time.time() - tstart))
+            self.save_parameter_snapshot()
+            return
+        self.progress("Fetching all parameters")
+        if not self.parameters.fetch_all(self.mav, self.target_system, self.target_component, timeout=timeout):
+            raise NotAchievedException("Failed to fetch parameters, missing %u of %s" %
+                                       (len(self.parameters.missing()), self.parameters.count))
+        self.progress("Got %u parameters in %fs" % (self.parameters.count, time.time() - tstart))
+        self.save_parameter_snapshot()
+
+    def fetch_parameters_ftp(self, timeout=60):
+        """Read the whole parameter table from @PARAM/param.pck with MAVLink FTP; False if that failed."""
+        ftp = MAVFTPClient(self.mav, self.bus, self.target_system, self.target_component)
+        try:
+            (count, params) = decode_param_pck(ftp.read_file("@PARAM/param.pck", timeout=timeout))
+        except FTPError as e:
+            self.progress("Parameter download over FTP failed: %s" % e)
+            return False
+        if len(params) != count:
+            # the vehicle left some out, we need them all for the index table
+            return False
+        self.parameters.restore({
+            "count": count,
+            "names": [name for (name, value) in params],
+            "values": dict(params),
+        }, overwrite=True)
+        return True
+
+    def vehicle_supports(self, capability):
+        """True if AUTOPILOT_VERSION advertises the MAV_PROTOCOL_CAPABILITY capability."""
+        m = self.request_autopilot_version()
+        return m is not None and m.capabilities & capability != 0
+
+    def request_autopilot_version(self, timeout=1, attempts=3):
+        """Return the vehicle AUTOPILOT_VERSION, None if it doesn't answer."""
+        m = self.cache.get('AUTOPILOT_VERSION')
+        if m is not None:
+            return m
+        for attempt in range(attempts):
+            since = self.rx_buffer.cursor()
+            try:
+                self.run_cmd(mavutil.mavlink.MAV_CMD_REQUEST_MESSAGE,
+                             mavutil.mavlink.MAVLINK_MSG_ID_AUTOPILOT_VERSION,
+                             0, 0, 0, 0, 0, 0,
+                             timeout=timeout,
+                             quiet=True)
+            except ValueError:
+                return None
+            except TimeoutException:
+                continue
+            m = self.recv_match(type='AUTOPILOT_VERSION', blocking=True, timeout=timeout, since=since)
+            if m is not None:
+                return m
+        return None
+
+    def parameter_snapshot_path(self, cache_dir=PARAMETER_CACHE_DIR):
+        """Snapshot file of this vehicle identity in cache_dir; None if the vehicle doesn't tell its identity."""
+        m = self.request_autopilot_version()
+        if m is None:
+            return None
+        uid = "%016x" % m.uid
+        if m.uid == 0:
+            uid = bytes(m.uid2).hex()
+        self.parameter_snapshot_file = os.path.join(
+            cache_dir, "sysid%u-fw%08x-%s.json" % (self.target_system, m.flight_sw_version, uid))
+        return self.parameter_snapshot_file
+
+    def save_parameter_snapshot(self):
+        """Write the parameter table to the snapshot file of this vehicle, if we know it.
+        Done after a download and on close(); the parameters set in between only update the table."""
+        path = self.parameter_snapshot_file
+        if path is None or not self.parameters.complete():
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.parameters.snapshot(), f)
+        os.replace(path + ".tmp", path)
+
+    def load_parameter_snapshot(self, path, samples=8, timeout=2):
+        """Load the snapshot at path into self.parameters if the vehicle still matches it:
+        same parameter count and same values for samples parameters picked at random."""
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return False
+        count = snapshot.get("count")
+        if not count or len(snapshot["names"]) != count:
+            return False
+        indices = set(random.sample(range(count), min(samples, count)))
+        replies = queue.SimpleQueue()
+        token = self.bus.subscribe('PARAM_VALUE', replies.put, sysid=self.target_system)
+        try:
+            for attempt in range(2):
+                for index in indices:
+                    self.mav.mav.param_request_read_send(self.target_system, self.target_component, b'', index)
+                deadline = time.monotonic() + timeout
+                while indices:
+                    try:
+                        m = replies.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if m.param_count != count:
+                        self.progress("Parameter snapshot is stale: %u parameters, vehicle has %u" %
+                                      (count, m.param_count))
+                        return False
+                    if m.param_index not in indices:
+                        continue
+                    name = snapshot["names"][m.param_index]
+                    if m.param_id != name or snapshot["values"].get(name) != m.param_value:
+                        self.progress("Parameter snapshot is stale: %s" % m.param_id)
+                        return False
+                    indices.discard(m.param_index)
+        finally:
+            self.bus.unsubscribe(token)
+        if indices:
+            return False
+        self.parameters.restore(snapshot)
+        return True
+
+    def get_parameter(self, name, *args, cached=True, **kwargs):
+        """Return the parameter from the parameter table, asking the vehicle only if we don't have it yet
+        (or cached is False)."""
+        if cached and name in self.parameters:
+            return self.parameters.get(name)
+        return self.get_parameter_direct(name, *args, **kwargs)
+
+    def get_parameters(self, names, cached=True, param_timeout=1.0, retries=3):
+        """Return a dict of the values of names.
+        Those not in the parameter table (all of them if cached is False) are requested at once and the
+        replies collected through one subscription; the ones unanswered after param_timeout are asked
+        again, at most retries times."""
+        values = {}
+        wanted = set()
+        for name in names:
+            if cached and name in self.parameters:
+                values[name] = self.parameters.get(name)
+            else:
+                wanted.add(name)
+        if len(wanted) == 0:
+            return {name: values[name] for name in names}
+
+        replies = queue.SimpleQueue()
+        token = self.bus.subscribe('PARAM_VALUE', replies.put, sysid=self.target_system)
+        try:
+            to_send = sorted(wanted)
+            for attempt in range(retries + 1):
+                for name in to_send:
+                    self.send_get_parameter_direct(name)
+                deadline = time.monotonic() + param_timeout
+                while wanted:
+                    try:
+                        m = replies.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if m.param_id in wanted:
+                        values[m.param_id] = m.param_value
+                        wanted.discard(m.param_id)
+                if len(wanted) == 0:
+                    return {name: values[name] for name in names}
+                to_send = sorted(wanted)
+                if attempt < retries:
+                    self.progress("Requesting (%s) again (retry=%u)" % (",".join(to_send), attempt + 1))
+        finally:
+            self.bus.unsubscribe(token)
+        raise NotAchievedException("Failed to retrieve parameters (%s)" % ",".join(sorted(wanted)))
 
     def send_get_parameter_direct(self, name):
         encname = name
@@ -472,7 +2059,7 @@ class Copter:
                 delta_time = now - tstart
                 if delta_time > timeout:
                     break
-                m = self.mav.recv_match(type='PARAM_VALUE', blocking=True, timeout=0.1)
+                m = self.recv_match(type='PARAM_VALUE', blocking=True, timeout=0.1)
                 if verbose:
                     self.progress("get_parameter(%s): %s" % (name, str(m),))
                 if m is None:
@@ -490,47 +2077,37 @@ class Copter:
         if self.in_drain_mav:
             return
 
-    def message_hook(self, mav, msg):
-        """Called as each mavlink msg is received.
-        Display STATUSTEXT messages.
-        Send the heartbeats if needed."""
-        if msg.get_type() == 'STATUSTEXT':
-            self.progress("AP: %s" % msg.text)
-        self.idle_hook(mav)
-        self.do_heartbeats()
+    def message_hook(self, msg):
+        """Called for each STATUSTEXT from the vehicle.
+        Display STATUSTEXT messages."""
+        self.progress("AP: %s" % msg.text)
 
-    def install_message_hook(self, hook):
-        self.mav.message_hooks.append(hook)
+    def install_message_hook(self, hook, msg_type=None):
+        """Call hook(mav, msg) for each received message of msg_type (every message if None).
+        Installing a hook again replaces its previous msg_type instead of calling it twice.
+        The hook runs on the receive thread; what it raises is printed by the bus, not re-raised."""
+        token = self.hook_tokens.pop(hook, None)
+        if token is not None:
+            self.bus.unsubscribe(token)
+        self.hook_tokens[hook] = self.bus.subscribe(msg_type, lambda m: hook(self.mav, m))
 
     def remove_message_hook(self, hook):
         if self.mav is None:
             return
-        oldlen = len(self.mav.message_hooks)
-        self.mav.message_hooks = list(filter(lambda x: x != hook,
-                                             self.mav.message_hooks))
-        if len(self.mav.message_hooks) == oldlen:
+        token = self.hook_tokens.pop(hook, None)
+        if token is None or not self.bus.unsubscribe(token):
             raise NotAchievedException("Failed to remove hook")
 
     def do_heartbeats(self, force=False):
-        if self.heartbeat_interval_ms is None and not force:
+        """Heartbeats are sent by the scheduler thread; force sends one immediately."""
+        if not force:
             return
-        x = self.mav.messages.get("SYSTEM_TIME", None)
-        now_wc = time.time()
-        if (force or
-                x is None or
-                self.last_heartbeat_time_ms is None or
-                self.last_heartbeat_time_ms < x.time_boot_ms or
-                x.time_boot_ms - self.last_heartbeat_time_ms > self.heartbeat_interval_ms or
-                now_wc - self.last_heartbeat_time_wc_s > 1):
-            # self.progress("Sending heartbeat")
-            if x is not None:
-                self.last_heartbeat_time_ms = x.time_boot_ms
-            self.last_heartbeat_time_wc_s = now_wc
-            self.mav.mav.heartbeat_send(mavutil.mavlink.MAV_TYPE_GCS,
-                                        mavutil.mavlink.MAV_AUTOPILOT_INVALID,
-                                        0,
-                                        0,
-                                        0)
+        if self.heartbeat is None:
+            self.heartbeat = HeartbeatScheduler(self.mav, self.link_lock)
+        self.heartbeat.beat()
+
+    def progress_cmd(self, command, target_sysid, target_compid, params):
+        self.progress(lookup.command_template(command).describe(target_sysid, target_compid, params))
 
     def send_cmd(self,
                  command,
@@ -549,22 +2126,7 @@ class Copter:
             target_sysid = self.target_system
         if target_compid is None:
             target_compid = 1
-        try:
-            command_name = mavutil.mavlink.enums["MAV_CMD"][command].name
-        except KeyError as e:
-            command_name = "UNKNOWN=%u" % command
-        self.progress("Sending COMMAND_LONG to (%u,%u) (%s) (p1=%f p2=%f p3=%f p4=%f p5=%f p6=%f  p7=%f)" %
-                      (
-                          target_sysid,
-                          target_compid,
-                          command_name,
-                          p1,
-                          p2,
-                          p3,
-                          p4,
-                          p5,
-                          p6,
-                          p7))
+        self.progress_cmd(command, target_sysid, target_compid, (p1, p2, p3, p4, p5, p6, p7))
         self.mav.mav.command_long_send(target_sysid,
                                        target_compid,
                                        command,
@@ -577,6 +2139,32 @@ class Copter:
                                        p6,
                                        p7)
 
+    def start_cmd(self,
+                  command,
+                  p1,
+                  p2,
+                  p3,
+                  p4,
+                  p5,
+                  p6,
+                  p7,
+                  target_sysid=None,
+                  target_compid=None,
+                  timeout=10,
+                  retries=3,
+                  quiet=False):
+        """Send a MAVLink command long without waiting; return its CommandHandle.
+        Commands with different ids can be in flight together. For long running commands timeout
+        applies between two MAV_RESULT_IN_PROGRESS ACKs."""
+        if target_sysid is None:
+            target_sysid = self.target_system
+        if target_compid is None:
+            target_compid = 1
+        if not quiet:
+            self.progress_cmd(command, target_sysid, target_compid, (p1, p2, p3, p4, p5, p6, p7))
+        return self.commands.send(command, (p1, p2, p3, p4, p5, p6, p7), target_sysid, target_compid,
+                                  timeout=timeout, retries=retries)
+
     def run_cmd(self,
                 command,
                 p1,
@@ -591,20 +2179,34 @@ class Copter:
                 target_compid=None,
                 timeout=10,
                 quiet=False):
-        self.drain_mav_unparsed()
-        time.time()  # required for timeout in run_cmd_get_ack to work
-        self.send_cmd(command,
-                      p1,
-                      p2,
-                      p3,
-                      p4,
-                      p5,
-                      p6,
-                      p7,
-                      target_sysid=target_sysid,
-                      target_compid=target_compid,
-                      )
-        self.run_cmd_get_ack(command, want_result, timeout, quiet=quiet)
+        handle = self.start_cmd(command,
+                                p1,
+                                p2,
+                                p3,
+                                p4,
+                                p5,
+                                p6,
+                                p7,
+                                target_sysid=target_sysid,
+                                target_compid=target_compid,
+                                timeout=timeout,
+                                quiet=quiet)
+        self.check_cmd_result(handle, want_result, quiet=quiet)
+
+    def check_cmd_result(self, handle, want_result=mavutil.mavlink.MAV_RESULT_ACCEPTED, quiet=False):
+        """Wait for the final ACK of handle and raise ValueError if its result isn't want_result."""
+        m = handle.wait()
+        if not quiet:
+            self.progress("ACK received: %s (%fs)" % (str(m), handle.elapsed()))
+        if m.result != want_result:
+            raise ValueError("Expected %s got %s" % (self.mav_result_name(want_result), self.mav_result_name(m.result)))
+        return m
+
+    @staticmethod
+    def mav_result_name(result):
+        if result == MAV_RESULT_CANCELLED:
+            return "MAV_RESULT_CANCELLED"
+        return lookup.enum_name("MAV_RESULT", result, "UNKNOWN=%u" % result)
 
     def run_cmd_get_ack(self, command, want_result, timeout, quiet=False):
         # note that the caller should ensure that this cached
@@ -614,7 +2216,7 @@ class Copter:
             delta_time = time.time() - tstart
             if delta_time > timeout:
                 raise TimeoutException("Did not get good COMMAND_ACK within %fs" % timeout)
-            m = self.mav.recv_match(type='COMMAND_ACK',
+            m = self.recv_match(type='COMMAND_ACK',
                                     blocking=True,
                                     timeout=0.1)
             if m is None:
@@ -623,9 +2225,8 @@ class Copter:
                 self.progress("ACK received: %s (%fs)" % (str(m), delta_time))
             if m.command == command:
                 if m.result != want_result:
-                    raise ValueError("Expected %s got %s" % (
-                        mavutil.mavlink.enums["MAV_RESULT"][want_result].name,
-                        mavutil.mavlink.enums["MAV_RESULT"][m.result].name))
+                    raise ValueError("Expected %s got %s" % (self.mav_result_name(want_result),
+                                                             self.mav_result_name(m.result)))
                 break
 
     def run_cmd_do_set_mode(self,
@@ -647,59 +2248,87 @@ class Copter:
                      )
 
     def do_set_mode_via_command_long(self, mode, timeout=30):
-        """Set mode with a command long message."""
+        """Set mode with a command long message.
+        ArduPilot switches mode before sending the ACK, so the first heartbeat after the ACK confirms it;
+        we ask for that heartbeat instead of waiting for the next periodic one."""
         tstart = time.time()
         want_custom_mode = self.get_mode_from_mode_mapping(mode)
         while True:
             remaining = timeout - (time.time() - tstart)
             if remaining <= 0:
                 raise TimeoutException("Failed to change mode")
-            self.run_cmd_do_set_mode(mode, timeout=10)
-            m = self.mav.recv_match(type='HEARTBEAT',
-                                    blocking=True,
-                                    timeout=5)
-            if m is None:
+            self.run_cmd_do_set_mode(mode, timeout=min(10, remaining))
+            seen = self.modes.count
+            self.request_heartbeat()
+            if not self.modes.wait(timeout=5, after=seen):
                 raise ErrorException("Heartbeat not received")
-            self.progress("Got mode=%u want=%u" % (m.custom_mode, want_custom_mode))
-            if m.custom_mode == want_custom_mode:
+            self.progress("Got mode=%u want=%u" % (self.modes.custom_mode, want_custom_mode))
+            if self.modes.custom_mode == want_custom_mode:
                 return
 
+    def request_heartbeat(self):
+        """Ask for an immediate HEARTBEAT, without waiting for the ACK; the periodic one still comes if this is lost.
+        Sent through the command engine so its ACK can't resolve another REQUEST_MESSAGE, and skipped while one
+        is in flight so it doesn't supersede it: the ACKs of two REQUEST_MESSAGE can't be told apart."""
+        if self.commands.in_flight(mavutil.mavlink.MAV_CMD_REQUEST_MESSAGE, self.target_system):
+            return
+        self.start_cmd(mavutil.mavlink.MAV_CMD_REQUEST_MESSAGE,
+                       mavutil.mavlink.MAVLINK_MSG_ID_HEARTBEAT,
+                       0,
+                       0,
+                       0,
+                       0,
+                       0,
+                       0,
+                       timeout=1,
+                       retries=0,
+                       quiet=True)
+
     def change_mode(self, mode, timeout=60):
         """change vehicle flightmode"""
-        self.wait_heartbeat()
+        if self.modes.heartbeat is None:
+            self.wait_heartbeat()
         self.progress("Changing mode to %s" % mode)
-        self.do_set_mode_via_command_long(mode)
+        self.do_set_mode_via_command_long(mode, timeout=timeout)
 
     def mode_is(self, mode, cached=False, drain_mav=True):
-        if not cached:
+        """True if the last heartbeat reports mode (a name or a number).
+        The mode is tracked from every heartbeat, so only the first call waits for one; cached and
+        drain_mav are kept for the existing callers."""
+        if self.modes.heartbeat is None:
             self.wait_heartbeat(drain_mav=drain_mav)
         try:
-            return self.get_mode_from_mode_mapping(self.mav.flightmode) == self.get_mode_from_mode_mapping(mode)
+            return self.modes.custom_mode == self.get_mode_from_mode_mapping(mode)
         except Exception as e:
             pass
         # assume this is a number....
-        return self.mav.messages['HEARTBEAT'].custom_mode == mode
+        return self.modes.custom_mode == mode
 
     def wait_mode(self, mode, timeout=60):
         """Wait for mode to change."""
         self.progress("Waiting for mode %s" % mode)
         tstart = time.time()
-        while not self.mode_is(mode, drain_mav=False):
-            custom_num = self.mav.messages['HEARTBEAT'].custom_mode
-            self.progress("mav.flightmode=%s Want=%s custom=%u" % (
-                self.mav.flightmode, mode, custom_num))
-            if (timeout is not None and
-                    time.time() > tstart + timeout):
-                raise WaitModeTimeout("Did not change mode")
+        while True:
+            seen = self.modes.count
+            if self.mode_is(mode):
+                break
+            self.progress("flightmode=%s Want=%s custom=%u" % (
+                self.modes.flightmode(), mode, self.modes.custom_mode))
+            remaining = None
+            if timeout is not None:
+                remaining = tstart + timeout - time.time()
+                if remaining <= 0:
+                    raise WaitModeTimeout("Did not change mode")
+            self.modes.wait(timeout=remaining, after=seen)
         self.progress("Got mode %s" % mode)
 
     def get_mode_from_mode_mapping(self, mode):
         """Validate and return the mode number from a string or int."""
-        mode_map = self.mav.mode_mapping()
+        mode_map = self.modes.mapping()
         if mode_map is None:
-            mav_type = self.mav.messages['HEARTBEAT'].type
-            mav_autopilot = self.mav.messages['HEARTBEAT'].autopilot
-            raise ErrorException("No mode map for (mav_type=%s mav_autopilot=%s)" % (mav_type, mav_autopilot))
+            mode_map = self.mav.mode_mapping()
+        if mode_map is None:
+            raise ErrorException("No mode map for (mav_type=%s)" % self.modes.mav_type)
         if isinstance(mode, str):
             if mode in mode_map:
                 return mode_map.get(mode)
@@ -712,8 +2341,9 @@ class Copter:
         m = self.mav.messages.get("HOME_POSITION", None)
         if use_cached_home is False or m is None:
             m = self.poll_home_position(quiet=True)
-        here = self.mav.recv_match(type='GLOBAL_POSITION_INT',
-                                   blocking=True)
+        here = self.recv_match(type='GLOBAL_POSITION_INT',
+                               blocking=True,
+                               since=self.rx_buffer.cursor())
         return self.get_distance_int(m, here)
 
     def poll_home_position(self, quiet=True, timeout=30):
@@ -747,33 +2377,221 @@ class Copter:
         self.progress("Polled home position (%s)" % str(m))
         return m
 
+    def location(self, relative_alt=False, cached=False, timeout=5):
+        """Return the current location built from the cached GPS_RAW_INT, VFR_HUD and GLOBAL_POSITION_INT.
+        Unless cached is set, wait for a fresh GLOBAL_POSITION_INT first."""
+        if not cached:
+            if self.recv_match(type='GLOBAL_POSITION_INT', blocking=True, timeout=timeout,
+                               since=self.rx_buffer.cursor()) is None:
+                raise MsgRcvTimeoutException("Failed to get Global Position")
+        gps = self.cache.get('GPS_RAW_INT')
+        hud = self.cache.get('VFR_HUD')
+        pos = self.cache.get('GLOBAL_POSITION_INT')
+        if gps is None or hud is None or pos is None:
+            raise MsgRcvTimeoutException("No position received yet")
+        if relative_alt:
+            alt = pos.relative_alt * 0.001
+        else:
+            alt = hud.alt
+        return location(gps.lat * 1.0e-7, gps.lon * 1.0e-7, alt, hud.heading)
+
+    def waypoint_current(self, timeout=5):
+        """Return the current mission sequence number from the next MISSION_CURRENT."""
+        m = self.recv_match(type='MISSION_CURRENT', blocking=True, timeout=timeout, since=self.rx_buffer.cursor())
+        if m is None:
+            raise MsgRcvTimeoutException("Failed to get MISSION_CURRENT")
+        return m.seq
+
     def home_position_as_mav_location(self):
         m = self.poll_home_position()
         return mavutil.location(m.latitude * 1.0e-7, m.longitude * 1.0e-7, m.altitude * 1.0e-3, 0)
 
-    def wait_altitude(self, altitude_min, altitude_max, relative=False, timeout=30, **kwargs):
-        """Wait for a given altitude range."""
+    def start_wait(self, predicate, timeout=None, expires=True):
+        """Start evaluating predicate on the received messages; return its future.
+        timeout replaces predicate.timeout for this wait; with expires False it never times out."""
+        return self.predicates.add(predicate, timeout=timeout, expires=expires)
+
+    def wait_predicate(self, predicate):
+        """Block until predicate holds, printing its value every second; return the attained value."""
+        future = self.start_wait(predicate)
+        self.progress("Waiting for %s %s" % (predicate.name, predicate.want))
+        try:
+            while True:
+                try:
+                    value = future.result(timeout=1)
+                except concurrent.futures.TimeoutError:
+                    if predicate.last_value is not None:
+                        self.progress("%s=%0.2f (want %s)" % (predicate.name, predicate.last_value, predicate.want))
+                    continue
+                self.progress("Attained %s=%f" % (predicate.name, value))
+                return value
+        finally:
+            future.cancel()
+
+    def altitude_predicate(self, altitude_min, altitude_max, relative=False, timeout=30, minimum_duration=0,
+                           called_function=None):
+        """Predicate of the GLOBAL_POSITION_INT altitude staying between altitude_min and altitude_max."""
         assert altitude_min <= altitude_max, "Minimum altitude should be less than maximum altitude."
+        if relative:
+            def altitude(m):
+                return m.relative_alt * 0.001  # mm -> m
+        else:
+            def altitude(m):
+                return m.alt * 0.001  # mm -> m
+
+        return Predicate("Altitude", "between %.02f and %.02f" % (altitude_min, altitude_max), 'GLOBAL_POSITION_INT',
+                         altitude, lambda value, m: altitude_min <= value <= altitude_max,
+                         minimum_duration=minimum_duration, timeout=timeout, exception=WaitAltitudeTimout,
+                         target=altitude_min, called_function=called_function)
+
+    def location_predicate(self, loc, accuracy=5.0, timeout=30, target_altitude=None, height_accuracy=-1,
+                           minimum_duration=0, called_function=None):
+        """Predicate of the distance to loc staying within accuracy, and of the altitude staying within
+        height_accuracy of target_altitude if both are given. Uses the same cached GPS_RAW_INT and VFR_HUD
+        as location(), sampled on each GLOBAL_POSITION_INT."""
+        lat = self.get_lat_attr(loc)
+        lon = self.get_lon_attr(loc)
+        cache = self.cache
+
+        def distance(m):
+            gps = cache.get('GPS_RAW_INT')
+            if gps is None:
+                return None
+            return mp_util.gps_distance(gps.lat * 1.0e-7, gps.lon * 1.0e-7, lat, lon)
+
+        def valid(value, m):
+            if value > accuracy:
+                return False
+            if target_altitude is not None and height_accuracy != -1:
+                hud = cache.get('VFR_HUD')
+                if hud is None or math.fabs(hud.alt - target_altitude) > height_accuracy:
+                    return False
+            return True
 
-        def get_altitude(alt_relative=False, timeout2=30):
-            msg = self.mav.recv_match(type='GLOBAL_POSITION_INT', blocking=True, timeout=timeout2)
-            if msg:
-                if alt_relative:
-                    return msg.relative_alt / 1000.0  # mm -> m
-                else:
-                    return msg.alt / 1000.0  # mm -> m
-            raise MsgRcvTimeoutException("Failed to get Global Position")
+        want = "(%.4f, %.4f) within %.02f" % (lat, lon, accuracy)
+        if target_altitude is not None:
+            want += " at altitude %.1f height_accuracy=%.1f" % (target_altitude, height_accuracy)
+        return Predicate("Distance to Location", want, 'GLOBAL_POSITION_INT', distance, valid,
+                         minimum_duration=minimum_duration, timeout=timeout, exception=WaitLocationTimeout,
+                         target=0, called_function=called_function)
+
+    def distance_to_home_predicate(self, distance_min, distance_max, timeout=10, use_cached_home=True,
+                                   minimum_duration=0, called_function=None):
+        """Predicate of the GLOBAL_POSITION_INT distance to home staying between distance_min and distance_max.
+        Home is polled once, when it is not cached or use_cached_home is False."""
+        assert distance_min <= distance_max, "Distance min should be less than distance max."
+        home = self.mav.messages.get("HOME_POSITION", None)
+        if use_cached_home is False or home is None:
+            home = self.poll_home_position(quiet=True)
+        home_lat = home.latitude * 1.0e-7
+        home_lon = home.longitude * 1.0e-7
+
+        def distance(m):
+            return mp_util.gps_distance(home_lat, home_lon, m.lat * 1.0e-7, m.lon * 1.0e-7)
+
+        return Predicate("Distance to home", "between %.02f and %.02f" % (distance_min, distance_max),
+                         'GLOBAL_POSITION_INT', distance, lambda value, m: distance_min <= value <= distance_max,
+                         minimum_duration=minimum_duration, timeout=timeout, exception=WaitDistanceTimeout,
+                         target=distance_min, called_function=called_function)
+
+    def mode_predicate(self, mode, timeout=30, minimum_duration=0):
+        """Predicate of the autopilot heartbeat reporting mode (a name or a number)."""
+        want_custom_mode = self.get_mode_from_mode_mapping(mode)
+        return Predicate("Mode", "%s" % mode, 'HEARTBEAT', self.heartbeat_custom_mode,
+                         lambda value, m: value == want_custom_mode,
+                         minimum_duration=minimum_duration, timeout=timeout, exception=WaitModeTimeout)
+
+    def mode_changed_predicate(self, mode=None, timeout=None):
+        """Predicate of the autopilot heartbeat reporting another mode than mode (by default the current one)."""
+        if mode is None:
+            if self.modes.heartbeat is None:
+                self.wait_heartbeat()
+            from_custom_mode = self.modes.custom_mode
+        else:
+            from_custom_mode = self.get_mode_from_mode_mapping(mode)
+        return Predicate("Mode", "not %u" % from_custom_mode, 'HEARTBEAT', self.heartbeat_custom_mode,
+                         lambda value, m: value != from_custom_mode, timeout=timeout, exception=WaitModeTimeout)
 
-        def validator(value2, target2=None):
-            if altitude_min <= value2 <= altitude_max:
-                return True
-            else:
-                return False
+    @staticmethod
+    def heartbeat_custom_mode(m):
+        if m.autopilot == mavutil.mavlink.MAV_AUTOPILOT_INVALID:
+            return None
+        return m.custom_mode
+
+    def armed_predicate(self, armed=True, timeout=30):
+        """Predicate of the autopilot heartbeat reporting the motors armed (or disarmed)."""
+        def is_armed(m):
+            if m.autopilot == mavutil.mavlink.MAV_AUTOPILOT_INVALID:
+                return None
+            return 1 if m.base_mode & mavutil.mavlink.MAV_MODE_FLAG_SAFETY_ARMED else 0
+
+        return Predicate("Armed", "%s" % armed, 'HEARTBEAT', is_armed, lambda value, m: value == int(armed),
+                         timeout=timeout, exception=NotAchievedException)
+
+    def waypoint_predicate(self, seq, timeout=400):
+        """Predicate of the mission having completed item seq: reached, or a later item current."""
+        def completed(m):
+            if m.get_type() == 'MISSION_ITEM_REACHED':
+                return m.seq
+            return m.seq - 1
+
+        return Predicate("Waypoint", "%u completed" % seq, ['MISSION_ITEM_REACHED', 'MISSION_CURRENT'], completed,
+                         lambda value, m: value >= seq, timeout=timeout, exception=WaitWaypointTimeout)
+
+    def wait_all(self, *predicates, timeout=None, guards=()):
+        """Wait until every predicate has been attained; they are all evaluated together on the received messages.
+        timeout, when given, is a deadline shared by all of them. The first predicate failing, or any of the
+        guards being attained, aborts at once. Return the attained values in order."""
+        return self.wait_composite(predicates, guards, timeout, True)
+
+    def wait_any(self, *predicates, timeout=None, guards=()):
+        """Wait until one of the predicates is attained; return (its index, its value).
+        Fails when all of them have failed, or at once when one of the guards is attained."""
+        return self.wait_composite(predicates, guards, timeout, False)
+
+    def wait_composite(self, predicates, guards, timeout, need_all):
+        futures = [self.start_wait(predicate, timeout=timeout) for predicate in predicates]
+        # a guard is watched for as long as the wait lasts
+        guard_futures = [self.start_wait(guard, expires=False) for guard in guards]
+        self.progress("Waiting for %s of %s%s" % (
+            "all" if need_all else "any",
+            ", ".join("%s %s" % (predicate.name, predicate.want) for predicate in predicates),
+            "".join(" unless %s %s" % (guard.name, guard.want) for guard in guards)))
+        try:
+            while True:
+                waiting = [future for future in futures + guard_futures if not future.done()]
+                done, not_done = concurrent.futures.wait(waiting, timeout=1,
+                                                         return_when=concurrent.futures.FIRST_COMPLETED)
+                for guard in guards:
+                    if guard.attained():
+                        raise WaitGuardException("Aborted: %s %s" % (guard.name, guard.want))
+                failed = [predicate.error() for predicate in predicates if predicate.error() is not None]
+                attained = [i for (i, predicate) in enumerate(predicates) if predicate.attained()]
+                if need_all:
+                    if failed:
+                        raise failed[0]
+                    if len(attained) == len(futures):
+                        self.progress("Attained all of %s" % ", ".join(predicate.name for predicate in predicates))
+                        return [future.result() for future in futures]
+                else:
+                    if attained:
+                        i = attained[0]
+                        self.progress("Attained %s=%s" % (predicates[i].name, futures[i].result()))
+                        return (i, futures[i].result())
+                    if len(failed) == len(futures):
+                        raise failed[0]
+                if not done:
+                    for (predicate, future) in zip(predicates, futures):
+                        if not future.done() and predicate.last_value is not None:
+                            self.progress("%s=%s (want %s)" % (predicate.name, predicate.last_value, predicate.want))
+        finally:
+            for future in futures + guard_futures:
+                future.cancel()
 
-        self.wait_and_maintain(value_name="Altitude", target=altitude_min,
-                               current_value_getter=lambda: get_altitude(relative, timeout),
-                               accuracy=(altitude_max - altitude_min),
-                               validator=lambda value2, target2: validator(value2, target2), timeout=timeout, **kwargs)
+    def wait_altitude(self, altitude_min, altitude_max, relative=False, timeout=30, **kwargs):
+        """Wait for a given altitude range."""
+        return self.wait_predicate(self.altitude_predicate(altitude_min, altitude_max, relative=relative,
+                                                           timeout=timeout, **kwargs))
 
     def wait_location(self,
                       loc,
@@ -783,99 +2601,14 @@ class Copter:
                       height_accuracy=-1,
                       **kwargs):
         """Wait for arrival at a location."""
-
-        def get_distance_to_loc():
-            return self.get_distance(self.mav.location(), loc)
-
-        def validator(value2, empty=None):
-            if value2 <= accuracy:
-                if target_altitude is not None:
-                    height_delta = math.fabs(self.mav.location().alt - target_altitude)
-                    if height_accuracy != -1 and height_delta > height_accuracy:
-                        return False
-                return True
-            else:
-                return False
-
-        debug_text = "Distance to Location (%.4f, %.4f) " % (loc.lat, loc.lng)
-        if target_altitude is not None:
-            debug_text += ",at altitude %.1f height_accuracy=%.1f, d" % (target_altitude, height_accuracy)
-        self.wait_and_maintain(value_name=debug_text, target=0, current_value_getter=lambda: get_distance_to_loc(),
-                               accuracy=accuracy, validator=lambda value2, target2: validator(value2, None),
-                               timeout=timeout, **kwargs)
+        return self.wait_predicate(self.location_predicate(loc, accuracy=accuracy, timeout=timeout,
+                                                           target_altitude=target_altitude,
+                                                           height_accuracy=height_accuracy, **kwargs))
 
     def wait_distance_to_home(self, distance_min, distance_max, timeout=10, use_cached_home=True, **kwargs):
         """Wait for distance to home to be within specified bounds."""
-        assert distance_min <= distance_max, "Distance min should be less than distance max."
-
-        def get_distance():
-            return self.distance_to_home(use_cached_home)
-
-        def validator(value2, target2=None):
-            return distance_min <= value2 <= distance_max
-
-        self.wait_and_maintain(value_name="Distance to home", target=distance_min,
-                               current_value_getter=lambda: get_distance(),
-                               validator=lambda value2, target2: validator(value2, target2),
-                               accuracy=(distance_max - distance_min), timeout=timeout, **kwargs)
-
-    def wait_and_maintain(self, value_name, target, current_value_getter, validator=None, accuracy=2.0, timeout=30,
-                          **kwargs):
-        tstart = time.time()
-        achieving_duration_start = None
-        if type(target) is Vector3:
-            sum_of_achieved_values = Vector3()
-            last_value = Vector3()
-        else:
-            sum_of_achieved_values = 0.0
-            last_value = 0.0
-        count_of_achieved_values = 0
-        called_function = kwargs.get("called_function", None)
-        minimum_duration = kwargs.get("minimum_duration", 0)
-        if type(target) is Vector3:
-            self.progress("Waiting for %s=(%s) with accuracy %.02f" % (value_name, str(target), accuracy))
-        else:
-            self.progress("Waiting for %s=%.02f with accuracy %.02f" % (value_name, target, accuracy))
-        last_print_time = 0
-        while time.time() < tstart + timeout:  # if we failed to received message with the getter the sim time isn't updated
-            last_value = current_value_getter()
-            if called_function is not None:
-                called_function(last_value, target)
-            if time.time() - last_print_time > 1:
-                if type(target) is Vector3:
-                    self.progress("%s=(%s) (want (%s) +- %f)" %
-                                  (value_name, str(last_value), str(target), accuracy))
-                else:
-                    self.progress("%s=%0.2f (want %f +- %f)" %
-                                  (value_name, last_value, target, accuracy))
-                last_print_time = time.time()
-            if validator is not None:
-                is_value_valid = validator(last_value, target)
-            else:
-                is_value_valid = math.fabs(last_value - target) <= accuracy
-            if is_value_valid:
-                sum_of_achieved_values += last_value
-                count_of_achieved_values += 1.0
-                if achieving_duration_start is None:
-                    achieving_duration_start = time.time()
-                if time.time() - achieving_duration_start >= minimum_duration:
-                    if type(target) is Vector3:
-                        self.progress("Attained %s=%s" % (
-                            value_name, str(sum_of_achieved_values * (1.0 / count_of_achieved_values))))
-                    else:
-                        self.progress(
-                            "Attained %s=%f" % (value_name, sum_of_achieved_values / count_of_achieved_values))
-                    return True
-            else:
-                achieving_duration_start = None
-                if type(target) is Vector3:
-                    sum_of_achieved_values.zero()
-                else:
-                    sum_of_achieved_values = 0.0
-                count_of_achieved_values = 0
-        raise TimeoutException("Failed to attain %s want %s, reached %s" % (value_name, str(target), str(
-            sum_of_achieved_values * (1.0 / count_of_achieved_values)) if count_of_achieved_values != 0 else str(
-            last_value)))
+        return self.wait_predicate(self.distance_to_home_predicate(distance_min, distance_max, timeout=timeout,
+                                                                   use_cached_home=use_cached_home, **kwargs))
 
     def wait_for_alt(self, alt_min=30, timeout=30, max_err=5):
         """Wait for minimum altitude to be reached."""
@@ -885,6 +2618,10 @@ class Copter:
                            timeout=timeout)
 
     def drain_mav_unparsed(self, mav=None, quiet=True, freshen_sim_time=False):
+        if self.rx_thread is not None:
+            # the receive thread owns the link; skipping what we have is a cursor move
+            self.rx_reader().cursors.clear()
+            return
         if mav is None:
             mav = self.mav
         self.in_drain_mav = True
@@ -908,7 +2645,7 @@ class Copter:
             time.time()
 
     def drain_mav(self, mav=None, unparsed=False, quiet=True):
-        if unparsed:
+        if unparsed or self.rx_thread is not None:
             return self.drain_mav_unparsed(quiet=quiet, mav=mav)
         if mav is None:
             mav = self.mav
@@ -928,58 +2665,25 @@ class Copter:
 
     def wait_prearm_sys_status_healthy(self, timeout=60):
         # self.do_timesync_roundtrip()
-        tstart = time.time()
-        while True:
-            t2 = time.time()
-            if t2 - tstart > timeout:
-                self.progress("Prearm bit never went true.  Attempting arm to elicit reason from autopilot")
-                self.arm_vehicle()
-                raise TimeoutException("Prearm bit never went true")
-            if self.sensor_has_state(mavutil.mavlink.MAV_SYS_STATUS_PREARM_CHECK, True, True, True):
-                break
+        if not self.sensors.wait(lambda: self.sensors.has_state(mavutil.mavlink.MAV_SYS_STATUS_PREARM_CHECK),
+                                 timeout):
+            self.progress("Prearm bit never went true.  Attempting arm to elicit reason from autopilot")
+            self.arm_vehicle()
+            raise TimeoutException("Prearm bit never went true")
 
     def sensor_has_state(self, sensor, present=True, enabled=True, healthy=True, do_assert=False, verbose=False):
-        m = self.mav.recv_match(type='SYS_STATUS', blocking=True, timeout=5)
-        if m is None:
+        """True if all the sensor bits have the wanted state in the sensor health snapshot.
+        Only waits, for up to 5s, if no SYS_STATUS was received yet."""
+        if not self.sensors.wait(self.sensors.has_snapshot, 5):
             raise TimeoutException("Did not receive SYS_STATUS")
         if verbose:
-            self.progress("Status: %s" % str(mavutil.dump_message_verbose(sys.stdout, m)))
-        reported_present = m.onboard_control_sensors_present & sensor
-        reported_enabled = m.onboard_control_sensors_enabled & sensor
-        reported_healthy = m.onboard_control_sensors_health & sensor
-        if present:
-            if not reported_present:
-                if do_assert:
-                    raise NotAchievedException("Sensor not present")
-                return False
-        else:
-            if reported_present:
-                if do_assert:
-                    raise NotAchievedException("Sensor present when it shouldn't be")
-                return False
-
-        if enabled:
-            if not reported_enabled:
-                if do_assert:
-                    raise NotAchievedException("Sensor not enabled")
-                return False
-        else:
-            if reported_enabled:
-                if do_assert:
-                    raise NotAchievedException("Sensor enabled when it shouldn't be")
-                return False
-
-        if healthy:
-            if not reported_healthy:
-                if do_assert:
-                    raise NotAchievedException("Sensor not healthy")
-                return False
-        else:
-            if reported_healthy:
-                if do_assert:
-                    raise NotAchievedException("Sensor healthy when it shouldn't be")
-                return False
-        return True
+            self.progress("Status: %s" % str(mavutil.dump_message_verbose(sys.stdout, self.cache.get('SYS_STATUS'))))
+        error = self.sensors.state_error(sensor, present, enabled, healthy)
+        if error is None:
+            return True
+        if do_assert:
+            raise NotAchievedException("Sensor %s" % error)
+        return False
 
     def wait_ready_to_arm(self, timeout=120, require_absolute=True, check_prearm_bit=True):
         # wait for EKF checks to pass
@@ -1012,7 +2716,7 @@ Also, ignores heartbeats not from our target system"""
                 # if not self.sitl_is_running():
                 #     self.progress("SITL is not running")
                 raise TimeoutException("Did not receive heartbeat")
-            m = self.mav.wait_heartbeat(*args, **x)
+            m = self.recv_match(type='HEARTBEAT', blocking=True, timeout=x["timeout"])
             if m is None:
                 continue
             if m.get_srcSystem() == self.target_system:
@@ -1047,7 +2751,7 @@ Also, ignores heartbeats not from our target system"""
         last_print_time = 0
         tstart = time.time()
         while timeout is None or time.time() < tstart + timeout:
-            m = self.mav.recv_match(type='EKF_STATUS_REPORT', blocking=True, timeout=timeout)
+            m = self.recv_match(type='EKF_STATUS_REPORT', blocking=True, timeout=timeout)
             if m is None:
                 continue
             current = m.flags
@@ -1066,28 +2770,23 @@ Also, ignores heartbeats not from our target system"""
 
     def wait_gps_sys_status_not_present_or_enabled_and_healthy(self, timeout=30):
         self.progress("Waiting for GPS health")
+        gps = mavutil.mavlink.MAV_SYS_STATUS_SENSOR_GPS
         tstart = time.time()
         while True:
-            now = time.time()
-            if now - tstart > timeout:
+            if self.sensors.wait(lambda: self.sensors.has_state(gps), 1):
+                self.progress("GPS healthy")
+                return
+            elapsed = time.time() - tstart
+            if elapsed > timeout:
                 raise TimeoutException("GPS status bits did not become good")
-            m = self.mav.recv_match(type='SYS_STATUS', blocking=True, timeout=1)
-            if m is None:
-                continue
-            if (not (m.onboard_control_sensors_present & mavutil.mavlink.MAV_SYS_STATUS_SENSOR_GPS)):
-                self.progress("GPS not present")
-                if now > 20:
-                    # it's had long enough to be detected....
-                    return
+            error = self.sensors.state_error(gps)
+            if error is None:
+                # no SYS_STATUS yet
                 continue
-            if (not (m.onboard_control_sensors_enabled & mavutil.mavlink.MAV_SYS_STATUS_SENSOR_GPS)):
-                self.progress("GPS not enabled")
-                continue
-            if (not (m.onboard_control_sensors_health & mavutil.mavlink.MAV_SYS_STATUS_SENSOR_GPS)):
-                self.progress("GPS not healthy")
-                continue
-            self.progress("GPS healthy")
-            return
+            self.progress("GPS %s" % error)
+            if error == "not present" and elapsed > 20:
+                # it's had long enough to be detected....
+                return
 
     def wait_waypoint(self,
                       wpnum_start,
@@ -1095,12 +2794,21 @@ Also, ignores heartbeats not from our target system"""
                       allow_skip=True,
                       max_dist=2,
                       timeout=400):
-        """Wait for waypoint ranges."""
+        """Wait for waypoint ranges.
+        Follows the mission tracker, so it wakes up on each mission message and never blocks on a message
+        that is not streamed: without NAV_CONTROLLER_OUTPUT the final waypoint counts once reached."""
         tstart = time.time()
         # this message arrives after we set the current WP
-        start_wp = self.mav.waypoint_current()
+        if self.mission.current is None:
+            self.waypoint_current()
+        start_wp = self.mission.current
         current_wp = start_wp
-        mode = self.mav.flightmode
+        # the mode we must stay in is only known from the first heartbeat on
+        if not self.modes.wait(timeout=timeout):
+            raise WaitWaypointTimeout("No HEARTBEAT received")
+        mode = self.modes.custom_mode
+        mode_name = self.modes.flightmode()
+        first_arrival = len(self.mission.arrivals)
 
         self.progress("wait for waypoint ranges start=%u end=%u"
                       % (wpnum_start, wpnum_end))
@@ -1110,21 +2818,23 @@ Also, ignores heartbeats not from our target system"""
         #                  (wpnum_start, start_wp))
 
         last_wp_msg = 0
+        seen = 0
         while time.time() < tstart + timeout:
-            seq = self.mav.waypoint_current()
-            m = self.mav.recv_match(type='NAV_CONTROLLER_OUTPUT',
-                                    blocking=True)
-            wp_dist = m.wp_dist
-            m = self.mav.recv_match(type='VFR_HUD', blocking=True)
+            if not self.mission.wait_update(seen, min(1, tstart + timeout - time.time())):
+                continue
+            seen = self.mission.count
+            seq = self.mission.current
+            wp_dist = self.mission.wp_dist
 
             # if we changed mode, fail
-            if self.mav.flightmode != mode:
-                raise WaitWaypointTimeout('Exited %s mode' % mode)
+            if self.modes.custom_mode != mode:
+                raise WaitWaypointTimeout('Exited %s mode' % mode_name)
 
             if time.time() - last_wp_msg > 1:
-                self.progress("WP %u (wp_dist=%u Alt=%.02f), current_wp: %u,"
+                hud = self.cache.get('VFR_HUD')
+                self.progress("WP %u (wp_dist=%s Alt=%s), current_wp: %u,"
                               "wpnum_end: %u" %
-                              (seq, wp_dist, m.alt, current_wp, wpnum_end))
+                              (seq, wp_dist, "%.02f" % hud.alt if hud is not None else None, current_wp, wpnum_end))
                 last_wp_msg = time.time()
             if seq == current_wp + 1 or (seq > current_wp + 1 and allow_skip):
                 self.progress("test: Starting new waypoint %u" % seq)
@@ -1134,7 +2844,8 @@ Also, ignores heartbeats not from our target system"""
                 # the right seqnum for end of mission
             # if current_wp == wpnum_end or (current_wp == wpnum_end-1 and
             #                                wp_dist < 2):
-            if current_wp == wpnum_end and wp_dist < max_dist:
+            if current_wp == wpnum_end and ((wp_dist is not None and wp_dist < max_dist) or
+                                            wpnum_end in self.mission.arrivals_since(first_arrival)):
                 self.progress("Reached final waypoint %u" % seq)
                 return True
             if seq >= 255:
@@ -1146,12 +2857,22 @@ Also, ignores heartbeats not from our target system"""
         raise WaitWaypointTimeout("Timed out waiting for waypoint %u of %u" %
                                   (wpnum_end, wpnum_end))
 
+    def wait_reached(self, seq, timeout=400):
+        """Wait for the next arrival at mission item seq; return its timestamp."""
+        future = self.mission.reached(seq)
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise WaitWaypointTimeout("Did not reach waypoint %u within %fs" % (seq, timeout))
+
     def send_all_waypoints(self, timeout=60):
         """send all waypoints to vehicle"""
         self.mav.waypoint_clear_all_send()
         self.progress("Sending %d waypoints" % self.wploader.count())
         if self.wploader.count() == 0:
             return
+        since = self.rx_buffer.cursor()
         self.mav.waypoint_count_send(self.wploader.count())
         tstart = time.time()
         while True:
@@ -1159,7 +2880,8 @@ Also, ignores heartbeats not from our target system"""
             if now - tstart > timeout:
                 self.progress("Failed to send Mission")
                 return
-            msg = self.mav.recv_match(type=["MISSION_REQUEST", "WAYPOINT_REQUEST"], blocking=True, timeout=3)
+            msg = self.recv_match(type=["MISSION_REQUEST", "WAYPOINT_REQUEST"], blocking=True, timeout=3, since=since)
+            since = None
             if msg is None:
                 continue
             if msg.seq >= self.wploader.count():
@@ -1176,6 +2898,7 @@ Also, ignores heartbeats not from our target system"""
 
     def get_all_waypoints(self, timeout=30):
         self.progress("Requesting Mission item count")
+        since = self.rx_buffer.cursor()
         self.mav.waypoint_request_list_send()
         tstart = time.time()
         while True:
@@ -1183,7 +2906,8 @@ Also, ignores heartbeats not from our target system"""
             if now - tstart > timeout:
                 self.progress("Failed to get Mission total item")
                 return
-            msg = self.mav.recv_match(type=['WAYPOINT_COUNT', 'MISSION_COUNT'], blocking=True, timeout=3)
+            msg = self.recv_match(type=['WAYPOINT_COUNT', 'MISSION_COUNT'], blocking=True, timeout=3, since=since)
+            since = None
             if msg is None:
                 continue
             self.wp_expected_count = msg.count
@@ -1193,6 +2917,7 @@ Also, ignores heartbeats not from our target system"""
         for seq in self.missing_wps_to_request():
             self.wp_requested[seq] = time.time()
             self.progress("Requesting waypoint %d" % seq)
+            since = self.rx_buffer.cursor()
             self.mav.mav.mission_request_int_send(self.target_system, self.target_component, seq)
             tstart = time.time()
             while True:
@@ -1200,8 +2925,9 @@ Also, ignores heartbeats not from our target system"""
                 if now - tstart > timeout:
                     self.progress("Failed to get Waypoint %d" % seq)
                     return
-                msg = self.mav.recv_match(type=['WAYPOINT', 'MISSION_ITEM', 'MISSION_ITEM_INT'], blocking=True,
-                                          timeout=3)
+                msg = self.recv_match(type=['WAYPOINT', 'MISSION_ITEM', 'MISSION_ITEM_INT'], blocking=True,
+                                      timeout=3, since=since)
+                since = None
                 if msg is None:
                     continue
                 if msg.get_type() == 'MISSION_ITEM_INT':
@@ -1376,26 +3102,9 @@ Also, ignores heartbeats not from our target system"""
                           height_accuracy=-1,
                           **kwargs):
         """Wait for arrival at a location."""
-
-        def get_distance_to_loc():
-            return self.get_distance(self.mav.location(), loc)
-
-        def validator(value2, empty=None):
-            if value2 <= accuracy:
-                if target_altitude is not None:
-                    height_delta = math.fabs(self.mav.location().alt - target_altitude)
-                    if height_accuracy != -1 and height_delta > height_accuracy:
-                        return False
-                return True
-            else:
-                return False
-
-        debug_text = "Distance to Location (%.4f, %.4f) " % (loc.lat, loc.lng)
-        if target_altitude is not None:
-            debug_text += ",at altitude %.1f height_accuracy=%.1f, d" % (target_altitude, height_accuracy)
-        self.wait_and_maintain(value_name=debug_text, target=0, current_value_getter=lambda: get_distance_to_loc(),
-                               accuracy=accuracy, validator=lambda value2, target2: validator(value2, None),
-                               timeout=timeout, **kwargs)
+        return self.wait_predicate(self.location_predicate(loc, accuracy=accuracy, timeout=timeout,
+                                                           target_altitude=target_altitude,
+                                                           height_accuracy=height_accuracy, **kwargs))
 
     def user_takeoff(self, alt_min=30):
         """takeoff using mavlink takeoff command"""
@@ -1419,7 +3128,7 @@ Also, ignores heartbeats not from our target system"""
 
     def wait_landed_and_disarmed(self, min_alt=6, timeout=60):
         """Wait to be landed and disarmed"""
-        m = self.mav.recv_match(type='GLOBAL_POSITION_INT', blocking=True)
+        m = self.recv_match(type='GLOBAL_POSITION_INT', blocking=True, since=self.rx_buffer.cursor())
         alt = m.relative_alt / 1000.0  # mm -> m
         if alt > min_alt:
             self.wait_for_alt(min_alt, timeout=timeout)
@@ -1438,7 +3147,7 @@ Also, ignores heartbeats not from our target system"""
         self.progress("Waiting RTL to reach Home and disarm")
         tstart = time.time()
         while time.time() < tstart + timeout:
-            m = self.mav.recv_match(type='GLOBAL_POSITION_INT', blocking=True)
+            m = self.recv_match(type='GLOBAL_POSITION_INT', blocking=True, since=self.rx_buffer.cursor())
             alt = m.relative_alt / 1000.0  # mm -> m
             home_distance = self.distance_to_home(use_cached_home=True)
             home = ""
@@ -1542,10 +3251,13 @@ Also, ignores heartbeats not from our target system"""
         """Get and print POSITION_TARGET_GLOBAL_INT msg send by the drone.
            those message are always in MAV_FRAME_GLOBAL_INT frame."""
         tstart = time.time()
+        since = self.rx_buffer.cursor()
         while True:
             if time.time() - tstart > timeout:
                 raise TimeoutException("Failed to set streamrate")
-            msg = self.mav.recv_match(type='POSITION_TARGET_GLOBAL_INT', blocking=True, timeout=2)
+            msg = self.recv_match(type='POSITION_TARGET_GLOBAL_INT', blocking=True, timeout=2, since=since)
+            # the next tries go on from where this one stopped
+            since = None
             if msg is not None:
                 self.progress("Received local target: %s" % str(msg))
                 return location(msg.lat_int * 1.0e-7, msg.lon_int * 1.0e-7, msg.alt, msg.yaw)
@@ -1570,6 +3282,10 @@ def main():
     # Assume that we are connecting to SITL on udp 14550
     copter.connect("udpin:0.0.0.0:14550")
 
+    big_print("Let's get all the parameters")
+    # One bulk download, or the snapshot saved by a previous run, then get_parameter() reads from memory
+    copter.fetch_parameters()
+
     big_print("Let's wait ready to arm")
     # We wait that can pass all arming check
     copter.wait_ready_to_arm()
@@ -1598,7 +3314,7 @@ def main():
 
     copter.move_ned(0,0,0)
     time.sleep(5)
-    targetpos = copter.mav.location()
+    targetpos = copter.location()
     print("Target Position: ", targetpos)
     # wp_accuracy = copter.get_parameter("WPNAV_RADIUS", attempts=2)
     # wp_accuracy = wp_accuracy * 0.01  # cm to m
@@ -1612,7 +3328,7 @@ def main():
         # while current_target.lat != targetpos.lat and current_target.lng != targetpos.lng and current_target.alt != targetpos.alt:
         #     current_target = copter.get_current_target()
 
-    # targetpos = copter.mav.location()
+    # targetpos = copter.location()
 
     # copter.mav.mav.set_position_target_global_int_send(
     #     0,  # timestamp
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""
+    Telemetry recorder for Copter.
+
+    Usage :
+    python recorder.py flight.tlog GLOBAL_POSITION_INT [t1 t2]
+"""
+
+import bisect
+import mmap
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+
+from pymavlink import mavutil
+
+import lookup
+
+INDEX_MAGIC = b'TIDX'
+INDEX_HEADER = struct.Struct('<4sI')
+# timestamp (us), message id, offset of the frame in the tlog
+INDEX_RECORD = struct.Struct('<QIQ')
+TLOG_TIMESTAMP = struct.Struct('>Q')
+
+
+class TelemetryRecorder:
+    """Write received frames to a tlog plus its .idx sidecar from a background thread.
+
+    The tlog is what MAVProxy and mavlogdump.py read: each frame follows its big-endian microsecond
+    timestamp. The sidecar holds one INDEX_RECORD per frame."""
+
+    def __init__(self, path, flush_interval=0.5):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.flush_interval = flush_interval
+        self.queue = queue.SimpleQueue()
+        self.tlog = None
+        self.index = None
+        self.offset = 0
+        self.thread = None
+        self.running = False
+        self.tokens = []
+
+    def record(self, msg):
+        """Bus callback: only queue the frame, the writer thread does the rest."""
+        timestamp = getattr(msg, '_timestamp', None)
+        if timestamp is None:
+            timestamp = time.time()
+        self.queue.put((round(timestamp * 1.0e6), msg.get_msgId(), msg.get_msgbuf()))
+
+    def start(self, bus):
+        """Open the files and record every message published on bus."""
+        self.tlog = open(self.path, 'wb')
+        self.index = open(self.index_path, 'wb')
+        self.index.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_RECORD.size))
+        self.offset = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.write_loop, name="tlog-writer", daemon=True)
+        self.thread.start()
+        self.tokens.append(bus.subscribe(None, self.record))
+
+    def stop(self, bus):
+        for token in self.tokens:
+            bus.unsubscribe(token)
+        self.tokens = []
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.tlog.close()
+        self.index.close()
+
+    def write_loop(self):
+        while True:
+            running = self.running
+            batch = []
+            try:
+                batch.append(self.queue.get(timeout=self.flush_interval))
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            if batch:
+                self.write_batch(batch)
+            if not running:
+                return
+
+    def write_batch(self, batch):
+        frames = []
+        records = []
+        for (usec, msgid, buf) in batch:
+            frames.append(TLOG_TIMESTAMP.pack(usec))
+            frames.append(buf)
+            records.append(INDEX_RECORD.pack(usec, msgid & 0xFFFFFFFF, self.offset))
+            self.offset += TLOG_TIMESTAMP.size + len(buf)
+        self.tlog.write(b''.join(frames))
+        self.index.write(b''.join(records))
+        self.tlog.flush()
+        self.index.flush()
+
+
+def build_index(path):
+    """Write the .idx sidecar of an existing tlog (for logs not written by TelemetryRecorder)."""
+    mlog = mavutil.mavlink_connection(path, robust_parsing=True)
+    records = []
+    while True:
+        offset = mlog.f.tell()
+        m = mlog.recv_msg()
+        if m is None:
+            break
+        if m.get_type() == 'BAD_DATA':
+            continue
+        records.append(INDEX_RECORD.pack(round(m._timestamp * 1.0e6), m.get_msgId(), offset))
+    mlog.close()
+    with open(path + '.idx', 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_RECORD.size))
+        f.write(b''.join(records))
+
+
+class TlogIndex:
+    """Memory-mapped view of a tlog and its .idx sidecar.
+
+    Records are in arrival order, so a time range is found with a bisect and the message id
+    filter is applied on the records, without parsing the frames we don't want."""
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path + '.idx'):
+            build_index(path)
+        self.tlog_file = open(path, 'rb')
+        self.index_file = open(path + '.idx', 'rb')
+        if os.path.getsize(path) > 0:
+            self.tlog = mmap.mmap(self.tlog_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # nothing was recorded; mmap can't map an empty file
+            self.tlog = b''
+        self.index = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, record_size) = INDEX_HEADER.unpack_from(self.index, 0)
+        if magic != INDEX_MAGIC or record_size != INDEX_RECORD.size:
+            raise ValueError("%s.idx is not a tlog index" % path)
+        self.count = (len(self.index) - INDEX_HEADER.size) // INDEX_RECORD.size
+        self.times = TimestampView(self)
+        self.parser = mavutil.mavlink.MAVLink(None)
+        self.parser.robust_parsing = True
+
+    def close(self):
+        if isinstance(self.tlog, mmap.mmap):
+            self.tlog.close()
+        self.index.close()
+        self.tlog_file.close()
+        self.index_file.close()
+
+    def record(self, i):
+        """Return (timestamp_us, msgid, offset) of record i."""
+        return INDEX_RECORD.unpack_from(self.index, INDEX_HEADER.size + i * INDEX_RECORD.size)
+
+    def position_at(self, t):
+        """Index of the first record at or after t (seconds since the epoch)."""
+        return bisect.bisect_left(self.times, round(t * 1.0e6))
+
+    def records(self, msg_types=None, t1=None, t2=None):
+        """Yield (timestamp_us, msgid, offset) between t1 and t2 (seconds, inclusive) for msg_types
+        (names or ids, None for all)."""
+        start = 0 if t1 is None else self.position_at(t1)
+        end = self.count if t2 is None else bisect.bisect_right(self.times, round(t2 * 1.0e6))
+        wanted = None
+        if msg_types is not None:
+            if not isinstance(msg_types, (list, set, tuple)):
+                msg_types = [msg_types]
+            wanted = set(lookup.message_id(t) for t in msg_types)
+        for i in range(start, end):
+            rec = self.record(i)
+            if wanted is None or rec[1] in wanted:
+                yield rec
+
+    def frame(self, offset):
+        """Raw MAVLink frame stored at offset in the tlog."""
+        start = offset + TLOG_TIMESTAMP.size
+        magic = self.tlog[start]
+        if magic == mavutil.mavlink.PROTOCOL_MARKER_V2:
+            length = self.tlog[start + 1] + mavutil.mavlink.HEADER_LEN_V2 + 2
+            if self.tlog[start + 2] & mavutil.mavlink.MAVLINK_IFLAG_SIGNED:
+                length += mavutil.mavlink.MAVLINK_SIGNATURE_BLOCK_LEN
+        else:
+            length = self.tlog[start + 1] + mavutil.mavlink.HEADER_LEN_V1 + 2
+        return self.tlog[start:start + length]
+
+    def messages(self, msg_types=None, t1=None, t2=None):
+        """Yield the parsed messages between t1 and t2 for msg_types; only those frames are decoded."""
+        for (usec, msgid, offset) in self.records(msg_types, t1, t2):
+            m = self.parser.decode(bytearray(self.frame(offset)))
+            m._timestamp = usec * 1.0e-6
+            yield m
+
+
+class TimestampView:
+    """Sequence of the index timestamps, for bisect."""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.count
+
+    def __getitem__(self, i):
+        return self.index.record(i)[0]
+
+
+if __name__ == "__main__":
+    index = TlogIndex(sys.argv[1])
+    t1 = t2 = None
+    if len(sys.argv) > 4:
+        t1 = float(sys.argv[3])
+        t2 = float(sys.argv[4])
+    for m in index.messages(sys.argv[2] if len(sys.argv) > 2 else None, t1, t2):
+        print("%.3f %s" % (m._timestamp, str(m)))
+    index.close()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""
+    Replay of a recorded tlog into a Copter, as if it were the live link.
+
+    Messages are delivered with their recorded spacing divided by speed (1x, Nx), or as fast
+    as possible when speed is None. In that last mode the replay waits for the Copter readers
+    of the receive buffer (recv_match) to consume what was already delivered, so no message is
+    lost to the buffer and a given log always produces the same sequence of messages. The waits
+    on the bus (predicates, trackers) see each message as it is delivered and never hold it back.
+    Everything the Copter sends is discarded. Note that the wait helpers timeouts stay in
+    wall-clock time, they are not scaled by speed.
+
+    Usage :
+    copter = Copter()
+    copter.connect_replay("flight.tlog", speed=10)
+    copter.wait_waypoint(1, 5)
+"""
+
+import os
+import struct
+import threading
+import time
+
+from pymavlink import mavutil
+
+
+class ReplayLink(mavutil.mavlogfile):
+    """A tlog reader paced like the live link it was recorded from."""
+
+    def __init__(self, path, speed=1.0, sysid=1, reader=None, reader_idle=0.5):
+        os.environ['MAVLINK20'] = '1'
+        mavutil.set_dialect("ardupilotmega")
+        mavutil.mavlogfile.__init__(self, path, robust_parsing=True, source_system=250, source_component=250)
+        self.target_system = sysid
+        self.speed = speed
+        self.reader = reader
+        self.reader_idle = reader_idle
+        self.start_log_time = None
+        self.start_wall_time = None
+        self.finished = threading.Event()
+
+    def write(self, buf):
+        """Commands to the recorded vehicle go nowhere."""
+        pass
+
+    def next_timestamp(self):
+        """Timestamp of the next frame in the log, None at the end."""
+        pos = self.f.tell()
+        tbuf = self.f.read(8)
+        self.f.seek(pos)
+        if len(tbuf) != 8:
+            return None
+        (tusec,) = struct.unpack('>Q', tbuf)
+        return tusec * 1.0e-6
+
+    def reader_is_behind(self):
+        """True while a Copter buffer reader has more than half the receive buffer left to read.
+        A reader blocked in recv_match is keeping up, and a Copter that has not read the buffer for
+        reader_idle seconds takes its messages from the bus."""
+        reader = self.reader
+        if reader is None or reader.rx_waiting > 0:
+            return False
+        if time.monotonic() - reader.rx_read_time > self.reader_idle:
+            return False
+        buf = reader.rx_buffer
+        return buf.cursor() - reader.rx_consumed > buf.size // 2
+
+    def wait_until(self, ready, deadline):
+        """Sleep until ready() or deadline (monotonic); return ready()."""
+        while not ready():
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                return False
+            time.sleep(0.001 if deadline is None else min(0.001, deadline - now))
+        return True
+
+    def recv_match(self, condition=None, type=None, blocking=False, timeout=None):
+        """Next recorded message of type once it is due; condition is a callable."""
+        if type is not None and not isinstance(type, (list, set)):
+            type = [type]
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            t = self.next_timestamp()
+            if t is None:
+                self.finished.set()
+                if blocking:
+                    time.sleep(0.1 if timeout is None else timeout)
+                return None
+            if self.speed is None:
+                if not blocking and self.reader_is_behind():
+                    return None
+                if not self.wait_until(lambda: not self.reader_is_behind(), deadline):
+                    return None
+            else:
+                if self.start_log_time is None:
+                    self.start_log_time = t
+                    self.start_wall_time = time.monotonic()
+                due = self.start_wall_time + (t - self.start_log_time) / self.speed
+                if not blocking and due > time.monotonic():
+                    return None
+                if deadline is not None and due > deadline:
+                    time.sleep(max(0.0, deadline - time.monotonic()))
+                    return None
+                time.sleep(max(0.0, due - time.monotonic()))
+            m = self.recv_msg()
+            if m is None:
+                continue
+            if type is not None and m.get_type() not in type:
+                continue
+            if condition is not None and not condition(m):
+                continue
+            return m
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""
+    Several vehicles sharing one MAVLink endpoint.
+
+    Usage :
+    router = LinkRouter("udpin:0.0.0.0:14550")
+    router.wait_vehicle(2)
+    copter2 = router.add_vehicle(2)
+"""
+
+import os
+import queue
+import threading
+import time
+
+from pymavlink import mavutil
+
+from main import Copter, HeartbeatScheduler, install_send_lock
+
+
+class RoutedLink:
+    """The part of a LinkRouter endpoint that belongs to one sysid.
+
+    Looks enough like a mavutil connection for Copter: received messages come from the router
+    queue of that sysid, the vehicle state comes from the shared connection state for that sysid,
+    and sends go through the shared socket."""
+
+    def __init__(self, router, sysid):
+        self.router = router
+        self.target_system = sysid
+        self.target_component = 1
+        self.queue = queue.SimpleQueue()
+        self.idle_hooks = []
+        self.mav = router.mav.mav
+
+    @property
+    def state(self):
+        states = self.router.mav.sysid_state
+        if self.target_system not in states:
+            states[self.target_system] = mavutil.mavfile_state()
+        return states[self.target_system]
+
+    @property
+    def messages(self):
+        return self.state.messages
+
+    @property
+    def flightmode(self):
+        return self.state.flightmode
+
+    def motors_armed(self):
+        return self.state.armed
+
+    def mode_mapping(self):
+        state = self.state
+        if state.mav_autopilot == mavutil.mavlink.MAV_AUTOPILOT_PX4:
+            return mavutil.px4_map
+        if state.mav_type is None:
+            return None
+        return mavutil.mode_mapping_byname(state.mav_type)
+
+    def recv_match(self, condition=None, type=None, blocking=False, timeout=None):
+        """Next routed message of type; condition is a callable like in Copter.recv_match."""
+        if type is not None and not isinstance(type, (list, set)):
+            type = [type]
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0.0, deadline - time.monotonic())
+            try:
+                m = self.queue.get(block=blocking, timeout=remaining)
+            except queue.Empty:
+                return None
+            if type is not None and m.get_type() not in type:
+                continue
+            if condition is not None and not condition(m):
+                continue
+            return m
+
+    def waypoint_clear_all_send(self):
+        self.mav.mission_clear_all_send(self.target_system, self.target_component)
+
+    def waypoint_count_send(self, seq):
+        self.mav.mission_count_send(self.target_system, self.target_component, seq)
+
+    def waypoint_request_list_send(self):
+        self.mav.mission_request_list_send(self.target_system, self.target_component)
+
+    def close(self):
+        self.router.remove_vehicle(self.target_system)
+
+
+class LinkRouter:
+    """One UDP/serial endpoint shared by several vehicles.
+
+    A single thread parses every frame once and hands it to the queue of its source sysid;
+    every Copter created by add_vehicle reads its own queue and sends through the shared socket.
+    The router sends the GCS heartbeats for all of them."""
+
+    def __init__(self, connection_string='udpin:0.0.0.0:14550', heartbeat_interval_ms=1000):
+        os.environ['MAVLINK20'] = '1'
+        self.mav = mavutil.mavlink_connection(
+            connection_string,
+            retries=1000,
+            robust_parsing=True,
+            source_system=250,
+            source_component=250,
+            autoreconnect=True,
+            dialect="ardupilotmega",
+        )
+        self.link_lock = threading.RLock()
+        install_send_lock(self.mav.mav, self.link_lock)
+        self.links = {}
+        self.systems_seen = set()
+        self.seen_condition = threading.Condition()
+        self.heartbeat = None
+        if heartbeat_interval_ms is not None:
+            self.heartbeat = HeartbeatScheduler(self.mav, self.link_lock, heartbeat_interval_ms * 0.001)
+            self.heartbeat.start()
+        self.running = True
+        self.thread = threading.Thread(target=self.route_loop, name="link-router", daemon=True)
+        self.thread.start()
+
+    def route_loop(self):
+        while self.running:
+            m = self.mav.recv_match(blocking=True, timeout=0.1)
+            if m is None or m.get_type() == 'BAD_DATA':
+                continue
+            sysid = m.get_srcSystem()
+            link = self.links.get(sysid)
+            if link is not None:
+                link.queue.put(m)
+            if sysid not in self.systems_seen:
+                with self.seen_condition:
+                    self.systems_seen.add(sysid)
+                    self.seen_condition.notify_all()
+
+    def vehicle_link(self, sysid):
+        """Return the RoutedLink of sysid, creating it if needed."""
+        link = self.links.get(sysid)
+        if link is None:
+            link = RoutedLink(self, sysid)
+            self.links[sysid] = link
+        return link
+
+    def remove_vehicle(self, sysid):
+        self.links.pop(sysid, None)
+
+    def add_vehicle(self, sysid, **kwargs):
+        """Create a Copter for sysid connected through this router. kwargs go to Copter()."""
+        copter = Copter(sysid=sysid, **kwargs)
+        copter.connect_via_router(self)
+        return copter
+
+    def wait_vehicle(self, sysid, timeout=3):
+        """Wait until sysid has been heard on the link; return False on timeout."""
+        with self.seen_condition:
+            return self.seen_condition.wait_for(lambda: sysid in self.systems_seen, timeout)
+
+    def close(self):
+        self.running = False
+        self.thread.join(2)
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+        self.mav.close()
@@ -0,0 +1,42 @@
+import itertools
+import os
+import sys
+
+import pytest
+
+# the Copter modules and the utilities live at the repository root
+root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_path)
+sys.path.append(os.path.join(root_path, "utilities"))
+from fake_vehicle import FakeVehicle
+from main import Copter
+
+ports = itertools.count(14700)
+
+
+@pytest.fixture
+def port():
+    return next(ports)
+
+
+@pytest.fixture
+def vehicle_and_copter(port):
+    """Start a FakeVehicle on a fresh local UDP port and connect a Copter to it.
+
+    The fake is built by the test through the returned start(**kwargs) function, so it can pick its
+    latency, loss and the other FakeVehicle options."""
+    started = []
+
+    def start(**kwargs):
+        vehicle = FakeVehicle("udpout:127.0.0.1:%u" % port, seed=0, **kwargs)
+        vehicle.start()
+        copter = Copter()
+        started.append((vehicle, copter))
+        copter.connect("udpin:127.0.0.1:%u" % port)
+        copter.wait_heartbeat()
+        return vehicle, copter
+
+    yield start
+    for (vehicle, copter) in started:
+        copter.close()
+        vehicle.stop()
@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+from pymavlink import mavutil
+
+from async_copter import AsyncCopter
+from fake_vehicle import FakeVehicle
+from main import WaitAltitudeTimout
+
+mavlink = mavutil.mavlink
+
+
+@pytest.fixture
+def vehicle(port):
+    vehicle = FakeVehicle("udpout:127.0.0.1:%u" % port, seed=0)
+    vehicle.start()
+    yield vehicle
+    vehicle.stop()
+
+
+def fly(port, script):
+    """Connect an AsyncCopter to the fake on port and run script(copter) in a fresh event loop."""
+    async def run():
+        copter = AsyncCopter()
+        await copter.connect("udpin:127.0.0.1:%u" % port)
+        try:
+            await copter.wait_heartbeat()
+            return await script(copter)
+        finally:
+            copter.close()
+
+    return asyncio.run(run())
+
+
+def test_run_cmd(vehicle, port):
+    async def script(copter):
+        await copter.run_cmd(mavlink.MAV_CMD_SET_MESSAGE_INTERVAL, mavlink.MAVLINK_MSG_ID_ATTITUDE, 100000,
+                             0, 0, 0, 0, 0, quiet=True)
+        with pytest.raises(ValueError):
+            await copter.run_cmd(mavlink.MAV_CMD_DO_FLIGHTTERMINATION, 1, 0, 0, 0, 0, 0, 0, quiet=True)
+
+    fly(port, script)
+    assert vehicle.rates['ATTITUDE'] == pytest.approx(10.0)
+
+
+def test_change_mode(vehicle, port):
+    async def script(copter):
+        await copter.change_mode("GUIDED", timeout=10)
+        return copter.flightmode
+
+    assert fly(port, script) == "GUIDED"
+
+
+def test_wait_altitude_subscribes_once(vehicle, port):
+    subscriptions = []
+
+    async def script(copter):
+        subscribe = copter.bus.subscribe
+
+        def counting_subscribe(msg_type, *args, **kwargs):
+            if msg_type == 'GLOBAL_POSITION_INT':
+                subscriptions.append(msg_type)
+            return subscribe(msg_type, *args, **kwargs)
+
+        copter.bus.subscribe = counting_subscribe
+        await copter.change_mode("GUIDED", timeout=10)
+        await copter.arm_vehicle()
+        await copter.run_cmd(mavlink.MAV_CMD_NAV_TAKEOFF, 0, 0, 0, 0, 0, 0, 5, quiet=True)
+        alt = await copter.wait_altitude(4, 10, relative=True, timeout=20, minimum_duration=0.5)
+        with pytest.raises(WaitAltitudeTimout):
+            await copter.wait_altitude(100, 110, relative=True, timeout=0.5)
+        return (alt, copter.bus.subscribers.get(mavlink.MAVLINK_MSG_ID_GLOBAL_POSITION_INT))
+
+    (alt, remaining) = fly(port, script)
+    assert 4 <= alt <= 10
+    assert subscriptions == ['GLOBAL_POSITION_INT'] * 2
+    assert not remaining
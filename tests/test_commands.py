@@ -0,0 +1,62 @@
+import time
+
+import pytest
+from pymavlink import mavutil
+
+from main import TimeoutException
+
+
+def test_long_running_command_outlives_its_timeout(vehicle_and_copter):
+    """MAV_RESULT_IN_PROGRESS ACKs push the timeout back until the final ACK."""
+    (vehicle, copter) = vehicle_and_copter()
+    vehicle.long_command_time = 5.0
+    tstart = time.monotonic()
+    copter.run_cmd(mavutil.mavlink.MAV_CMD_PREFLIGHT_CALIBRATION, 0, 0, 0, 0, 0, 0, 0, timeout=2, quiet=True)
+    assert time.monotonic() - tstart >= 4.5
+
+
+def test_long_running_command_progress_and_cancel(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter()
+    handle = copter.start_cmd(mavutil.mavlink.MAV_CMD_PREFLIGHT_CALIBRATION, 0, 0, 0, 0, 0, 0, 0, quiet=True)
+    ack = handle.next_update(timeout=2)
+    assert ack is not None and ack.result == mavutil.mavlink.MAV_RESULT_IN_PROGRESS
+    assert handle.in_progress and not handle.done()
+    handle.cancel()
+    with pytest.raises(ValueError):
+        copter.check_cmd_result(handle, quiet=True)
+
+
+def test_commands_overlap(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter(latency=0.05)
+    handles = [copter.start_cmd(mavutil.mavlink.MAV_CMD_GET_HOME_POSITION, 0, 0, 0, 0, 0, 0, 0, quiet=True),
+               copter.start_cmd(mavutil.mavlink.MAV_CMD_SET_MESSAGE_INTERVAL, 33, 100000, 0, 0, 0, 0, 0, quiet=True)]
+    for handle in handles:
+        assert handle.wait().result == mavutil.mavlink.MAV_RESULT_ACCEPTED
+
+
+def test_unanswered_command_times_out(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter()
+    vehicle.writer.loss = 1.0
+    handle = copter.start_cmd(mavutil.mavlink.MAV_CMD_GET_HOME_POSITION, 0, 0, 0, 0, 0, 0, 0, timeout=1, quiet=True)
+    with pytest.raises(TimeoutException):
+        handle.wait()
+
+
+def test_request_heartbeat_leaves_other_requests_alone(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter(latency=0.05)
+    handle = copter.start_cmd(mavutil.mavlink.MAV_CMD_REQUEST_MESSAGE,
+                              mavutil.mavlink.MAVLINK_MSG_ID_AUTOPILOT_VERSION, 0, 0, 0, 0, 0, 0, quiet=True)
+    seen = copter.modes.count
+    copter.request_heartbeat()
+    copter.check_cmd_result(handle, quiet=True)
+    assert copter.modes.wait(timeout=2, after=seen)
+
+
+def test_request_heartbeat_ack_is_not_taken_for_another_request(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter(latency=0.2)
+    copter.request_heartbeat()
+    # sent while the heartbeat request waits for its ACK
+    handle = copter.start_cmd(mavutil.mavlink.MAV_CMD_REQUEST_MESSAGE,
+                              mavutil.mavlink.MAVLINK_MSG_ID_AUTOPILOT_VERSION, 0, 0, 0, 0, 0, 0, quiet=True)
+    copter.check_cmd_result(handle, quiet=True)
+    assert copter.cache.get('AUTOPILOT_VERSION') is not None
@@ -0,0 +1,24 @@
+import pytest
+
+from ftp import FTPError, MAVFTPClient, decode_param_pck
+
+
+def test_read_param_pck_with_losses(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter(param_count=300, loss=0.05)
+    ftp = MAVFTPClient(copter.mav, copter.bus, copter.target_system)
+    (count, params) = decode_param_pck(ftp.read_file("@PARAM/param.pck", timeout=20))
+    assert count == len(vehicle.param_names)
+    assert [name for (name, value) in params] == vehicle.param_names
+    assert dict(params)["BENCH_P0123"] == 123.0
+
+
+def test_missing_file(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter()
+    ftp = MAVFTPClient(copter.mav, copter.bus, copter.target_system)
+    with pytest.raises(FTPError):
+        ftp.read_file("@PARAM/nothing.pck", timeout=5)
+
+
+def test_bad_magic():
+    with pytest.raises(FTPError):
+        decode_param_pck(b'\x00\x00\x01\x00\x01\x00')
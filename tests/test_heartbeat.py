@@ -0,0 +1,24 @@
+import time
+
+
+def test_heartbeats_keep_their_cadence_on_a_quiet_link(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter()
+    sent = []
+    copter.mav.mav.set_send_callback(lambda msg: sent.append((time.monotonic(), msg.get_type())))
+    copter.heartbeat.interval = 0.1
+    # the scheduler may still be asleep on the old 1s interval, the new one starts after its next beat
+    deadline = time.monotonic() + 2
+    while 'HEARTBEAT' not in [mtype for (t, mtype) in sent] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # the vehicle goes silent: nothing is received, the heartbeats go on
+    vehicle.writer.loss = 1.0
+    time.sleep(0.3)
+    start = vehicle.received['HEARTBEAT']
+    time.sleep(1.0)
+    assert 7 <= vehicle.received['HEARTBEAT'] - start <= 13
+    # the send callback sees the pre-encoded heartbeats, at a steady spacing
+    beats = [t for (t, mtype) in sent if mtype == 'HEARTBEAT']
+    gaps = [t2 - t1 for (t1, t2) in zip(beats, beats[1:])]
+    assert len(beats) >= 10
+    assert 0.08 < sum(gaps[1:]) / len(gaps[1:]) < 0.12
+    assert max(gaps[1:]) < 0.3
@@ -0,0 +1,118 @@
+import threading
+
+import pytest
+from pymavlink import mavutil
+
+from main import Copter, MissionTracker, WaitWaypointTimeout
+
+mavlink = mavutil.mavlink
+
+
+def current(seq):
+    return mavlink.MAVLink_mission_current_message(seq)
+
+
+def reached(seq):
+    return mavlink.MAVLink_mission_item_reached_message(seq)
+
+
+def heartbeat(custom_mode):
+    return mavlink.MAVLink_heartbeat_message(mavlink.MAV_TYPE_QUADROTOR, mavlink.MAV_AUTOPILOT_ARDUPILOTMEGA,
+                                             mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED, custom_mode, 0, 3)
+
+
+def arrivals(messages):
+    tracker = MissionTracker()
+    for m in messages:
+        tracker.update(m)
+    return tracker.arrivals_since(0)
+
+
+def test_reported_arrivals():
+    assert arrivals([current(1), reached(1), current(2), reached(2), current(3)]) == [1, 2]
+
+
+def test_lost_arrival_is_inferred():
+    assert arrivals([current(1), current(2), reached(2), current(3)]) == [1, 2]
+
+
+def test_late_arrival_is_counted_once():
+    # MISSION_ITEM_REACHED 1 repeated after item 2 became current
+    assert arrivals([current(1), reached(1), current(2), reached(1), reached(2), current(3)]) == [1, 2]
+
+
+def test_late_arrival_after_inference_is_counted_once():
+    assert arrivals([current(1), current(2), reached(1), current(3)]) == [1, 2]
+
+
+def test_looping_mission_counts_every_lap():
+    assert arrivals([current(1), reached(1), current(2), reached(2),
+                     current(1), reached(1), current(2), reached(2)]) == [1, 2, 1, 2]
+
+
+def test_lap_times():
+    tracker = MissionTracker()
+    for (m, timestamp) in [(current(1), 10), (reached(1), 11), (current(2), 12), (current(1), 13),
+                           (reached(1), 15.5)]:
+        m._timestamp = timestamp
+        tracker.update(m)
+    assert tracker.lap_times(1) == [4.5]
+
+
+def test_wait_waypoint_before_the_first_heartbeat():
+    copter = Copter()
+    copter.mission.update(current(1))
+
+    def fly():
+        copter.mission.update(reached(1))
+        copter.mission.update(current(2))
+        copter.mission.update(reached(2))
+
+    # the mode to keep is the AUTO of the first heartbeat, not "no mode yet"
+    timers = [threading.Timer(0.2, copter.modes.update, [heartbeat(3)]), threading.Timer(0.5, fly)]
+    for timer in timers:
+        timer.start()
+    try:
+        assert copter.wait_waypoint(1, 2, timeout=5)
+    finally:
+        for timer in timers:
+            timer.cancel()
+
+
+def mission_item(seq, command, north=0.0, alt=10.0):
+    """An item north metres north of the fake vehicle home; 0 keeps the current position."""
+    (lat, lon) = (0, 0)
+    if north:
+        (lat, lon) = (int((-35.363261 + north / 111319.5) * 1.0e7), int(149.165230 * 1.0e7))
+    return mavlink.MAVLink_mission_item_int_message(1, 1, seq, mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT, command,
+                                                    0, 1, 0, 0, 0, 0, lat, lon, alt)
+
+
+def test_fly_mission_with_losses(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter(loss=0.1)
+    vehicle.speed = 20.0
+    vehicle.mission = [mission_item(0, mavlink.MAV_CMD_NAV_WAYPOINT, alt=0),
+                       mission_item(1, mavlink.MAV_CMD_NAV_TAKEOFF),
+                       mission_item(2, mavlink.MAV_CMD_NAV_WAYPOINT, north=20.0),
+                       mission_item(3, mavlink.MAV_CMD_NAV_WAYPOINT, north=40.0),
+                       # a loss on the last item could never be inferred, so item 3 is not the last
+                       mission_item(4, mavlink.MAV_CMD_NAV_WAYPOINT, north=80.0)]
+    copter.change_mode("GUIDED")
+    copter.arm_vehicle()
+    first = len(copter.mission.arrivals)
+    copter.change_mode("AUTO")
+    copter.wait_reached(3, timeout=20)
+    # lost MISSION_ITEM_REACHED are inferred, repeated ones are not counted twice
+    assert copter.mission.arrivals_since(first)[:3] == [1, 2, 3]
+
+
+def test_abandoned_reached_waits_are_forgotten():
+    copter = Copter()
+    with pytest.raises(WaitWaypointTimeout):
+        copter.wait_reached(2, timeout=0.1)
+    assert copter.mission.waiters == {}
+    future = copter.mission.reached(3)
+    copter.mission.update(current(3))
+    copter.mission.update(reached(3))
+    assert future.result(timeout=1) is not None
+    assert copter.mission.waiters == {}
@@ -0,0 +1,101 @@
+import json
+import threading
+import time
+
+from pymavlink import mavutil
+
+from main import ParameterStore
+
+
+def param_value(index, count=3):
+    name = "P%u" % index
+    return mavutil.mavlink.MAVLink_param_value_message(name.encode('ascii'), float(index),
+                                                       mavutil.mavlink.MAV_PARAM_TYPE_REAL32, count, index)
+
+
+class LossyParameterLink:
+    """Answers PARAM_REQUEST_LIST without index 2 and PARAM_REQUEST_READ normally, while index 0
+    keeps coming back every 50ms, so the link is never quiet."""
+
+    def __init__(self, store):
+        self.mav = self
+        self.store = store
+        self.reads = []
+        self.running = True
+        self.thread = threading.Thread(target=self.chatter, daemon=True)
+        self.thread.start()
+
+    def chatter(self):
+        while self.running:
+            self.store.update(param_value(0))
+            time.sleep(0.05)
+
+    def param_request_list_send(self, target_system, target_component):
+        for index in (0, 1):
+            self.store.update(param_value(index))
+
+    def param_request_read_send(self, target_system, target_component, name, index):
+        self.reads.append(index)
+        if len(self.reads) > 1:
+            # the first read is lost too
+            self.store.update(param_value(index))
+
+
+def test_fetch_all_retransmits_while_the_link_is_busy():
+    store = ParameterStore()
+    link = LossyParameterLink(store)
+    try:
+        tstart = time.monotonic()
+        assert store.fetch_all(link, 1, timeout=10)
+        assert time.monotonic() - tstart < 3
+        assert link.reads == [2, 2]
+    finally:
+        link.running = False
+        link.thread.join()
+
+
+def test_fetch_and_set_parameters(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter(param_count=100, loss=0.05)
+    copter.fetch_parameters(cache_dir=None)
+    assert copter.parameters.complete()
+    assert copter.parameters.get("BENCH_P0042") == 42.0
+    copter.set_parameters({"BENCH_P%04u" % i: 1000.0 + i for i in range(20)}, verbose=False)
+    assert vehicle.parameters["BENCH_P0007"] == 1007.0
+    assert copter.parameters.get("BENCH_P0019") == 1019.0
+
+
+def test_snapshot_is_written_on_fetch_and_close(vehicle_and_copter, tmp_path):
+    (vehicle, copter) = vehicle_and_copter(param_count=10)
+    copter.fetch_parameters(cache_dir=str(tmp_path))
+    path = copter.parameter_snapshot_file
+    with open(path) as f:
+        assert json.load(f)["values"]["BENCH_P0003"] == 3.0
+    copter.set_parameters({"BENCH_P0003": 33.0}, verbose=False)
+    assert copter.parameters.get("BENCH_P0003") == 33.0
+    with open(path) as f:
+        assert json.load(f)["values"]["BENCH_P0003"] == 3.0
+    copter.close()
+    with open(path) as f:
+        assert json.load(f)["values"]["BENCH_P0003"] == 33.0
+
+
+def test_apply_parameter_file(vehicle_and_copter, tmp_path):
+    (vehicle, copter) = vehicle_and_copter(param_count=10)
+    copter.fetch_parameters(cache_dir=None)
+    path = str(tmp_path / "tune.parm")
+    with open(path, "w") as f:
+        f.write("# tuning\nBENCH_P0001 1\nBENCH_P0002 22.5\nBENCH_P0003,33\nNOT_A_PARAM 5\n")
+    report = copter.apply_parameter_file(path, dry_run=True)
+    assert report.changed == {"BENCH_P0002": (2.0, 22.5), "BENCH_P0003": (3.0, 33.0)}
+    assert report.unchanged == ["BENCH_P0001"]
+    assert report.unknown == ["NOT_A_PARAM"]
+    assert vehicle.parameters["BENCH_P0002"] == 2.0
+    report = copter.apply_parameter_file(path, verbose=False)
+    assert str(report).startswith("%s: 2 changed, 1 unchanged, 1 unknown" % path)
+    assert vehicle.parameters["BENCH_P0002"] == 22.5
+    assert vehicle.parameters["BENCH_P0003"] == 33.0
+    assert "NOT_A_PARAM" not in vehicle.parameters
+    # applied once, the file is now all unchanged
+    report = copter.apply_parameter_file(path)
+    assert report.changed == {}
+    assert report.unchanged == ["BENCH_P0001", "BENCH_P0002", "BENCH_P0003"]
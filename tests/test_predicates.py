@@ -0,0 +1,111 @@
+import threading
+
+import pytest
+from pymavlink import mavutil
+
+from main import Copter, ErrorException, NotAchievedException, Predicate, WaitAltitudeTimout, WaitGuardException
+
+mavlink = mavutil.mavlink
+
+
+def bus_copter():
+    """A Copter whose bus is fed by the test."""
+    copter = Copter()
+    copter.predicates.start(copter.bus, 1)
+    return copter
+
+
+def system_time(usec):
+    m = mavlink.MAVLink_system_time_message(usec, 0)
+    m._header.srcSystem = 1
+    return m
+
+
+def time_predicate(usec, timeout=30):
+    return Predicate("Time", "above %u" % usec, 'SYSTEM_TIME', lambda m: m.time_unix_usec,
+                     lambda value, m: value > usec, timeout=timeout, exception=NotAchievedException)
+
+
+def publish_later(copter, messages, delay=0.2):
+    def publish():
+        for m in messages:
+            copter.bus.publish(m)
+    timer = threading.Timer(delay, publish)
+    timer.start()
+    return timer
+
+
+def test_wait_all_keeps_the_predicate_timeouts():
+    copter = bus_copter()
+    predicates = [time_predicate(1), time_predicate(2, timeout=None)]
+    publish_later(copter, [system_time(5)])
+    assert copter.wait_all(*predicates, timeout=5) == [5, 5]
+    assert [predicate.timeout for predicate in predicates] == [30, None]
+
+
+def test_wait_all_times_out():
+    copter = bus_copter()
+    with pytest.raises(NotAchievedException):
+        copter.wait_all(time_predicate(1), time_predicate(10), timeout=0.5)
+
+
+def test_guard_aborts_the_wait():
+    copter = bus_copter()
+    guard = time_predicate(3)
+    publish_later(copter, [system_time(2), system_time(4)])
+    with pytest.raises(WaitGuardException):
+        copter.wait_all(time_predicate(10), timeout=5, guards=[guard])
+    assert guard.timeout == 30
+
+
+def test_cancelled_wait_fails_cleanly():
+    copter = bus_copter()
+    timer = threading.Timer(0.2, copter.predicates.cancel_all)
+    timer.start()
+    with pytest.raises(ErrorException, match="cancelled"):
+        copter.wait_any(time_predicate(1), time_predicate(2), timeout=5)
+
+
+def fly_guided(vehicle, copter, alt=10.0):
+    vehicle.speed = 20.0
+    copter.change_mode("GUIDED")
+    copter.arm_vehicle()
+    copter.run_cmd(mavlink.MAV_CMD_NAV_TAKEOFF, 0, 0, 0, 0, 0, 0, alt, quiet=True)
+
+
+def test_altitude_distance_and_location(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter()
+    fly_guided(vehicle, copter)
+    samples = []
+    copter.wait_altitude(9, 11, relative=True, timeout=10, minimum_duration=0.5,
+                         called_function=lambda value, target: samples.append(value))
+    assert samples and all(value <= 11 for value in samples)
+    # fly 40m north
+    vehicle.target = [40.0, 0.0, -10.0]
+    assert 35 <= copter.wait_distance_to_home(35, 45, timeout=10) <= 45
+    north = mavutil.location(vehicle.home[0] + 40.0 / 111319.5, vehicle.home[1], 0, 0)
+    copter.wait_location(north, accuracy=2, timeout=10)
+
+
+def test_altitude_timeout(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter()
+    with pytest.raises(WaitAltitudeTimout):
+        copter.wait_altitude(50, 60, relative=True, timeout=1)
+
+
+def test_called_function_errors_fail_the_wait(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter()
+
+    def broken(value, target):
+        raise ValueError("broken")
+
+    with pytest.raises(ValueError):
+        copter.wait_altitude(-1, 1, relative=True, timeout=5, called_function=broken)
+
+    def blocking(value, target):
+        copter.recv_match(type='HEARTBEAT', blocking=True)
+
+    # blocking on the receive thread would deadlock it
+    with pytest.raises(ErrorException, match="receive thread"):
+        copter.wait_altitude(-1, 1, relative=True, timeout=5, called_function=blocking)
+    copter.wait_heartbeat()
@@ -0,0 +1,39 @@
+import pytest
+from pymavlink import mavutil
+
+from main import LinkBudgetException, MessageRatePlan
+
+mavlink = mavutil.mavlink
+
+
+def test_rate_plan_intervals():
+    plan = MessageRatePlan({'ATTITUDE': 20, 'VFR_HUD': 0})
+    assert plan.interval_us(mavlink.MAVLINK_MSG_ID_ATTITUDE) == 50000
+    assert plan.interval_us(mavlink.MAVLINK_MSG_ID_VFR_HUD) == -1
+    # ArduPilot keeps milliseconds
+    assert plan.matches(mavlink.MAVLINK_MSG_ID_ATTITUDE, 50999)
+    assert not plan.matches(mavlink.MAVLINK_MSG_ID_ATTITUDE, 100000)
+    assert plan.matches(mavlink.MAVLINK_MSG_ID_VFR_HUD, 0)
+
+
+def test_rate_plan_budget():
+    plan = MessageRatePlan({'ATTITUDE': 10})
+    # the 1Hz vehicle heartbeat plus 10 full ATTITUDE frames
+    heartbeat = 10 + 9 + 2
+    attitude = 10 + 28 + 2
+    assert plan.bytes_per_second() == heartbeat + 10 * attitude
+    assert MessageRatePlan({'ATTITUDE': 10}, signed=True).bytes_per_second() == (heartbeat + 13) + 10 * (attitude + 13)
+    assert plan.check_budget(57600) == plan.bytes_per_second()
+    with pytest.raises(LinkBudgetException, match="ATTITUDE"):
+        MessageRatePlan({'ATTITUDE': 200, 'GLOBAL_POSITION_INT': 200}).check_budget(57600)
+
+
+def test_apply_rate_plan(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter(latency=0.02, loss=0.1)
+    confirmed = copter.apply_rate_plan({'ATTITUDE': 20, 'VFR_HUD': 2, 'GPS_RAW_INT': 0}, timeout=10)
+    assert set(confirmed) == {mavlink.MAVLINK_MSG_ID_ATTITUDE, mavlink.MAVLINK_MSG_ID_VFR_HUD,
+                              mavlink.MAVLINK_MSG_ID_GPS_RAW_INT}
+    assert vehicle.rates['ATTITUDE'] == 20
+    assert vehicle.rates['GPS_RAW_INT'] == 0
+    # every other stream is stopped
+    assert vehicle.rates['SYS_STATUS'] == 0
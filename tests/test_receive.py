@@ -0,0 +1,136 @@
+import threading
+
+from pymavlink import mavutil
+
+from main import Copter
+
+
+def buffered_copter():
+    """A Copter whose receive buffer is filled by the test instead of a receive thread."""
+    copter = Copter()
+    copter.rx_thread = threading.Thread()
+    return copter
+
+
+def heartbeat():
+    return mavutil.mavlink.MAVLink_heartbeat_message(2, 3, 0, 0, 0, 3)
+
+
+def system_time(usec):
+    return mavutil.mavlink.MAVLink_system_time_message(usec, 0)
+
+
+def test_other_types_stay_buffered():
+    copter = buffered_copter()
+    # a type asked for the first time only matches what comes next
+    assert copter.recv_match(type='SYSTEM_TIME') is None
+    copter.rx_buffer.append(system_time(1))
+    assert copter.recv_match(type='SYSTEM_TIME').time_unix_usec == 1
+    copter.rx_buffer.append(system_time(2))
+    copter.rx_buffer.append(heartbeat())
+    copter.rx_buffer.append(system_time(3))
+    assert copter.recv_match(type='HEARTBEAT', since=copter.rx_buffer.oldest()) is not None
+    # waiting for the HEARTBEAT did not throw away the SYSTEM_TIME buffered before it
+    assert copter.recv_match(type='SYSTEM_TIME').time_unix_usec == 2
+    assert copter.recv_match(type='SYSTEM_TIME').time_unix_usec == 3
+    assert copter.recv_match(type='SYSTEM_TIME') is None
+
+
+def test_threads_read_independently():
+    copter = buffered_copter()
+    assert copter.recv_match(type='SYSTEM_TIME') is None
+    for usec in range(3):
+        copter.rx_buffer.append(system_time(usec))
+    seen = []
+
+    def read():
+        seen.append(copter.recv_match(type='SYSTEM_TIME'))
+        copter.rx_buffer.append(system_time(3))
+        seen.append(copter.recv_match(type='SYSTEM_TIME').time_unix_usec)
+
+    thread = threading.Thread(target=read)
+    thread.start()
+    thread.join()
+    # a new thread starts at the newest message, not at the oldest buffered one
+    assert seen == [None, 3]
+    assert [copter.recv_match(type='SYSTEM_TIME').time_unix_usec for i in range(4)] == [0, 1, 2, 3]
+
+
+def test_current_value_reads_are_fresh():
+    copter = buffered_copter()
+    copter.rx_buffer.append(system_time(0))
+    assert copter.recv_match(type='SYSTEM_TIME', since=copter.rx_buffer.oldest()).time_unix_usec == 0
+    for usec in range(1, 100):
+        copter.rx_buffer.append(system_time(usec))
+    timer = threading.Timer(0.1, copter.rx_buffer.append, [system_time(100)])
+    timer.start()
+    m = copter.recv_match(type='SYSTEM_TIME', blocking=True, timeout=2, since=copter.rx_buffer.cursor())
+    assert m.time_unix_usec == 100
+
+
+def test_drain_skips_everything_buffered():
+    copter = buffered_copter()
+    assert copter.recv_match(type='SYSTEM_TIME') is None
+    copter.rx_buffer.append(system_time(1))
+    copter.drain_mav_unparsed()
+    timer = threading.Timer(0.1, copter.rx_buffer.append, [system_time(2)])
+    timer.start()
+    assert copter.recv_match(type='SYSTEM_TIME', blocking=True, timeout=2).time_unix_usec == 2
+
+
+def test_message_hook_installed_twice_fires_once():
+    copter = Copter()
+    calls = []
+
+    def hook(mav, m):
+        calls.append(m.get_type())
+
+    copter.install_message_hook(hook, 'SYSTEM_TIME')
+    copter.install_message_hook(hook, 'HEARTBEAT')
+    copter.bus.publish(system_time(1))
+    copter.bus.publish(heartbeat())
+    assert calls == ['HEARTBEAT']
+    # remove_message_hook is a no-op before connect
+    copter.mav = object()
+    copter.remove_message_hook(hook)
+    copter.bus.publish(heartbeat())
+    assert calls == ['HEARTBEAT']
+
+
+def test_failing_hook_does_not_stop_the_receive_thread(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter()
+    calls = []
+
+    def bad(mav, m):
+        calls.append(m)
+        raise RuntimeError("broken hook")
+
+    copter.install_message_hook(bad, 'ATTITUDE')
+    copter.install_message_hook(lambda mav, m: calls.append(m), 'ATTITUDE')
+    copter.wait_heartbeat()
+    copter.wait_heartbeat()
+    assert copter.rx_thread.is_alive()
+    assert copter.bus.errors > 0
+    # the second hook still got every message
+    assert len(calls) >= 2 * copter.bus.errors
+
+
+def test_cache_sequence_and_wait_newer():
+    copter = Copter()
+    assert copter.cache.wait_newer('SYSTEM_TIME', 0, timeout=0.05) == (None, 0)
+    copter.cache.update(system_time(1))
+    (m, sequence) = copter.cache.wait_newer('SYSTEM_TIME', 0, timeout=1)
+    assert (m.time_unix_usec, sequence) == (1, 1)
+    timer = threading.Timer(0.1, copter.cache.update, [system_time(2)])
+    timer.start()
+    (m, sequence) = copter.cache.wait_newer('SYSTEM_TIME', sequence, timeout=2)
+    assert (m.time_unix_usec, sequence) == (2, 2)
+
+
+def test_receive_thread_fills_the_cache(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter()
+    assert copter.rx_thread.is_alive()
+    sequence = copter.cache.sequence.get('ATTITUDE', 0)
+    (m, newer) = copter.cache.wait_newer('ATTITUDE', sequence, timeout=2)
+    assert m is not None and newer > sequence
+    assert m.get_srcSystem() == copter.target_system
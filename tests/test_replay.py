@@ -0,0 +1,68 @@
+import struct
+import threading
+import time
+
+from pymavlink import mavutil
+
+from main import Copter
+
+
+def write_tlog(path, count):
+    """A tlog of count SYSTEM_TIME messages from system 1, 10ms apart, numbered by time_unix_usec."""
+    mav = mavutil.mavlink.MAVLink(None, srcSystem=1, srcComponent=1)
+    with open(path, 'wb') as f:
+        for i in range(count):
+            buf = mavutil.mavlink.MAVLink_system_time_message(i, 0).pack(mav)
+            f.write(struct.pack('>Q', 1000000 + i * 10000) + buf)
+
+
+def replay(path):
+    copter = Copter()
+    copter.connect_replay(path, speed=None)
+    return copter
+
+
+def stop(copter):
+    copter.commands.stop(copter.bus)
+    copter.stop_receive_thread()
+
+
+def test_bus_reader_gets_the_whole_log(tmp_path):
+    path = str(tmp_path / "flight.tlog")
+    write_tlog(path, 3 * 4096)
+    copter = Copter()
+    seen = []
+    done = threading.Event()
+
+    def on_time(m):
+        seen.append(m.time_unix_usec)
+        if len(seen) == 3 * 4096:
+            done.set()
+
+    copter.bus.subscribe('SYSTEM_TIME', on_time)
+    copter.connect_replay(path, speed=None)
+    # a recv_match before the bus waits must not hold the replay back once it stops reading
+    assert copter.recv_match(type='SYSTEM_TIME', blocking=True, timeout=5) is not None
+    try:
+        assert done.wait(20)
+        assert seen == list(range(3 * 4096))
+    finally:
+        stop(copter)
+
+
+def test_buffer_reader_loses_nothing(tmp_path):
+    path = str(tmp_path / "flight.tlog")
+    write_tlog(path, 3 * 4096)
+    copter = replay(path)
+    try:
+        # the first read goes back to the start of the log
+        since = copter.rx_buffer.oldest()
+        for i in range(3 * 4096):
+            m = copter.recv_match(type='SYSTEM_TIME', blocking=True, timeout=5, since=since)
+            since = None
+            assert m.time_unix_usec == i
+            if i % 1000 == 0:
+                # a slow reader is waited for
+                time.sleep(0.1)
+    finally:
+        stop(copter)
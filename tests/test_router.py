@@ -0,0 +1,26 @@
+from fake_vehicle import FakeVehicle
+from router import LinkRouter
+
+
+def test_router_splits_the_vehicles(port):
+    router = LinkRouter("udpin:127.0.0.1:%u" % port)
+    vehicles = [FakeVehicle("udpout:127.0.0.1:%u" % port, sysid=sysid, seed=0) for sysid in (2, 3)]
+    for vehicle in vehicles:
+        vehicle.start()
+    copter = None
+    try:
+        assert router.wait_vehicle(2) and router.wait_vehicle(3)
+        link3 = router.vehicle_link(3)
+        m = link3.recv_match(type='HEARTBEAT', blocking=True, timeout=3)
+        assert m is not None and m.get_srcSystem() == 3
+        copter = router.add_vehicle(2)
+        copter.wait_heartbeat()
+        m = copter.recv_match(type='SYSTEM_TIME', blocking=True, timeout=3)
+        assert m is not None and m.get_srcSystem() == 2
+        assert all(m.get_srcSystem() == 3 for m in iter(lambda: link3.recv_match(), None))
+    finally:
+        if copter is not None:
+            copter.close()
+        router.close()
+        for vehicle in vehicles:
+            vehicle.stop()
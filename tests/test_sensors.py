@@ -0,0 +1,61 @@
+import pytest
+from pymavlink import mavutil
+
+from main import NotAchievedException, SensorHealth
+
+mavlink = mavutil.mavlink
+
+GYRO = mavlink.MAV_SYS_STATUS_SENSOR_3D_GYRO
+MAG = mavlink.MAV_SYS_STATUS_SENSOR_3D_MAG
+GPS = mavlink.MAV_SYS_STATUS_SENSOR_GPS
+
+
+def sys_status(present, enabled, health, timestamp):
+    m = mavlink.MAVLink_sys_status_message(present, enabled, health, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    m._timestamp = timestamp
+    return m
+
+
+def test_state_is_a_mask_test_on_the_snapshot():
+    sensors = SensorHealth()
+    assert not sensors.has_snapshot()
+    assert not sensors.has_state(GYRO)
+    sensors.update(sys_status(GYRO | GPS, GYRO | GPS, GYRO, 1.0))
+    assert sensors.has_state(GYRO)
+    assert not sensors.has_state(GPS)
+    assert not sensors.has_state(GYRO | GPS)
+    assert sensors.state_error(GPS) == "not healthy"
+    assert sensors.state_error(GPS, healthy=False) is None
+    assert sensors.state_error(MAG) == "not present"
+    assert sensors.state_error(MAG, present=False, enabled=False, healthy=False) is None
+    assert sensors.state_error(GYRO, present=False) == "present when it shouldn't be"
+
+
+def test_only_changed_bits_make_events():
+    sensors = SensorHealth()
+    gps_changes = []
+    sensors.subscribe(lambda *change: gps_changes.append(change), sensors=GPS)
+    sensors.update(sys_status(GYRO | GPS, GYRO | GPS, GYRO, 1.0))
+    # the first snapshot reports every set bit
+    assert len(sensors.history) == 5
+    assert gps_changes == [(1.0, 'present', GPS, True), (1.0, 'enabled', GPS, True)]
+    sensors.update(sys_status(GYRO | GPS, GYRO | GPS, GYRO, 2.0))
+    assert len(sensors.history) == 5
+    sensors.update(sys_status(GYRO | GPS, GYRO | GPS, GYRO | GPS, 3.0))
+    sensors.update(sys_status(GYRO | GPS, GYRO | GPS, GPS, 4.0))
+    assert gps_changes[2:] == [(3.0, 'health', GPS, True)]
+    assert sensors.timeline(GYRO | GPS)[-2:] == [(3.0, 'health', 'MAV_SYS_STATUS_SENSOR_GPS', True),
+                                                 (4.0, 'health', 'MAV_SYS_STATUS_SENSOR_3D_GYRO', False)]
+
+
+def test_sensor_has_state(vehicle_and_copter):
+    (vehicle, copter) = vehicle_and_copter()
+    assert copter.sensor_has_state(GPS | GYRO)
+    assert copter.sensor_has_state(mavlink.MAV_SYS_STATUS_SENSOR_PROPULSION, present=False, enabled=False,
+                                   healthy=False)
+    vehicle.sensors_health &= ~GPS
+    assert copter.sensors.wait(lambda: not copter.sensors.has_state(GPS), 5)
+    assert not copter.sensor_has_state(GPS)
+    assert copter.sensor_has_state(GYRO)
+    with pytest.raises(NotAchievedException):
+        copter.sensor_has_state(GPS, do_assert=True)
@@ -0,0 +1,271 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+
+from pymavlink import mavutil
+
+# add this folder and the Copter one to the path
+utilities_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(utilities_path)
+sys.path.append(os.path.dirname(utilities_path))
+from fake_vehicle import FakeVehicle, DEFAULT_RATES
+from main import Copter
+
+
+def summarize(samples, scale=1000.0):
+    """
+    summarize reduces a list of durations to the statistics we track.
+
+    Args:
+        samples (List[float]): Durations in seconds.
+        scale (float, optional): Multiplier applied to the durations. Defaults to 1000 (milliseconds).
+
+    Returns:
+        Dict[str, float]: count, mean, min, p50, p99 and max of the samples.
+    """
+    if len(samples) == 0:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(pct):
+        # nearest rank
+        rank = max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1)
+        return ordered[min(rank, len(ordered) - 1)] * scale
+
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered) * scale,
+        "min": ordered[0] * scale,
+        "p50": percentile(50),
+        "p99": percentile(99),
+        "max": ordered[-1] * scale,
+    }
+
+
+def timed(function, iterations):
+    """Call function() iterations times and return the list of durations in seconds."""
+    samples = []
+    for i in range(iterations):
+        tstart = time.perf_counter()
+        function(i)
+        samples.append(time.perf_counter() - tstart)
+    return samples
+
+
+class CopterBenchmark:
+    """
+    Runs Copter protocol operations against a FakeVehicle on a local UDP port.
+
+    Args:
+        port (int, optional): Local UDP port used between the Copter and the fake vehicle.
+        latency (float, optional): One-way latency added by the fake vehicle in seconds.
+        loss (float, optional): Packet loss probability of the fake vehicle.
+        quick (bool, optional): Run fewer iterations and smaller sizes.
+        verbose (bool, optional): Keep the Copter progress output.
+    """
+
+    def __init__(self, port=14600, latency=0.0, loss=0.0, quick=False, verbose=False):
+        self.port = port
+        self.latency = latency
+        self.loss = loss
+        self.quick = quick
+        self.verbose = verbose
+        self.vehicle = None
+        self.copter = None
+        self.results = {}
+
+    def setup(self):
+        self.vehicle = FakeVehicle("udpout:127.0.0.1:%u" % self.port, param_count=500,
+                                   latency=self.latency, loss=self.loss, seed=0)
+        self.vehicle.start()
+        self.copter = Copter()
+        self.copter.connect("udpin:127.0.0.1:%u" % self.port)
+        self.copter.wait_heartbeat()
+
+    def teardown(self):
+        self.copter.stop_receive_thread()
+        self.copter.stop_heartbeats()
+        self.copter.mav.close()
+        self.vehicle.stop()
+
+    def quiet(self):
+        """Silence the Copter progress output while measuring, unless verbose."""
+        if self.verbose:
+            return contextlib.nullcontext()
+        return contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+    def record(self, name, samples, **extra):
+        result = summarize(samples)
+        result.update(extra)
+        self.results[name] = result
+        sys.stderr.write("%-40s p50=%.3fms p99=%.3fms\n" % (name, result.get("p50", 0), result.get("p99", 0)))
+
+    def run(self):
+        self.setup()
+        try:
+            with self.quiet():
+                self.bench_run_cmd()
+                self.bench_get_parameter()
+                self.bench_set_parameters()
+                self.bench_change_mode()
+                self.bench_move_ned()
+                self.bench_waypoints()
+                self.bench_receive()
+            self.bench_parse()
+        finally:
+            self.teardown()
+        return self.results
+
+    def bench_run_cmd(self):
+        msgid = mavutil.mavlink.MAVLINK_MSG_ID_SYSTEM_TIME
+        samples = timed(lambda i: self.copter.run_cmd(mavutil.mavlink.MAV_CMD_REQUEST_MESSAGE,
+                                                      msgid, 0, 0, 0, 0, 0, 0),
+                        20 if self.quick else 200)
+        self.record("run_cmd", samples)
+
+    def bench_get_parameter(self):
+        names = sorted(self.vehicle.parameters.keys())
+        samples = timed(lambda i: self.copter.get_parameter(names[i % len(names)]),
+                        20 if self.quick else 200)
+        self.record("get_parameter", samples)
+
+    def bench_set_parameters(self):
+        for count in (1, 10) if self.quick else (1, 10, 500):
+            names = ["BENCH_P%04u" % i for i in range(count)]
+            iterations = max(1, min(20, 100 // count))
+            samples = timed(lambda i: self.copter.set_parameters({name: float(i + 1000) for name in names}),
+                            iterations)
+            self.record("set_parameters_%u" % count, samples,
+                        params_per_s=count * len(samples) / sum(samples))
+
+    def bench_change_mode(self):
+        modes = ["GUIDED", "LOITER"]
+        samples = timed(lambda i: self.copter.change_mode(modes[i % len(modes)]), 4 if self.quick else 10)
+        self.record("change_mode", samples)
+
+    def bench_move_ned(self):
+        self.copter.change_mode("GUIDED")
+        duration = 1.0 if self.quick else 3.0
+        received = self.vehicle.received["SET_POSITION_TARGET_LOCAL_NED"]
+        samples = []
+        tstart = time.perf_counter()
+        while time.perf_counter() - tstart < duration:
+            t0 = time.perf_counter()
+            self.copter.move_ned(1, 0, -5)
+            samples.append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - tstart
+        time.sleep(0.2 + self.latency)
+        received = self.vehicle.received["SET_POSITION_TARGET_LOCAL_NED"] - received
+        self.record("move_ned", samples,
+                    sent_per_s=len(samples) / elapsed,
+                    received_per_s=received / elapsed)
+
+    def bench_waypoints(self):
+        (lat, lon, alt) = self.vehicle.home
+        for count in (10, 100) if self.quick else (10, 100, 1000, 5000):
+            self.copter.init_wp()
+            for i in range(count - 1):
+                self.copter.add_waypoint(lat + i * 1.0e-5, lon, 10)
+            tstart = time.perf_counter()
+            self.copter.send_all_waypoints()
+            upload = time.perf_counter() - tstart
+            # the last MISSION_ITEM_INT may still be on its way
+            while len(self.vehicle.mission) != count and time.perf_counter() - tstart < upload + 1:
+                time.sleep(0.001)
+            self.record("send_all_waypoints_%u" % count, [upload],
+                        items_per_s=count / upload, ok=len(self.vehicle.mission) == count)
+            tstart = time.perf_counter()
+            got = self.copter.get_all_waypoints()
+            download = time.perf_counter() - tstart
+            self.record("get_all_waypoints_%u" % count, [download],
+                        items_per_s=count / download, ok=got == count)
+
+    def bench_receive(self):
+        """Receive path at each telemetry rate: messages parsed per second and GLOBAL_POSITION_INT delivery latency.
+        The latency uses the fake vehicle time_boot_ms, so it is overestimated by up to 1ms."""
+        duration = 2.0 if self.quick else 5.0
+        for rate in (10, 50, 200):
+            for name in DEFAULT_RATES:
+                self.vehicle.rates[name] = rate
+            self.vehicle.next_send.clear()
+            time.sleep(0.5)
+            buf = self.copter.rx_buffer
+            start = buf.cursor()
+            tstart = time.monotonic()
+            time.sleep(duration)
+            end = buf.cursor()
+            elapsed = time.monotonic() - tstart
+            latencies = []
+            cursor = max(start, buf.oldest())
+            while cursor < end:
+                (m, cursor) = buf.wait(cursor, ['GLOBAL_POSITION_INT'], timeout=0)
+                if m is None or cursor > end:
+                    break
+                arrival = buf.arrival_time(cursor - 1)
+                if arrival is not None:
+                    latencies.append(arrival - (self.vehicle.boot_time + m.time_boot_ms * 0.001))
+            self.record("receive_%uhz" % rate, latencies,
+                        messages_per_s=(end - start) / elapsed,
+                        expected_per_s=rate * len(DEFAULT_RATES) + 1)
+        self.vehicle.rates.update(DEFAULT_RATES)
+        self.vehicle.next_send.clear()
+
+    def bench_parse(self):
+        """Raw decode throughput of a mixed telemetry byte stream, without any socket."""
+        frames = []
+
+        class Sink:
+            def write(self, buf):
+                frames.append(bytes(buf))
+
+        encoder = mavutil.mavlink.MAVLink(Sink(), srcSystem=1, srcComponent=1)
+        for i in range(1000):
+            encoder.global_position_int_send(i, -353632610, 1491652300, 584000, 10000, 0, 0, 0, 0)
+            encoder.attitude_send(i, 0, 0, 0, 0, 0, 0)
+            encoder.vfr_hud_send(0, 0, 0, 0, 10, 0)
+            encoder.gps_raw_int_send(i, 3, -353632610, 1491652300, 584000, 100, 100, 0, 0, 12)
+            encoder.sys_status_send(0, 0, 0, 200, 12600, 1000, 90, 0, 0, 0, 0, 0, 0)
+        stream = b''.join(frames)
+        parser = mavutil.mavlink.MAVLink(None)
+        parser.robust_parsing = True
+        samples = []
+        for repeat in range(3 if self.quick else 10):
+            tstart = time.perf_counter()
+            for offset in range(0, len(stream), 4096):
+                parser.parse_buffer(stream[offset:offset + 4096])
+            samples.append(time.perf_counter() - tstart)
+        self.record("parse_buffer_%u_msgs" % len(frames), samples,
+                    messages_per_s=len(frames) / min(samples))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark Copter protocol operations against a fake vehicle')
+    parser.add_argument('--port', type=int, default=14600, help='Local UDP port to use (default: 14600)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Added one-way latency in seconds (default: 0)')
+    parser.add_argument('--loss', type=float, default=0.0, help='Packet loss probability (default: 0)')
+    parser.add_argument('--quick', action='store_true', help='Fewer iterations and smaller sizes')
+    parser.add_argument('--verbose', action='store_true', help='Keep the Copter progress output')
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON results to this file')
+    args = parser.parse_args()
+
+    benchmark = CopterBenchmark(port=args.port, latency=args.latency, loss=args.loss, quick=args.quick,
+                                verbose=args.verbose)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "latency": args.latency,
+        "loss": args.loss,
+        "quick": args.quick,
+        "unit": "ms",
+        "results": benchmark.run(),
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text)
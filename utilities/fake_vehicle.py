@@ -0,0 +1,667 @@
+import argparse
+import collections
+import heapq
+import math
+import os
+import random
+import struct
+import threading
+import time
+
+from pymavlink import mavutil
+
+# ArduCopter custom modes
+STABILIZE = 0
+AUTO = 3
+GUIDED = 4
+LOITER = 5
+RTL = 6
+LAND = 9
+
+DEFAULT_PARAMETERS = {
+    "AHRS_EKF_TYPE": 3,
+    "WPNAV_RADIUS": 200,
+    "WPNAV_SPEED": 500,
+    "RTL_ALT": 1500,
+    "ARMING_CHECK": 1,
+    "SYSID_THISMAV": 1,
+    "SIM_FLOW_ENABLE": 0,
+    "FLOW_TYPE": 0,
+}
+
+DEFAULT_RATES = {
+    "SYSTEM_TIME": 1,
+    "SYS_STATUS": 1,
+    "GPS_RAW_INT": 5,
+    "GLOBAL_POSITION_INT": 10,
+    "LOCAL_POSITION_NED": 10,
+    "ATTITUDE": 10,
+    "VFR_HUD": 5,
+    "EKF_STATUS_REPORT": 2,
+    "MISSION_CURRENT": 1,
+    "NAV_CONTROLLER_OUTPUT": 5,
+}
+
+FIRMWARE_VERSION = (4 << 24) | (5 << 16) | (1 << 8) | 255  # 4.5.1 official
+EKF_GOOD_FLAGS = 831  # attitude, velocities, relative and absolute positions, predicted positions
+SENSORS_PRESENT = 0x1020ffff  # all the basic sensors, GPS and the prearm check bit
+
+
+class DelayedWriter:
+    """Stands between the MAVLink encoder and the socket to add latency and packet loss."""
+
+    def __init__(self, conn, latency=0.0, loss=0.0, rng=None):
+        self.conn = conn
+        self.latency = latency
+        self.loss = loss
+        self.rng = rng or random.Random()
+        self.pending = []
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def write(self, buf):
+        if self.loss > 0 and self.rng.random() < self.loss:
+            return
+        if self.latency <= 0:
+            self.conn.write(buf)
+            return
+        with self.lock:
+            self.counter += 1
+            heapq.heappush(self.pending, (time.monotonic() + self.latency, self.counter, bytes(buf)))
+
+    def flush(self):
+        """Send every delayed packet that is due; return the time the next one is due, or None."""
+        now = time.monotonic()
+        with self.lock:
+            while self.pending and self.pending[0][0] <= now:
+                (_, _, buf) = heapq.heappop(self.pending)
+                self.conn.write(buf)
+            if self.pending:
+                return self.pending[0][0]
+        return None
+
+
+class FakeVehicle:
+    """
+    Pure-Python ArduCopter stand-in for offline tests and benchmarks.
+
+    Answers HEARTBEAT, COMMAND_LONG (with COMMAND_ACK), the parameter protocol, the mission
+    upload/download handshake, MESSAGE_INTERVAL and HOME_POSITION, and streams telemetry at
+    configurable rates from a very simple point-mass model.
+
+    Args:
+        connection_str (str): Where to send the telemetry, as for mavutil.mavlink_connection.
+        sysid (int, optional): Our system id. Defaults to 1.
+        rates (Dict[str, float], optional): Telemetry rates in Hz by message name.
+        param_count (int, optional): Number of extra BENCH_Pxxxx parameters to add to the table.
+        latency (float, optional): Delay in seconds added to every packet we send.
+        loss (float, optional): Probability of dropping each packet we send or receive.
+        param_queue_len (int, optional): Length of the parameter request queue; requests received
+            while it is full are dropped, like ArduPilot does.
+        param_rate (float, optional): Number of parameter requests serviced per second.
+        seed (int, optional): Seed of the packet loss random generator.
+        ftp (bool, optional): Serve @PARAM/param.pck over MAVLink FTP. Defaults to True.
+        ftp_burst (int, optional): Number of packets in a FTP burst read.
+    """
+
+    def __init__(self, connection_str="udpout:127.0.0.1:14550", sysid=1, rates=None, param_count=0,
+                 latency=0.0, loss=0.0, param_queue_len=20, param_rate=1000.0, seed=None, ftp=True, ftp_burst=80):
+        os.environ['MAVLINK20'] = '1'
+        self.conn = mavutil.mavlink_connection(connection_str, source_system=sysid, source_component=1,
+                                               dialect="ardupilotmega")
+        self.rng = random.Random(seed)
+        self.writer = DelayedWriter(self.conn, latency=latency, loss=loss, rng=self.rng)
+        self.conn.mav.file = self.writer
+        self.mav = self.conn.mav
+        self.loss = loss
+        self.sysid = sysid
+        self.received = collections.Counter()
+
+        self.parameters = dict(DEFAULT_PARAMETERS)
+        self.parameters["SYSID_THISMAV"] = sysid
+        for i in range(param_count):
+            self.parameters["BENCH_P%04u" % i] = float(i)
+        self.param_names = sorted(self.parameters.keys())
+        self.param_queue = []
+        self.param_queue_len = param_queue_len
+        self.param_interval = 1.0 / param_rate
+        self.next_param_time = 0
+
+        self.rates = dict(DEFAULT_RATES)
+        if rates is not None:
+            self.rates.update(rates)
+        self.default_rates = dict(self.rates)
+        self.next_send = {}
+
+        self.mission = []
+        self.upload_count = None
+        self.upload_next = 0
+        self.upload_time = 0
+        self.current_wp = 0
+
+        self.long_command = None
+        self.long_command_time = 2.0
+        self.next_progress_time = 0
+
+        self.ftp = ftp
+        self.ftp_burst = ftp_burst
+        self.ftp_sessions = {}
+
+        self.armed = False
+        self.custom_mode = STABILIZE
+        self.sensors_health = SENSORS_PRESENT
+        self.home = (-35.363261, 149.165230, 584.0)
+        self.position = [0.0, 0.0, 0.0]
+        self.velocity = [0.0, 0.0, 0.0]
+        self.target = None
+        self.landing = False
+        self.speed = 5.0
+        self.boot_time = time.monotonic()
+        self.last_step = self.boot_time
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="fake-vehicle", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(2)
+            self.thread = None
+        self.conn.close()
+
+    def time_boot_ms(self):
+        return int((time.monotonic() - self.boot_time) * 1000)
+
+    def run(self):
+        next_heartbeat = 0
+        while self.running:
+            now = time.monotonic()
+            while True:
+                m = self.conn.recv_match(blocking=False)
+                if m is None:
+                    break
+                if self.loss > 0 and self.rng.random() < self.loss:
+                    continue
+                self.handle(m)
+            self.service_parameters(now)
+            self.service_upload(now)
+            self.service_long_command(now)
+            self.step(now)
+            if now >= next_heartbeat:
+                self.send_heartbeat()
+                next_heartbeat = now + 1
+            self.send_telemetry(now)
+            next_due = self.writer.flush()
+            wait = 0.002
+            if next_due is not None:
+                wait = min(wait, max(0.0, next_due - time.monotonic()))
+            self.conn.select(wait)
+
+    def handle(self, m):
+        mtype = m.get_type()
+        if mtype == 'BAD_DATA':
+            return
+        if getattr(m, 'target_system', self.sysid) not in (0, self.sysid):
+            return
+        self.received[mtype] += 1
+        handler = getattr(self, "handle_%s" % mtype.lower(), None)
+        if handler is not None:
+            handler(m)
+
+    # Commands ############################################################################################
+
+    def handle_command_long(self, m):
+        result = mavutil.mavlink.MAV_RESULT_ACCEPTED
+        command = m.command
+        if command == mavutil.mavlink.MAV_CMD_COMPONENT_ARM_DISARM:
+            self.armed = m.param1 == 1
+            if not self.armed:
+                self.landing = False
+                self.target = None
+        elif command == mavutil.mavlink.MAV_CMD_DO_SET_MODE:
+            self.set_mode(int(m.param2))
+        elif command == mavutil.mavlink.MAV_CMD_NAV_TAKEOFF:
+            if not self.armed or self.custom_mode != GUIDED:
+                result = mavutil.mavlink.MAV_RESULT_FAILED
+            else:
+                self.target = [self.position[0], self.position[1], -m.param7]
+        elif command == mavutil.mavlink.MAV_CMD_SET_MESSAGE_INTERVAL:
+            result = self.set_message_interval(int(m.param1), m.param2)
+        elif command == mavutil.mavlink.MAV_CMD_GET_MESSAGE_INTERVAL:
+            self.send_message_interval(int(m.param1))
+        elif command == mavutil.mavlink.MAV_CMD_GET_HOME_POSITION:
+            self.send_home_position()
+        elif command == mavutil.mavlink.MAV_CMD_PREFLIGHT_CALIBRATION:
+            # long running: MAV_RESULT_IN_PROGRESS ACKs until service_long_command finishes it
+            self.long_command = (command, m.get_srcSystem(), m.get_srcComponent(), time.monotonic())
+            self.next_progress_time = 0
+            return
+        elif command == mavutil.mavlink.MAV_CMD_REQUEST_MESSAGE:
+            if not self.send_by_id(int(m.param1)):
+                result = mavutil.mavlink.MAV_RESULT_UNSUPPORTED
+        else:
+            result = mavutil.mavlink.MAV_RESULT_UNSUPPORTED
+        self.mav.command_ack_send(command, result, 0, 0, m.get_srcSystem(), m.get_srcComponent())
+
+    def service_long_command(self, now):
+        if self.long_command is None or now < self.next_progress_time:
+            return
+        (command, sysid, compid, tstart) = self.long_command
+        elapsed = now - tstart
+        if elapsed >= self.long_command_time:
+            self.long_command = None
+            self.mav.command_ack_send(command, mavutil.mavlink.MAV_RESULT_ACCEPTED, 100, 0, sysid, compid)
+            return
+        self.mav.command_ack_send(command, mavutil.mavlink.MAV_RESULT_IN_PROGRESS,
+                                  int(100 * elapsed / self.long_command_time), 0, sysid, compid)
+        self.next_progress_time = now + 0.2
+
+    def handle_unknown_80(self, m):
+        # COMMAND_CANCEL isn't in the ardupilotmega dialect
+        header_len = 6 if m.data[0] == mavutil.mavlink.PROTOCOL_MARKER_V1 else 10
+        payload = bytes(m.data[header_len:header_len + 4]) + bytes(4)
+        (command, target_system, target_component) = struct.unpack_from('<HBB', payload, 0)
+        if self.long_command is None or self.long_command[0] != command or target_system != self.sysid:
+            return
+        (command, sysid, compid, tstart) = self.long_command
+        self.long_command = None
+        self.mav.command_ack_send(command, 6, 0, 0, sysid, compid)  # MAV_RESULT_CANCELLED
+
+    def set_mode(self, mode):
+        self.custom_mode = mode
+        self.landing = False
+        if mode == RTL:
+            self.target = [0.0, 0.0, -self.parameters["RTL_ALT"] * 0.01]
+        elif mode == LAND:
+            self.land()
+        elif mode == AUTO:
+            self.current_wp = min(1, len(self.mission) - 1) if self.mission else 0
+            self.target = self.mission_target(self.current_wp)
+        else:
+            self.target = list(self.position)
+
+    def handle_set_position_target_local_ned(self, m):
+        if self.custom_mode == GUIDED:
+            self.target = [m.x, m.y, m.z]
+
+    def handle_set_mode(self, m):
+        self.set_mode(m.custom_mode)
+
+    def handle_request_data_stream(self, m):
+        for name in self.rates:
+            self.rates[name] = m.req_message_rate if m.start_stop else 0
+
+    # Messages intervals ##################################################################################
+
+    def message_name(self, msgid):
+        cls = mavutil.mavlink.mavlink_map.get(msgid)
+        if cls is None:
+            return None
+        return cls.msgname
+
+    def set_message_interval(self, msgid, interval_us):
+        name = self.message_name(msgid)
+        if name is None:
+            return mavutil.mavlink.MAV_RESULT_DENIED
+        if interval_us == -1:
+            self.rates[name] = 0
+        elif interval_us == 0:
+            self.rates[name] = self.default_rates.get(name, 0)
+        else:
+            self.rates[name] = 1.0e6 / interval_us
+        self.next_send.pop(name, None)
+        return mavutil.mavlink.MAV_RESULT_ACCEPTED
+
+    def send_message_interval(self, msgid):
+        rate = self.rates.get(self.message_name(msgid), 0)
+        interval_us = int(1.0e6 / rate) if rate > 0 else -1
+        self.mav.message_interval_send(msgid, interval_us)
+
+    # Parameters ##########################################################################################
+
+    def queue_param_request(self, request):
+        if len(self.param_queue) >= self.param_queue_len:
+            return
+        self.param_queue.append(request)
+
+    def handle_param_request_read(self, m):
+        if m.param_index >= 0:
+            if m.param_index < len(self.param_names):
+                self.queue_param_request(self.param_names[m.param_index])
+            return
+        self.queue_param_request(m.param_id)
+
+    def handle_param_set(self, m):
+        if m.param_id not in self.parameters:
+            return
+        self.parameters[m.param_id] = m.param_value
+        self.queue_param_request(m.param_id)
+
+    def handle_param_request_list(self, m):
+        # like ArduPilot, the full list is streamed outside of the request queue
+        self.param_queue.extend(self.param_names)
+
+    def service_parameters(self, now):
+        while self.param_queue and now >= self.next_param_time:
+            name = self.param_queue.pop(0)
+            self.send_param(name)
+            self.next_param_time = max(self.next_param_time + self.param_interval, now - 0.1)
+
+    def send_param(self, name):
+        if name not in self.parameters:
+            return
+        self.mav.param_value_send(name.encode('ascii'),
+                                  self.parameters[name],
+                                  mavutil.mavlink.MAV_PARAM_TYPE_REAL32,
+                                  len(self.param_names),
+                                  self.param_names.index(name))
+
+    # FTP ###############################################################################################
+
+    def param_pck(self):
+        """The parameter table packed like ArduPilot's @PARAM/param.pck, in index order."""
+        out = [struct.pack('<HHH', 0x671b, len(self.param_names), len(self.param_names))]
+        last_name = b''
+        for name in self.param_names:
+            encoded = name.encode('ascii')
+            common = 0
+            while common < min(15, len(last_name), len(encoded) - 1) and last_name[common] == encoded[common]:
+                common += 1
+            suffix = encoded[common:]
+            out.append(struct.pack('<BB', 4, ((len(suffix) - 1) << 4) | common) + suffix +
+                       struct.pack('<f', self.parameters[name]))
+            last_name = encoded
+        return b''.join(out)
+
+    def ftp_send(self, m, seq, session, opcode, req_opcode, offset=0, data=b'', burst_complete=0):
+        payload = struct.pack('<HBBBBBBI', (seq + 1) % 0x10000, session, opcode, len(data), req_opcode,
+                              burst_complete, 0, offset) + data
+        payload += bytes(251 - len(payload))
+        self.mav.file_transfer_protocol_send(0, m.get_srcSystem(), m.get_srcComponent(), payload)
+
+    def handle_file_transfer_protocol(self, m):
+        if not self.ftp:
+            return
+        payload = bytes(m.payload)
+        (seq, session, opcode, size, _, _, _, offset) = struct.unpack_from('<HBBBBBBI', payload, 0)
+        data = payload[12:12 + size]
+        ack = 128
+        nak = 129
+        if opcode == 4:  # OpenFileRO
+            if data.rstrip(b'\0') != b'@PARAM/param.pck':
+                self.ftp_send(m, seq, 0, nak, opcode, data=bytes([10]))
+                return
+            session = len(self.ftp_sessions)
+            self.ftp_sessions[session] = self.param_pck()
+            self.ftp_send(m, seq, session, ack, opcode, data=struct.pack('<I', len(self.ftp_sessions[session])))
+        elif opcode in (1, 2):  # TerminateSession, ResetSessions
+            if opcode == 1:
+                self.ftp_sessions.pop(session, None)
+            else:
+                self.ftp_sessions.clear()
+            self.ftp_send(m, seq, session, ack, opcode)
+        elif opcode in (5, 15):  # ReadFile, BurstReadFile
+            content = self.ftp_sessions.get(session)
+            if content is None:
+                self.ftp_send(m, seq, session, nak, opcode, data=bytes([4]))
+                return
+            packets = self.ftp_burst if opcode == 15 else 1
+            for i in range(packets):
+                if offset >= len(content):
+                    self.ftp_send(m, seq, session, nak, opcode, offset, bytes([6]), burst_complete=1)
+                    return
+                chunk = content[offset:offset + 239]
+                self.ftp_send(m, seq, session, ack, opcode, offset, chunk, burst_complete=int(i == packets - 1))
+                seq += 1
+                offset += len(chunk)
+        else:
+            self.ftp_send(m, seq, session, nak, opcode, data=bytes([7]))
+
+    # Mission #############################################################################################
+
+    def handle_mission_clear_all(self, m):
+        self.mission = []
+        self.mav.mission_ack_send(m.get_srcSystem(), m.get_srcComponent(), mavutil.mavlink.MAV_MISSION_ACCEPTED)
+
+    def handle_mission_count(self, m):
+        self.upload_count = m.count
+        self.upload_next = 0
+        self.mission = []
+        self.request_upload_item()
+
+    def request_upload_item(self):
+        # MISSION_REQUEST rather than MISSION_REQUEST_INT, like the firmware Copter.send_all_waypoints expects
+        self.upload_time = time.monotonic()
+        self.mav.mission_request_send(255, 0, self.upload_next)
+
+    def service_upload(self, now):
+        # ask again if the item got lost
+        if self.upload_count is not None and now - self.upload_time > 1:
+            self.request_upload_item()
+
+    def handle_mission_item_int(self, m):
+        if self.upload_count is None:
+            return
+        if m.seq != self.upload_next:
+            return
+        self.mission.append(m)
+        self.upload_next += 1
+        if self.upload_next < self.upload_count:
+            self.request_upload_item()
+            return
+        self.upload_count = None
+        self.mav.mission_ack_send(m.get_srcSystem(), m.get_srcComponent(), mavutil.mavlink.MAV_MISSION_ACCEPTED)
+
+    def handle_mission_item(self, m):
+        self.handle_mission_item_int(mavutil.mavlink.MAVLink_mission_item_int_message(
+            m.target_system, m.target_component, m.seq, m.frame, m.command, m.current, m.autocontinue,
+            m.param1, m.param2, m.param3, m.param4, int(m.x * 1.0e7), int(m.y * 1.0e7), m.z))
+
+    def handle_mission_request_list(self, m):
+        self.mav.mission_count_send(m.get_srcSystem(), m.get_srcComponent(), len(self.mission))
+
+    def handle_mission_request_int(self, m):
+        if m.seq >= len(self.mission):
+            return
+        item = self.mission[m.seq]
+        self.mav.mission_item_int_send(m.get_srcSystem(), m.get_srcComponent(), item.seq, item.frame,
+                                       item.command, item.current, item.autocontinue, item.param1, item.param2,
+                                       item.param3, item.param4, item.x, item.y, item.z)
+
+    def handle_mission_request(self, m):
+        self.handle_mission_request_int(m)
+
+    def handle_mission_set_current(self, m):
+        if m.seq < len(self.mission):
+            self.current_wp = m.seq
+            if self.custom_mode == AUTO:
+                self.target = self.mission_target(self.current_wp)
+
+    def mission_target(self, seq):
+        if seq >= len(self.mission):
+            return list(self.position)
+        item = self.mission[seq]
+        if item.command == mavutil.mavlink.MAV_CMD_NAV_RETURN_TO_LAUNCH:
+            return [0.0, 0.0, -self.parameters["RTL_ALT"] * 0.01]
+        if item.command == mavutil.mavlink.MAV_CMD_NAV_TAKEOFF or (item.x == 0 and item.y == 0):
+            return [self.position[0], self.position[1], -item.z]
+        return self.ned_from_latlon(item.x * 1.0e-7, item.y * 1.0e-7) + [-item.z]
+
+    # Model ###############################################################################################
+
+    def ned_from_latlon(self, lat, lon):
+        north = math.radians(lat - self.home[0]) * 6378137.0
+        east = math.radians(lon - self.home[1]) * 6378137.0 * math.cos(math.radians(self.home[0]))
+        return [north, east]
+
+    def latlon(self):
+        lat = self.home[0] + math.degrees(self.position[0] / 6378137.0)
+        lon = self.home[1] + math.degrees(self.position[1] / (6378137.0 * math.cos(math.radians(self.home[0]))))
+        return lat, lon
+
+    def distance_to_target(self):
+        if self.target is None:
+            return 0.0
+        return math.sqrt(sum((self.target[i] - self.position[i]) ** 2 for i in range(3)))
+
+    def step(self, now):
+        dt = now - self.last_step
+        self.last_step = now
+        if not self.armed or self.target is None:
+            self.velocity = [0.0, 0.0, 0.0]
+            return
+        distance = self.distance_to_target()
+        if distance < 0.05:
+            self.velocity = [0.0, 0.0, 0.0]
+            self.target_reached()
+            return
+        speed = min(self.speed, distance / max(dt, 1.0e-3))
+        self.velocity = [(self.target[i] - self.position[i]) / distance * speed for i in range(3)]
+        for i in range(3):
+            self.position[i] += self.velocity[i] * dt
+        self.position[2] = min(self.position[2], 0.0)
+
+    def target_reached(self):
+        if self.landing:
+            self.landing = False
+            self.armed = False
+            self.target = None
+            return
+        if self.custom_mode == AUTO and self.current_wp < len(self.mission):
+            self.mav.mission_item_reached_send(self.current_wp)
+            command = self.mission[self.current_wp].command
+            if command in (mavutil.mavlink.MAV_CMD_NAV_RETURN_TO_LAUNCH, mavutil.mavlink.MAV_CMD_NAV_LAND):
+                self.land()
+            elif self.current_wp + 1 < len(self.mission):
+                self.current_wp += 1
+                self.target = self.mission_target(self.current_wp)
+            else:
+                self.target = None
+            return
+        if self.custom_mode in (LAND, RTL):
+            self.land()
+
+    def land(self):
+        self.landing = True
+        self.target = [self.position[0], self.position[1], 0.0]
+
+    # Telemetry ###########################################################################################
+
+    def send_heartbeat(self):
+        base_mode = mavutil.mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED
+        if self.armed:
+            base_mode |= mavutil.mavlink.MAV_MODE_FLAG_SAFETY_ARMED
+        self.mav.heartbeat_send(mavutil.mavlink.MAV_TYPE_QUADROTOR,
+                                mavutil.mavlink.MAV_AUTOPILOT_ARDUPILOTMEGA,
+                                base_mode,
+                                self.custom_mode,
+                                mavutil.mavlink.MAV_STATE_ACTIVE if self.armed else mavutil.mavlink.MAV_STATE_STANDBY)
+
+    def send_telemetry(self, now):
+        for (name, rate) in self.rates.items():
+            if rate <= 0:
+                continue
+            due = self.next_send.get(name, now)
+            if now < due:
+                continue
+            self.send_by_name(name)
+            due += 1.0 / rate
+            if due < now:
+                due = now + 1.0 / rate
+            self.next_send[name] = due
+
+    def send_by_id(self, msgid):
+        name = self.message_name(msgid)
+        if name == "HOME_POSITION":
+            self.send_home_position()
+            return True
+        return self.send_by_name(name)
+
+    def send_by_name(self, name):
+        sender = getattr(self, "send_%s" % str(name).lower(), None)
+        if sender is None:
+            return False
+        sender()
+        return True
+
+    def send_home_position(self):
+        self.mav.home_position_send(int(self.home[0] * 1.0e7), int(self.home[1] * 1.0e7), int(self.home[2] * 1000),
+                                    0, 0, 0, [1, 0, 0, 0], 0, 0, 0)
+
+    def send_autopilot_version(self):
+        self.mav.autopilot_version_send(mavutil.mavlink.MAV_PROTOCOL_CAPABILITY_MAVLINK2 |
+                                        mavutil.mavlink.MAV_PROTOCOL_CAPABILITY_MISSION_INT |
+                                        mavutil.mavlink.MAV_PROTOCOL_CAPABILITY_PARAM_FLOAT |
+                                        (mavutil.mavlink.MAV_PROTOCOL_CAPABILITY_FTP if self.ftp else 0),
+                                        FIRMWARE_VERSION, 0, 0, 0, [0] * 8, [0] * 8, [0] * 8, 0, 0,
+                                        0x5eed0000 + self.sysid)
+
+    def send_system_time(self):
+        self.mav.system_time_send(int(time.time() * 1.0e6), self.time_boot_ms())
+
+    def send_sys_status(self):
+        self.mav.sys_status_send(SENSORS_PRESENT, SENSORS_PRESENT, self.sensors_health, 200, 12600, 1000, 90, 0, 0,
+                                 0, 0, 0, 0)
+
+    def send_gps_raw_int(self):
+        (lat, lon) = self.latlon()
+        self.mav.gps_raw_int_send(self.time_boot_ms() * 1000, 3, int(lat * 1.0e7), int(lon * 1.0e7),
+                                  int((self.home[2] - self.position[2]) * 1000), 100, 100, 0, 0, 12)
+
+    def send_global_position_int(self):
+        (lat, lon) = self.latlon()
+        self.mav.global_position_int_send(self.time_boot_ms(), int(lat * 1.0e7), int(lon * 1.0e7),
+                                          int((self.home[2] - self.position[2]) * 1000),
+                                          int(-self.position[2] * 1000),
+                                          int(self.velocity[0] * 100), int(self.velocity[1] * 100),
+                                          int(self.velocity[2] * 100), 0)
+
+    def send_local_position_ned(self):
+        self.mav.local_position_ned_send(self.time_boot_ms(), self.position[0], self.position[1], self.position[2],
+                                         self.velocity[0], self.velocity[1], self.velocity[2])
+
+    def send_attitude(self):
+        self.mav.attitude_send(self.time_boot_ms(), 0, 0, 0, 0, 0, 0)
+
+    def send_vfr_hud(self):
+        groundspeed = math.sqrt(self.velocity[0] ** 2 + self.velocity[1] ** 2)
+        self.mav.vfr_hud_send(groundspeed, groundspeed, 0, 50 if self.armed else 0,
+                              self.home[2] - self.position[2], -self.velocity[2])
+
+    def send_ekf_status_report(self):
+        self.mav.ekf_status_report_send(EKF_GOOD_FLAGS, 0.1, 0.1, 0.1, 0.1, 0.1)
+
+    def send_mission_current(self):
+        self.mav.mission_current_send(self.current_wp)
+
+    def send_nav_controller_output(self):
+        self.mav.nav_controller_output_send(0, 0, 0, 0, int(self.distance_to_target()), 0, 0, 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fake ArduCopter for offline tests')
+    parser.add_argument('--connection_str', type=str, default='udpout:127.0.0.1:14550',
+                        help='Where to send telemetry (default: udpout:127.0.0.1:14550)')
+    parser.add_argument('--sysid', type=int, default=1, help='System ID (default: 1)')
+    parser.add_argument('--param_count', type=int, default=0, help='Extra parameters in the table (default: 0)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Added latency in seconds (default: 0)')
+    parser.add_argument('--loss', type=float, default=0.0, help='Packet loss probability (default: 0)')
+    parser.add_argument('--position_rate', type=float, default=10,
+                        help='GLOBAL_POSITION_INT and LOCAL_POSITION_NED rate in Hz (default: 10)')
+    args = parser.parse_args()
+
+    vehicle = FakeVehicle(args.connection_str, sysid=args.sysid, param_count=args.param_count,
+                          latency=args.latency, loss=args.loss,
+                          rates={"GLOBAL_POSITION_INT": args.position_rate,
+                                 "LOCAL_POSITION_NED": args.position_rate})
+    print(f"Fake vehicle SYSID {args.sysid} sending to {args.connection_str}")
+    vehicle.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        vehicle.stop()
@@ -1,32 +1,13 @@
 import time
 import sys
 import os
-from pymavlink import mavutil
 
-# add this folder to the path
+# add this folder and the Copter one to the path
 utilities_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(utilities_path)
+sys.path.append(os.path.dirname(utilities_path))
 from get_autopilot_info import get_autopilot_info
-
-
-def get_enum_value_by_name(enum_dict, name):
-    """
-    Get the value of an enum entry by its name.
-
-    Args:
-        enum_dict (Dict[str, Enum]): The enum dictionary to search.
-        name (str): The name of the enum entry.
-
-    Returns:
-        int: The value of the enum entry.
-
-    Raises:
-        ValueError: If no enum entry with the given name is found.
-    """
-    for key, enum_entry in enum_dict.items():
-        if enum_entry.name == name:
-            return key
-    raise ValueError("No enum entry with name: " + name)
+from lookup import enum_value
 
 
 def wait_until_position_aiding(mav_connection, timeout=120):
@@ -83,7 +64,7 @@ def ekf_pos_aiding(mav_connection, flags, estimator_status_msg="ESTIMATOR_STATUS
     ekf_flags = msg.flags
 
     for flag in flags:
-        flag_val = get_enum_value_by_name(mavutil.mavlink.enums["EKF_STATUS_FLAGS"], flag)
+        flag_val = enum_value("EKF_STATUS_FLAGS", flag)
         if not ekf_flags & flag_val:
             return False
 